@@ -0,0 +1,172 @@
+"""
+Dynamic micro-batching.
+
+MicroBatcher groups calls arriving within a short window into a single batched call on
+a background thread, then hands each caller its own result. LamaBatcher groups LaMa
+requests by padded size bucket and runs each group as one forward pass: LaMa is fully
+convolutional, so inputs padded to the same shape can share a batch. The rembg batcher
+lives in segmentation.py.
+"""
+import os
+import threading
+import queue
+import time
+from collections import Counter
+
+import numpy as np
+from PIL import Image
+
+import metrics
+
+# How long to wait for more requests after the first one arrives (0 disables batching)
+LAMA_BATCH_WINDOW_MS = float(os.environ.get("LAMA_BATCH_WINDOW_MS", "10"))
+LAMA_MAX_BATCH = int(os.environ.get("LAMA_MAX_BATCH", "4"))
+# Inputs are padded up to a multiple of this so similar sizes land in the same bucket
+LAMA_BATCH_BUCKET = int(os.environ.get("LAMA_BATCH_BUCKET", "64"))
+
+BATCH_SIZE = metrics.Histogram("cleanup_batch_size", "Requests per batched forward pass", ("batcher",),
+                               buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+
+
+class _Request:
+    def __init__(self, payload, key):
+        self.payload = payload
+        self.key = key
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Collects submit() calls for up to `window_ms` (at most `max_batch`), groups them by
+    key and passes each group's payloads to _run_batch, which subclasses implement and
+    which returns one result per payload.
+    """
+    name = "micro"
+    thread_name = "micro-batcher"
+
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batch_sizes = Counter()
+
+    def submit(self, payload, key=None):
+        """Run `payload` as part of a batch and return its result (blocks the caller)"""
+        request = _Request(payload, key)
+        self._ensure_started()
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run_batch(self, payloads: list) -> list:
+        raise NotImplementedError
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.thread_name, daemon=True)
+                self._thread.start()
+
+    def after_fork(self):
+        """Forget the parent's batching thread and queue in a forked server process"""
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def stop(self):
+        """Let the batching thread exit once queued requests are served; a later submit starts a new one"""
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread = None
+
+    def _collect(self):
+        pending = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(pending) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+            if pending[-1] is None:
+                break
+        return pending
+
+    def _loop(self):
+        running = True
+        while running:
+            groups = {}
+            for request in self._collect():
+                if request is None:
+                    running = False
+                    continue
+                groups.setdefault(request.key, []).append(request)
+            for group in groups.values():
+                try:
+                    results = self._run_batch([request.payload for request in group])
+                    for request, result in zip(group, results):
+                        request.result = result
+                    self.batch_sizes[len(group)] += 1
+                    BATCH_SIZE.observe(len(group), batcher=self.name)
+                except Exception as e:
+                    for request in group:
+                        request.error = e
+                finally:
+                    for request in group:
+                        request.done.set()
+
+    def stats(self) -> dict:
+        return {
+            "window_ms": self.window * 1000.0,
+            "max_batch": self.max_batch,
+            "batches": sum(self.batch_sizes.values()),
+            "requests": sum(size * count for size, count in self.batch_sizes.items()),
+            "batch_sizes": dict(self.batch_sizes),
+        }
+
+
+class LamaBatcher(MicroBatcher):
+    name = "lama"
+    thread_name = "lama-batcher"
+
+    def __init__(self, lama, window_ms: float = LAMA_BATCH_WINDOW_MS, max_batch: int = LAMA_MAX_BATCH, bucket: int = LAMA_BATCH_BUCKET):
+        super().__init__(window_ms, max_batch)
+        self.lama = lama
+        self.bucket = max(8, bucket)
+
+    def __call__(self, image: Image.Image, mask: Image.Image) -> Image.Image:
+        w, h = image.size
+        # Requests padded to the same bucket size can share a forward pass
+        key = (-(-h // self.bucket) * self.bucket, -(-w // self.bucket) * self.bucket)
+        return self.submit((image.convert("RGB"), mask.convert("L")), key)
+
+    def _run_batch(self, payloads: list) -> list:
+        import torch
+        from simple_lama_inpainting.utils.util import prepare_img_and_mask
+
+        device = self.lama.device
+        images, masks = [], []
+        for image, mask in payloads:
+            # Padding to a multiple of the bucket size lands every request of a group on the same shape
+            image, mask = prepare_img_and_mask(image, mask, torch.device("cpu"), pad_out_to_modulo=self.bucket)
+            images.append(image)
+            masks.append(mask)
+
+        with torch.inference_mode():
+            output = self.lama.model(torch.cat(images).to(device), torch.cat(masks).to(device))
+
+        output = np.clip(output.permute(0, 2, 3, 1).cpu().numpy() * 255, 0, 255).astype(np.uint8)
+        results = []
+        for index, (image, _) in enumerate(payloads):
+            w, h = image.size
+            results.append(Image.fromarray(output[index, :h, :w]))
+        return results
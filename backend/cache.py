@@ -0,0 +1,114 @@
+"""
+Content-addressed inference cache.
+
+Results are keyed on a hash of the decoded image, the binarized mask, the model id,
+prompt, quality preset and output encoding, so resubmitting the same edit (undo/redo, retries,
+double-clicks) returns the stored result instead of rerunning the model. Identical
+jobs that are still running are shared rather than started twice.
+"""
+import os
+import hashlib
+import tempfile
+import threading
+
+import numpy as np
+from PIL import Image
+
+import shared_state
+from masks import MODEL_THRESHOLD
+from store import create_blob_store
+
+INFERENCE_CACHE = os.environ.get("INFERENCE_CACHE", "memory").lower()  # memory | disk | off
+INFERENCE_CACHE_DIR = os.environ.get("INFERENCE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "cleanup-image-cache"))
+INFERENCE_CACHE_MAX_BYTES = int(os.environ.get("INFERENCE_CACHE_MB", "256")) * 1024 * 1024
+INFERENCE_CACHE_TTL_SECONDS = int(os.environ.get("INFERENCE_CACHE_TTL_SECONDS", "86400"))
+
+
+def image_digest(image: Image.Image) -> str:
+    """Hash of the decoded pixels, independent of the container format"""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{image.mode}:{image.size}".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def mask_digest(mask: Image.Image) -> str:
+    """Hash of the binarized mask (what the model actually sees)"""
+    binary = np.packbits(np.asarray(mask.convert("L")) > MODEL_THRESHOLD)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{mask.size}".encode())
+    h.update(binary.tobytes())
+    return h.hexdigest()
+
+
+def inference_key(image: Image.Image, mask: Image.Image, model_id: str, prompt: str = None, quality: str = None, image_hash: str = None, output: str = None) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    for part in (image_hash or image_digest(image), mask_digest(mask), model_id, prompt or "", quality or "", output or ""):
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class InferenceCache:
+    def __init__(self, kind: str = INFERENCE_CACHE, directory: str = INFERENCE_CACHE_DIR,
+                 max_bytes: int = INFERENCE_CACHE_MAX_BYTES, ttl: int = INFERENCE_CACHE_TTL_SECONDS):
+        self.enabled = kind != "off"
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        if shared_state.enabled():
+            # One store and in-flight map for all server processes (configured from the same environment)
+            self.store = shared_state.remote("inference_store") if self.enabled else None
+            self._inflight = shared_state.remote("inflight")
+        else:
+            self.store = create_blob_store(kind, directory, max_bytes=max_bytes, ttl=ttl) if self.enabled else None
+            self._inflight = {}  # key -> job_id computing it
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Return (data, meta) for a cached result, or None"""
+        if not self.enabled:
+            return None
+        data = self.store.get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return data, self.store.meta(key) or {}
+
+    def put(self, key: str, data: bytes, meta: dict = None):
+        if self.enabled:
+            self.store.put(key, data, meta)
+
+    def claim(self, key: str, job_id: str):
+        """
+        Register `job_id` as the computation for `key`. Returns the id of an identical
+        job already in flight (and registers nothing), or None if this job owns the key.
+        """
+        # setdefault is a single step on the shared map too
+        existing = self._inflight.setdefault(key, job_id)
+        if existing == job_id:
+            return None
+        with self._lock:
+            self.deduplicated += 1
+        return existing
+
+    def release(self, key: str):
+        self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "deduplicated": self.deduplicated,
+                "in_flight": len(self._inflight),
+                "store": self.store.stats() if self.enabled else None,
+            }
+
+
+inference_cache = InferenceCache()
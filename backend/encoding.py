@@ -0,0 +1,124 @@
+"""
+Result image encoding.
+
+Clients choose the output format with ?format= or, failing that, an Accept header:
+PNG (at a configurable compression level), lossless or lossy WebP, or JPEG. PNG stays
+the default so existing clients see no change, but at a low zlib level, which is many
+times faster than Pillow's default for a modest size increase. Previews are small JPEGs
+that can be published before the full-size result is encoded.
+"""
+import os
+from io import BytesIO
+
+from PIL import Image
+
+# zlib level for PNG results (0-9). Pillow's default of 6 costs several times the CPU of 1.
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", "1"))
+# Quality of JPEG and lossy WebP results
+LOSSY_QUALITY = int(os.environ.get("LOSSY_QUALITY", "90"))
+# WebP encoder effort (0 = fastest, 6 = smallest)
+WEBP_METHOD = int(os.environ.get("WEBP_METHOD", "2"))
+# Longest side and JPEG quality of fast previews
+PREVIEW_MAX_DIM = int(os.environ.get("PREVIEW_MAX_DIM", "512"))
+PREVIEW_QUALITY = int(os.environ.get("PREVIEW_QUALITY", "75"))
+
+MEDIA_TYPES = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+ALIASES = {"jpg": "jpeg"}
+EXTENSIONS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg"}
+
+
+class OutputFormat:
+    """An output format plus its encoder settings"""
+
+    def __init__(self, format: str = "png", lossless: bool = True, compression: int = None, quality: int = None):
+        format = ALIASES.get(format, format)
+        if format not in MEDIA_TYPES:
+            raise ValueError(f"Unsupported output format '{format}' (use png, webp or jpeg)")
+        self.format = format
+        self.lossless = lossless
+        self.compression = PNG_COMPRESS_LEVEL if compression is None else compression
+        self.quality = LOSSY_QUALITY if quality is None else quality
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.format]
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS[self.format]
+
+    @property
+    def key(self) -> str:
+        """Identifies the encoded bytes, for cache keys"""
+        if self.format == "png":
+            return f"png:{self.compression}"
+        if self.format == "webp" and self.lossless:
+            return "webp:lossless"
+        return f"{self.format}:{self.quality}"
+
+
+PNG = OutputFormat("png")
+
+
+def _accepted(accept: str) -> list:
+    """Image formats from an Accept header, most preferred first"""
+    ranked = []
+    for position, item in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        for format, known in MEDIA_TYPES.items():
+            if media_type.lower() == known and q > 0:
+                ranked.append((-q, position, format))
+    return [format for _, _, format in sorted(ranked)]
+
+
+def negotiate(format: str = None, accept: str = None, lossless: bool = True, compression: int = None, quality: int = None) -> OutputFormat:
+    """
+    The requested output format: `format` if given, else the most preferred image type
+    named in `accept` (wildcards do not count), else PNG. Raises ValueError for an
+    unknown `format`.
+    """
+    if not format:
+        preferred = _accepted(accept or "")
+        format = preferred[0] if preferred else "png"
+    return OutputFormat(format.lower(), lossless=lossless, compression=compression, quality=quality)
+
+
+def encode(image: Image.Image, output: OutputFormat = PNG) -> tuple:
+    """
+    Encode `image` and return (data, media_type). JPEG cannot carry transparency, so
+    images with an alpha channel are written as PNG instead.
+    """
+    if output.format == "jpeg" and (image.mode in ("RGBA", "LA") or "transparency" in image.info):
+        output = OutputFormat("png", compression=output.compression)
+
+    buffer = BytesIO()
+    if output.format == "png":
+        image.save(buffer, format="PNG", compress_level=output.compression)
+    elif output.format == "webp":
+        if output.lossless:
+            # In lossless mode "quality" is encoder effort, scaled like the method
+            image.save(buffer, format="WEBP", lossless=True, quality=WEBP_METHOD * 100 // 6, method=WEBP_METHOD)
+        else:
+            image.save(buffer, format="WEBP", quality=output.quality, method=WEBP_METHOD)
+    else:
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        # Full chroma resolution for high-quality results, 4:2:0 below that
+        image.save(buffer, format="JPEG", quality=output.quality, subsampling=0 if output.quality >= 90 else 2)
+    return buffer.getvalue(), output.media_type
+
+
+def encode_preview(image: Image.Image, max_dim: int = PREVIEW_MAX_DIM, quality: int = PREVIEW_QUALITY) -> bytes:
+    """Small JPEG of `image` (longest side at most `max_dim`) for showing before the full result"""
+    preview = image.convert("RGB") if image.mode not in ("RGB", "L") else image.copy()
+    preview.thumbnail((max_dim, max_dim), Image.BILINEAR)
+    buffer = BytesIO()
+    preview.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
@@ -0,0 +1,77 @@
+"""
+Thread pools for blocking work.
+
+Model inference and image codec work (decode, resize, encode) run on separate pools so
+a burst of heavy inference cannot starve cheap decode/encode work and vice versa.
+Threads are created on demand, so importing this module starts nothing. Both pools
+record how long work waits for a free thread.
+"""
+import os
+import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", "2"))
+CODEC_THREADS = int(os.environ.get("CODEC_THREADS", str(min(4, os.cpu_count() or 1))))
+
+
+class InstrumentedPool(ThreadPoolExecutor):
+    """ThreadPoolExecutor that tracks queue depth, running calls and queue wait time"""
+
+    def __init__(self, max_workers: int, name: str):
+        super().__init__(max_workers=max_workers, thread_name_prefix=name)
+        self.name = name
+        self.pending = 0  # submitted, waiting for a thread
+        self.running = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        queued_at = time.perf_counter()
+        with self._stats_lock:
+            self.pending += 1
+
+        def timed():
+            wait = time.perf_counter() - queued_at
+            with self._stats_lock:
+                self.pending -= 1
+                self.running += 1
+                self.completed += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self.running -= 1
+
+        return super().submit(timed)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "workers": self._max_workers,
+                "pending": self.pending,
+                "running": self.running,
+                "completed": self.completed,
+                "avg_wait_ms": 1000.0 * self.wait_total / self.completed if self.completed else 0.0,
+                "max_wait_ms": 1000.0 * self.wait_max,
+            }
+
+
+inference_pool = InstrumentedPool(INFERENCE_THREADS, "inference")
+codec_pool = InstrumentedPool(CODEC_THREADS, "codec")
+
+
+async def run_inference(fn, *args, **kwargs):
+    """Run a model call (rembg, LaMa, SDXL) without blocking the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(inference_pool, functools.partial(fn, *args, **kwargs))
+
+
+async def run_codec(fn, *args, **kwargs):
+    """Run image decode/resize/encode work without blocking the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(codec_pool, functools.partial(fn, *args, **kwargs))
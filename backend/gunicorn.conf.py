@@ -0,0 +1,36 @@
+# Multi-process serving with shared model weights (see shared.py) and job, session and
+# dedupe state shared by the workers (see shared_state.py), so any worker can answer any
+# request. Needs gunicorn (in requirements.txt):
+#   WEB_CONCURRENCY=4 gunicorn -c gunicorn.conf.py main:app
+import os
+import sys
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Import the app (and load the weights) once in the parent, then fork the workers. Also
+# required for the shared state: the queue bound and model slots are created at import.
+preload_app = True
+# Long SDXL jobs and streamed batch ZIPs outlive gunicorn's default 30 s
+timeout = int(os.environ.get("WORKER_TIMEOUT", "300"))
+
+# Children size their thread pools from this (lama_backends.cpu_threads)
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+# Started while the config loads, before the preloaded app is imported, so the app builds
+# its stores on the shared state
+if workers > 1:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import shared_state
+    shared_state.start()
+
+
+def when_ready(server):
+    if os.environ.get("SHARED_WEIGHTS", "true").lower() == "true":
+        import shared
+        shared.preload()
+
+
+def post_fork(server, worker):
+    import shared
+    shared.after_fork()
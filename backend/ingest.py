@@ -0,0 +1,76 @@
+"""
+Upload ingestion with as few full-size copies as possible.
+
+Starlette already spools multipart uploads over 1 MB to a temporary file, so images are
+decoded straight from that file instead of being read into memory first. When a quality
+preset is going to downscale the image anyway, JPEGs are decoded at reduced size (DCT
+scaling via Image.draft, 1/2 to 1/8) and other formats are reduced by an integer factor
+before the final resample, so a 24 MP camera photo never exists at full resolution.
+Masks are decoded directly into a grayscale numpy array.
+"""
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# Integer-reduce first when the downscale factor is at least this large (Image.resize reducing_gap)
+REDUCING_GAP = 2.0
+
+
+def target_size(size: tuple, max_dim: int) -> tuple:
+    """`size` scaled down so its longer side is `max_dim` (unchanged if it already fits)"""
+    w, h = size
+    if max(w, h) <= max_dim:
+        return size
+    scale = max_dim / max(w, h)
+    return max(1, int(w * scale)), max(1, int(h * scale))
+
+
+def open_image(source, mode: str, max_dim: int = None) -> tuple:
+    """
+    Decode an image from a path, file object or bytes. With `max_dim`, decode at a reduced
+    size no smaller than the preset's target (the caller still resamples to the exact
+    size). Returns (image in `mode`, original (w, h)).
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    elif hasattr(source, "seek"):
+        source.seek(0)
+    image = Image.open(source)
+    original_size = image.size
+    if max_dim and max(original_size) > max_dim:
+        target = target_size(original_size, max_dim)
+        if image.format == "JPEG":
+            # Picks the largest DCT scale that still covers `target`; nothing decoded yet
+            image.draft(mode if mode in ("RGB", "L") else None, target)
+        else:
+            factor = min(original_size[0] // target[0], original_size[1] // target[1])
+            if factor >= 2:
+                if image.mode not in ("L", "LA", "RGB", "RGBA"):
+                    # Palette and bilevel images cannot be reduced directly
+                    image = image.convert(mode)
+                image = image.reduce(factor)
+    image.load()
+    # convert() always copies, even to the mode the image already has
+    if image.mode != mode:
+        image = image.convert(mode)
+    return image, original_size
+
+
+def downscale(image: Image.Image, size: tuple) -> Image.Image:
+    """LANCZOS to `size`, integer-reducing first when shrinking a lot"""
+    return image.resize(size, Image.LANCZOS, reducing_gap=REDUCING_GAP)
+
+
+def decode_mask(source) -> np.ndarray:
+    """Decode a mask upload (bytes or file object) to a uint8 grayscale array"""
+    import cv2
+    if hasattr(source, "read"):
+        source.seek(0)
+        source = source.read()
+    # EXIF orientation is ignored, as PIL does for the image, so the two stay aligned
+    mask = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION)
+    if mask is None:
+        # Formats OpenCV cannot read
+        return np.asarray(open_image(source, "L")[0])
+    return mask
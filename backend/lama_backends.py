@@ -0,0 +1,415 @@
+"""
+Alternative LaMa inference backends, mainly for CPU-only nodes.
+
+LAMA_BACKEND selects how the model runs:
+  eager        SimpleLama's TorchScript module as shipped (default)
+  torchscript  the same graph frozen and optimized for inference
+  onnx         exported once to ONNX and run with ONNX Runtime (CPU only)
+
+LAMA_QUANTIZE=dynamic|static additionally quantizes the ONNX graph's conv weights (and,
+for static, activations) to int8 with ONNX Runtime's quantization tools.
+
+Converted artifacts are cached in LAMA_ARTIFACT_DIR next to a small JSON record. A new
+artifact is only used after its output matches the eager model: within
+LAMA_PARITY_TOLERANCE on a fixed input for fp32 graphs, and at least LAMA_MIN_PSNR dB on
+a fixed test set for quantized ones. Later processes reuse the record, so they never
+load the eager model at all. Any failure falls back to eager.
+"""
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+from PIL import Image
+
+LAMA_BACKEND = os.environ.get("LAMA_BACKEND", "eager").lower()
+LAMA_ARTIFACT_DIR = os.environ.get("LAMA_ARTIFACT_DIR", os.path.join(os.path.expanduser("~"), ".cache", "cleanup-image"))
+# Max absolute difference from the eager output (on the 0..1 scale) for a converted model to be accepted
+LAMA_PARITY_TOLERANCE = float(os.environ.get("LAMA_PARITY_TOLERANCE", "0.02"))
+# int8 quantization of the ONNX graph: off | dynamic | static
+LAMA_QUANTIZE = os.environ.get("LAMA_QUANTIZE", "off").lower()
+# Lowest acceptable PSNR (dB, masked pixels) of a quantized model against the fp32 eager model
+LAMA_MIN_PSNR = float(os.environ.get("LAMA_MIN_PSNR", "30"))
+# NHWC memory layout for the torch backends, usually faster for convolutions on CPU
+LAMA_CHANNELS_LAST = os.environ.get("LAMA_CHANNELS_LAST", "false").lower() == "true"
+# Intra-op threads per process on CPU (0 = CPU count divided by INFERENCE_WORKERS times
+# the number of server processes, WEB_CONCURRENCY, so concurrent jobs do not oversubscribe the cores)
+LAMA_THREADS = int(os.environ.get("LAMA_THREADS", "0"))
+# ONNX Runtime thread pools (intra-op 0 = same as LAMA_THREADS)
+ORT_INTRA_OP_THREADS = int(os.environ.get("ORT_INTRA_OP_THREADS", "0"))
+ORT_INTER_OP_THREADS = int(os.environ.get("ORT_INTER_OP_THREADS", "1"))
+ONNX_OPSET = int(os.environ.get("LAMA_ONNX_OPSET", "17"))
+
+BACKENDS = ("eager", "torchscript", "onnx")
+QUANTIZE_MODES = ("off", "dynamic", "static")
+
+
+def cpu_threads() -> int:
+    if LAMA_THREADS > 0:
+        return LAMA_THREADS
+    workers = max(1, int(os.environ.get("INFERENCE_WORKERS", "2"))) * max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def configure_torch_threads() -> int:
+    """Apply the per-process intra-op thread count for CPU inference"""
+    import torch
+
+    threads = cpu_threads()
+    torch.set_num_threads(threads)
+    return threads
+
+
+class LamaRunner:
+    """
+    Same interface as SimpleLama (`model`, `device`, `__call__`) around a converted graph,
+    so LamaBatcher and the tiling code work with every backend.
+    """
+
+    def __init__(self, model, device, backend: str):
+        self.model = model
+        self.device = device
+        self.backend = backend
+
+    def __call__(self, image, mask):
+        import torch
+        from simple_lama_inpainting.utils.util import prepare_img_and_mask
+
+        image, mask = prepare_img_and_mask(image, mask, self.device)
+        with torch.inference_mode():
+            output = self.model(image, mask)
+        output = output[0].permute(1, 2, 0).cpu().numpy()
+        return Image.fromarray(np.clip(output * 255, 0, 255).astype(np.uint8))
+
+
+class ChannelsLastModule:
+    """Feeds a channels_last model NHWC-strided inputs (the tensor shapes stay NCHW)"""
+
+    def __init__(self, module):
+        import torch
+
+        self.module = module.to(memory_format=torch.channels_last)
+
+    def __call__(self, image, mask):
+        import torch
+
+        return self.module(image.contiguous(memory_format=torch.channels_last),
+                           mask.contiguous(memory_format=torch.channels_last))
+
+
+class OnnxLamaModule:
+    """Callable like the TorchScript module: (image, mask) tensors in, a tensor out"""
+
+    def __init__(self, session):
+        self.session = session
+
+    def __call__(self, image, mask):
+        import torch
+
+        output = self.session.run(None, {
+            "image": image.detach().cpu().numpy().astype(np.float32, copy=False),
+            "mask": mask.detach().cpu().numpy().astype(np.float32, copy=False),
+        })[0]
+        return torch.from_numpy(output)
+
+
+def weights_path() -> str:
+    """Path of the LaMa TorchScript weights, downloading them like SimpleLama does"""
+    from simple_lama_inpainting.models.model import LAMA_MODEL_URL
+    from simple_lama_inpainting.utils.util import download_model
+
+    path = os.environ.get("LAMA_MODEL")
+    if path:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"lama torchscript model not found: {path}")
+        return path
+    return download_model(LAMA_MODEL_URL)
+
+
+def artifact_key(source: str, backend: str, quantize: str = "off") -> str:
+    import torch
+
+    stat = os.stat(source)
+    fingerprint = f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}:{backend}:{quantize}:{torch.__version__}:{ONNX_OPSET}"
+    return hashlib.blake2b(fingerprint.encode(), digest_size=8).hexdigest()
+
+
+def parity_inputs(size: int = 256):
+    """Fixed image and mask used for the parity check"""
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    mask[size // 4:size // 2, size // 3:2 * size // 3] = 255
+    return Image.fromarray(image), Image.fromarray(mask)
+
+
+def test_set(size: int = 256) -> list:
+    """Fixed (image, mask) pairs covering noise, smooth gradients, texture and flat areas"""
+    rng = np.random.default_rng(1)
+    yy, xx = np.mgrid[0:size, 0:size]
+    noise = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    gradient = np.stack([xx * 255 // size, yy * 255 // size, (xx + yy) * 127 // size], axis=-1).astype(np.uint8)
+    texture = np.repeat((((xx // 8 + yy // 8) % 2) * 200 + 30).astype(np.uint8)[..., None], 3, axis=-1)
+    scene = np.full((size, size, 3), (90, 140, 200), dtype=np.uint8)
+    scene[size // 2:] = (70, 110, 40)
+    scene[size // 3:2 * size // 3, size // 4:size // 2] = (160, 60, 50)
+
+    box = np.zeros((size, size), dtype=np.uint8)
+    box[size // 4:size // 2, size // 3:2 * size // 3] = 255
+    disc = (((xx - size / 2) ** 2 + (yy - size / 2) ** 2) < (size / 6) ** 2).astype(np.uint8) * 255
+    stroke = (np.abs(xx - yy) < 4).astype(np.uint8) * 255
+    blobs = np.zeros((size, size), dtype=np.uint8)
+    for cy, cx in rng.integers(size // 8, size - size // 8, (5, 2)):
+        blobs[max(0, cy - 10):cy + 10, max(0, cx - 10):cx + 10] = 255
+
+    return [(Image.fromarray(image), Image.fromarray(mask))
+            for image, mask in ((noise, box), (gradient, disc), (texture, stroke), (scene, blobs))]
+
+
+def compare_outputs(reference: np.ndarray, candidate: np.ndarray) -> dict:
+    diff = np.abs(reference.astype(np.float32) - candidate.astype(np.float32)) / 255.0
+    return {"max_abs_diff": round(float(diff.max()), 5), "mean_abs_diff": round(float(diff.mean()), 6)}
+
+
+def psnr(reference: np.ndarray, candidate: np.ndarray, mask: np.ndarray = None) -> float:
+    """PSNR in dB (capped at 100 for identical images), over the masked pixels only when `mask` is given"""
+    diff = reference.astype(np.float32) - candidate.astype(np.float32)
+    if mask is not None:
+        diff = diff[mask > 0]
+    mse = float(np.mean(diff ** 2)) if diff.size else 0.0
+    return 100.0 if mse == 0 else min(100.0, float(10.0 * np.log10(255.0 ** 2 / mse)))
+
+
+def accuracy(reference, candidate, cases: list = None) -> dict:
+    """PSNR of `candidate` against `reference` (both SimpleLama-compatible) on the test set"""
+    values = []
+    for image, mask in cases or test_set():
+        w, h = image.size
+        expected = np.asarray(reference(image, mask))[:h, :w]
+        actual = np.asarray(candidate(image, mask))[:h, :w]
+        values.append(round(psnr(expected, actual, np.asarray(mask)), 2))
+    return {"psnr_db": values, "min_psnr_db": min(values)}
+
+
+def _freeze(eager, path):
+    import torch
+
+    # optimize_for_inference() output cannot be serialized, so it is applied after loading
+    torch.jit.save(torch.jit.freeze(eager.model.eval()), path)
+
+
+def _register_fft_symbolics():
+    """
+    LaMa's Fourier units use rfftn/irfftn on complex tensors, which the TorchScript ONNX
+    exporter does not support. Complex tensors are exported as real ones with a trailing
+    (real, imag) axis of size 2 and the transforms map onto the opset 17 DFT operator.
+    """
+    import torch
+    from torch.onnx import register_custom_op_symbolic, symbolic_helper
+
+    def const(g, value, dtype=torch.int64):
+        return g.op("Constant", value_t=torch.tensor(value, dtype=dtype))
+
+    def scale(g, x, count, power):
+        # x * count ** power, where count is the number of transformed elements
+        n = g.op("Cast", g.op("ReduceProd", count, keepdims_i=0), to_i=1)
+        return g.op("Mul", x, g.op("Pow", n, const(g, power, torch.float32)))
+
+    def axes(dim, rank):
+        return [d % rank for d in symbolic_helper._get_const(dim, "is", "dim")]
+
+    def rfftn(g, x, s, dim, norm):
+        dims = axes(dim, symbolic_helper._get_tensor_rank(x))
+        y = g.op("DFT", g.op("Unsqueeze", x, const(g, [-1])), axis_i=dims[-1], onesided_i=1)
+        for d in dims[:-1]:
+            y = g.op("DFT", y, axis_i=d)
+        norm = symbolic_helper._maybe_get_const(norm, "s")
+        if norm in ("ortho", "forward"):
+            count = g.op("Gather", g.op("Shape", x), const(g, dims))
+            y = scale(g, y, count, -0.5 if norm == "ortho" else -1.0)
+        return y
+
+    def irfftn(g, x, s, dim, norm):
+        # x has the trailing complex axis, so its rank is one more than the complex tensor's
+        dims = axes(dim, symbolic_helper._get_tensor_rank(x) - 1)
+        for d in dims[:-1]:
+            x = g.op("DFT", x, axis_i=d, inverse_i=1)
+        # Rebuild the full spectrum along the last axis from Hermitian symmetry, then invert it
+        last = dims[-1]
+        sizes = g.op("Cast", s, to_i=7)
+        length = g.op("Gather", sizes, const(g, [-1]))
+        half = g.op("Gather", g.op("Shape", x), const(g, [last]))
+        tail = g.op("Slice", x, g.op("Sub", length, half), const(g, [0]), const(g, [last]), const(g, [-1]))
+        tail = g.op("Mul", tail, const(g, [1.0, -1.0], torch.float32))
+        y = g.op("DFT", g.op("Concat", x, tail, axis_i=last), axis_i=last, inverse_i=1)
+        y = g.op("Gather", y, const(g, 0), axis_i=-1)
+        # ONNX Runtime's inverse DFT already divides by the length ("backward" normalization)
+        norm = symbolic_helper._maybe_get_const(norm, "s")
+        if norm in ("ortho", "forward"):
+            y = scale(g, y, sizes, 0.5 if norm == "ortho" else 1.0)
+        return y
+
+    def real(g, x):
+        return g.op("Gather", x, const(g, 0), axis_i=-1)
+
+    def imag(g, x):
+        return g.op("Gather", x, const(g, 1), axis_i=-1)
+
+    def complex(g, re, im):
+        return g.op("Concat", g.op("Unsqueeze", re, const(g, [-1])), g.op("Unsqueeze", im, const(g, [-1])), axis_i=-1)
+
+    for name, fn in (("fft_rfftn", rfftn), ("fft_irfftn", irfftn), ("real", real), ("imag", imag), ("complex", complex)):
+        register_custom_op_symbolic(f"aten::{name}", fn, ONNX_OPSET)
+
+
+def _export_onnx(eager, path):
+    import torch
+    from simple_lama_inpainting.utils.util import prepare_img_and_mask
+
+    _register_fft_symbolics()
+    image, mask = prepare_img_and_mask(*parity_inputs(), eager.device)
+    torch.onnx.export(
+        eager.model, (image, mask.float()), path,
+        input_names=["image", "mask"], output_names=["output"],
+        dynamic_axes={name: {0: "batch", 2: "height", 3: "width"} for name in ("image", "mask", "output")},
+        opset_version=ONNX_OPSET, dynamo=False,
+    )
+
+
+def _quantize(source, path, mode):
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+    from simple_lama_inpainting.utils.util import prepare_img_and_mask
+
+    if mode == "dynamic":
+        quantize_dynamic(source, path, weight_type=QuantType.QUInt8)
+        return
+
+    class TestSetReader(CalibrationDataReader):
+        def __init__(self):
+            self.batches = iter([
+                {"image": image.numpy(), "mask": mask.float().numpy()}
+                for image, mask in (prepare_img_and_mask(i, m, "cpu") for i, m in test_set())
+            ])
+
+        def get_next(self):
+            return next(self.batches, None)
+
+    quantize_static(source, path, TestSetReader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+
+def _open(backend, path, device, channels_last: bool = False):
+    import torch
+
+    if backend == "torchscript":
+        model = torch.jit.optimize_for_inference(torch.jit.load(path, map_location=device))
+        return LamaRunner(ChannelsLastModule(model) if channels_last else model, device, backend)
+
+    return LamaRunner(OnnxLamaModule(_onnx_session(path)), torch.device("cpu"), backend)
+
+
+def _onnx_session(path):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = ORT_INTRA_OP_THREADS or cpu_threads()
+    if ORT_INTER_OP_THREADS > 0:
+        options.inter_op_num_threads = ORT_INTER_OP_THREADS
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+def reopen_onnx(runner: LamaRunner, path: str):
+    """
+    Give an ONNX runner a new session with this process's thread settings (a forked
+    process cannot use the parent's thread pool). Swapped in place, so the batcher keeps working.
+    """
+    runner.model.session = _onnx_session(path)
+
+
+def _convert(backend, path, device, quantize) -> dict:
+    """Build the artifact from the eager model and check it against the eager output"""
+    from simple_lama_inpainting import SimpleLama
+
+    eager = SimpleLama(device=device)
+    started = time.perf_counter()
+    if backend == "torchscript":
+        _freeze(eager, path + ".tmp")
+    elif quantize == "off":
+        _export_onnx(eager, path + ".tmp")
+    else:
+        _export_onnx(eager, path + ".fp32")
+        try:
+            _quantize(path + ".fp32", path + ".tmp", quantize)
+        finally:
+            os.remove(path + ".fp32")
+    os.replace(path + ".tmp", path)
+    convert_seconds = time.perf_counter() - started
+
+    candidate = _open(backend, path, device)
+    image, mask = parity_inputs()
+    record = compare_outputs(np.asarray(eager(image, mask)), np.asarray(candidate(image, mask)))
+    record.update(accuracy(eager, candidate))
+    record.update({"backend": backend, "quantize": quantize, "convert_seconds": round(convert_seconds, 2)})
+    return record
+
+
+def load_lama(device, backend: str = LAMA_BACKEND, quantize: str = LAMA_QUANTIZE, channels_last: bool = LAMA_CHANNELS_LAST):
+    """
+    Return a SimpleLama-compatible model for `backend`, converting and caching it on first
+    use. Returns (model, info) where info records the configuration actually used and the
+    parity/accuracy results.
+    """
+    if backend not in BACKENDS:
+        print(f"Unknown LAMA_BACKEND '{backend}', using eager.")
+        backend = "eager"
+    if backend == "onnx" and device.type != "cpu":
+        print("The ONNX LaMa backend runs on CPU only, using eager on GPU.")
+        backend = "eager"
+    if quantize not in QUANTIZE_MODES:
+        print(f"Unknown LAMA_QUANTIZE '{quantize}', not quantizing.")
+        quantize = "off"
+    if quantize != "off" and backend != "onnx":
+        # The shipped model is TorchScript, which torch's quantization workflows cannot rewrite
+        print("LAMA_QUANTIZE needs LAMA_BACKEND=onnx, not quantizing.")
+        quantize = "off"
+    channels_last = channels_last and backend != "onnx"
+    if backend == "eager":
+        return _eager(device, channels_last), {"backend": "eager", "channels_last": channels_last}
+
+    try:
+        source = weights_path()
+        os.makedirs(LAMA_ARTIFACT_DIR, exist_ok=True)
+        suffix = ".onnx" if backend == "onnx" else ".pt"
+        path = os.path.join(LAMA_ARTIFACT_DIR, f"big-lama-{artifact_key(source, backend, quantize)}{suffix}")
+
+        record = None
+        if os.path.exists(path) and os.path.exists(path + ".json"):
+            with open(path + ".json") as f:
+                record = json.load(f)
+        if record is None:
+            print(f"Converting LaMa to {backend} (one-time, cached in {LAMA_ARTIFACT_DIR})...")
+            record = _convert(backend, path, device, quantize)
+            with open(path + ".json", "w") as f:
+                json.dump(record, f)
+            print(f"LaMa {backend} parity: max abs diff {record['max_abs_diff']}, min PSNR {record['min_psnr_db']} dB")
+
+        if quantize != "off" and record["min_psnr_db"] < LAMA_MIN_PSNR:
+            raise RuntimeError(f"int8 PSNR {record['min_psnr_db']} dB is below LAMA_MIN_PSNR ({LAMA_MIN_PSNR} dB)")
+        if quantize == "off" and record["max_abs_diff"] > LAMA_PARITY_TOLERANCE:
+            raise RuntimeError(f"output differs from eager by {record['max_abs_diff']}")
+        return _open(backend, path, device, channels_last), dict(record, artifact=path, channels_last=channels_last)
+    except Exception as e:
+        print(f"LaMa {backend} backend unavailable ({e}). Falling back to eager.")
+        return _eager(device, channels_last), {"backend": "eager", "channels_last": channels_last, "error": f"{backend}: {e}"}
+
+
+def _eager(device, channels_last):
+    from simple_lama_inpainting import SimpleLama
+
+    lama = SimpleLama(device=device)
+    if channels_last:
+        lama.model = ChannelsLastModule(lama.model)
+    return lama
@@ -1,16 +1,48 @@
-from fastapi import FastAPI, UploadFile, File, Query, BackgroundTasks, HTTPException
+from fastapi import FastAPI, UploadFile, File, Query, HTTPException, Request, Depends
+import os
+import json
+import asyncio
+from contextlib import asynccontextmanager, suppress
 import uuid
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-from io import BytesIO
-from PIL import Image
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse, Response, PlainTextResponse
+from PIL import Image, UnidentifiedImageError
 from model import inpainting_model
 from typing import Optional, List
 import numpy as np
-import cv2
-import zipfile
+import shutil
+import tempfile
+import roi
+import batch
+from executors import inference_pool, codec_pool, run_inference, run_codec
+from store import JobStore, SharedJobStore, create_blob_store, TERMINAL_STATES
+import shared_state
+from cache import inference_cache, inference_key
+import segmentation
+import masks
+import outpainting
+import encoding
+import ingest
+import delta
+from sessions import image_sessions, SessionImage
+import metrics
+from metrics import StageTimer
+from scheduler import JobScheduler, QueueFullError, JobCancelled, JOB_QUEUE_SIZE, MODEL_CONCURRENCY, parse_model_limits
 
-app = FastAPI()
+# background: answer requests immediately, detect the device and load/warm models on a thread
+# blocking: load MODEL_PRELOAD before accepting requests (warm-up still runs in the background)
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "background").lower()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # See MODEL_PRELOAD / MODEL_WARMUP
+    if STARTUP_MODE == "blocking":
+        await asyncio.to_thread(inpainting_model.start, False)
+    else:
+        inpainting_model.start()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,281 +52,714 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+HTTP_REQUESTS = metrics.Counter("cleanup_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_REQUESTS.inc(method=request.method, route=route.path if route else "unmatched", status=response.status_code)
+    return response
+
 # Quality preset max dimensions
 QUALITY_PRESETS = {
     "fast": 512,
     "balanced": 1024,
-    "high": 99999,  # Original resolution (no resize)
+    "high": 99999,  # Original resolution (no resize), LaMa runs tiled above TILE_SIZE
 }
 
-# Lazy load rembg to avoid slow startup
-_rembg_session = None
+# Two-pass (progressive) inpainting: longest side LaMa sees in the fast first pass
+PROGRESSIVE_PREVIEW_DIM = int(os.environ.get("PROGRESSIVE_PREVIEW_DIM", "256"))
 
-# In-memory job store
-# Structure: { job_id: { "status": "processing" | "completed" | "failed", "result": bytes | None, "error": str | None } }
-JOBS = {}
+# Job records plus size/TTL-bounded result storage (RESULT_STORE=memory|disk), held by the
+# shared state process when several server processes serve the API (see shared_state.py)
+if shared_state.enabled():
+    jobs = SharedJobStore(shared_state.remote("jobs"), shared_state.JOB_POLL_SECONDS)
+else:
+    jobs = JobStore(create_blob_store())
 
-def process_inpaint_job(job_id: str, image_pil: Image.Image, mask_pil: Image.Image, max_dim: int, original_size: tuple, model_id: str = "lama", prompt: str = None):
-    try:
-        # Resize if image exceeds max dimension (only for LaMa, SDXL handles its own resolution usually, but good to cap for upload speed)
-        # SDXL works best at 1024x1024.
-        w, h = image_pil.size
-        if max(w, h) > max_dim:
+# Inference workers: a couple so decode/encode overlaps inference (INFERENCE_WORKERS=1 for a
+# single GPU). Read from the environment only: the device is not known yet at import and
+# probing it on the first request would stall the event loop.
+INFERENCE_WORKERS = max(1, int(os.environ.get("INFERENCE_WORKERS", "2")))
+job_scheduler = JobScheduler(
+    workers=INFERENCE_WORKERS,
+    max_queue=JOB_QUEUE_SIZE,
+    model_limits=parse_model_limits(MODEL_CONCURRENCY),
+    shared=shared_state.enabled(),
+)
+
+def _follow_remote_cancel(job_id: str):
+    """
+    With several server processes a cancel can reach one that is not running the job. It
+    then only flags the shared record; this passes the flag on to our scheduler.
+    """
+    if not shared_state.enabled():
+        return
+
+    def watch(job):
+        if job["status"] in TERMINAL_STATES:
+            jobs.unsubscribe(job_id, watch)
+        elif job.get("cancel_requested") and job_scheduler.cancel(job_id) == "dequeued":
+            jobs.cancel(job_id)
+
+    jobs.subscribe(job_id, watch)
+    job = jobs.get(job_id)
+    if job is None or job["status"] in TERMINAL_STATES:
+        jobs.unsubscribe(job_id, watch)
+
+def _complete_job(job_id: str, result_pil: Image.Image, actual_model: str, start_time: float, timer: StageTimer, profile: bool,
+                  output: encoding.OutputFormat, preview: bool = False, delta_source: Image.Image = None,
+                  session_id: str = None, session_image: SessionImage = None) -> tuple:
+    """Encode a job's result, chain it onto its image session and store it. Returns (data, media_type, metadata)."""
+    import time
+    # A small JPEG first for clients that asked for a preview, then the full result
+    if preview:
+        with timer.stage("preview"):
+            jobs.put_preview(job_id, encoding.encode_preview(result_pil))
+    with timer.stage("encode"):
+        if delta_source is not None:
+            # Only the changed rectangles; the client pastes them onto its copy
+            data, media_type = delta.encode_delta(delta_source, result_pil, output), delta.MEDIA_TYPE
+        else:
+            data, media_type = encoding.encode(result_pil, output)
+
+    elapsed = time.time() - start_time
+    timer.finish()
+
+    metadata = {
+        "model_used": actual_model,
+        "execution_time": f"{elapsed:.2f}s"
+    }
+    if session_id:
+        # Chain: the result becomes the session's next version
+        advanced = image_sessions.advance(session_id, result_pil, session_image.version)
+        metadata["image_version"] = advanced.version if advanced else None
+    if profile:
+        metadata["timings"] = timer.breakdown()
+    jobs.complete(job_id, data, media_type=media_type, metadata=metadata)
+    return data, media_type, metadata
+
+def _run_inpaint(job_id: str, image_pil: Image.Image, mask_pil: Image.Image, max_dim: int, original_size: tuple, model_id: str,
+                 prompt: str, timer: StageTimer, session_image: SessionImage = None, stage: str = "inference") -> tuple:
+    """
+    One inpainting pass, checking for cancellation between regions, tiles and SDXL steps.
+    Returns (result, actual model); the result is only resized back when `original_size` is given.
+    """
+    def progress(step, total):
+        job_scheduler.check_cancelled(job_id)
+        jobs.update(job_id, progress={"step": step, "total": total})
+
+    if model_id == "lama" and roi.ROI_ENABLED:
+        def fill(crop, crop_mask):
+            job_scheduler.check_cancelled(job_id)
+            # Large crops run tiled; stop between their tiles too
+            return inpainting_model.process(crop, crop_mask, model_id="lama",
+                                            progress_callback=lambda step, total: job_scheduler.check_cancelled(job_id))[0]
+
+        # Inpaint only the masked regions at native resolution; unmasked pixels stay untouched
+        with timer.stage(stage):
+            result_pil = roi.inpaint_regions(image_pil, mask_pil, fill, max_dim=max_dim)
+        if result_pil is not None:
+            return result_pil, "lama"
+
+    # Resize if image exceeds max dimension (only for LaMa, SDXL handles its own resolution usually, but good to cap for upload speed)
+    # SDXL works best at 1024x1024.
+    w, h = image_pil.size
+    if max(w, h) > max_dim:
+        with timer.stage("downscale"):
             scale = max_dim / max(w, h)
             new_w = int(w * scale)
             new_h = int(h * scale)
-            image_pil = image_pil.resize((new_w, new_h), Image.LANCZOS)
+            resize = lambda image=image_pil: ingest.downscale(image, (new_w, new_h))
+            # Session images keep their downscaled copy for the next edit at this preset
+            image_pil = session_image.derive(("resize", new_w, new_h), resize) if session_image else resize()
             mask_pil = mask_pil.resize((new_w, new_h), Image.NEAREST)
 
+    # Process - ModelManager now returns (image, actual_model_id)
+    with timer.stage(stage):
+        result_pil, actual_model = inpainting_model.process(image_pil, mask_pil, model_id=model_id, prompt=prompt, progress_callback=progress)
+
+    # Resize back to original size if we downscaled
+    if original_size and result_pil.size != original_size:
+        with timer.stage("upscale"):
+            result_pil = result_pil.resize(original_size, Image.LANCZOS)
+    return result_pil, actual_model
+
+def _preview_pass_helps(image_pil: Image.Image, mask_pil: Image.Image, model_id: str) -> bool:
+    """
+    Whether a PROGRESSIVE_PREVIEW_DIM LaMa pass is actually cheaper than the full one: the
+    full pass runs another model, or some crop (or the whole frame) gets downscaled.
+    Otherwise the preview would be the final result, computed twice.
+    """
+    if inpainting_model.resolve_model(model_id) != "lama":
+        return True
+    # Same choice as _run_inpaint: masked regions at native resolution, else the whole frame
+    boxes = roi.plan_regions(np.asarray(mask_pil), image_pil.size) if model_id == "lama" and roi.ROI_ENABLED else None
+    if boxes is None:
+        return max(image_pil.size) > PROGRESSIVE_PREVIEW_DIM
+    return any(max(x1 - x0, y1 - y0) > PROGRESSIVE_PREVIEW_DIM for x0, y0, x1, y1 in boxes)
+
+def process_inpaint_job(job_id: str, image_pil: Image.Image, mask_pil: Image.Image, max_dim: int, original_size: tuple, model_id: str = "lama", prompt: str = None, cache_key: str = None, timer: StageTimer = None, profile: bool = False,
+                        output: encoding.OutputFormat = encoding.PNG, preview: bool = False, as_delta: bool = False,
+                        session_id: str = None, session_image: SessionImage = None, progressive: bool = False):
+    try:
         import time
+        timer = timer or StageTimer("inpaint")
+        timer.add_since("queue_wait", "queued")
+        jobs.update(job_id, status="processing")
         start_time = time.time()
-        
-        # Process - ModelManager now returns (image, actual_model_id)
-        result_pil, actual_model = inpainting_model.process(image_pil, mask_pil, model_id=model_id, prompt=prompt)
 
-        # Resize back to original size if we downscaled
-        if result_pil.size != original_size:
-            result_pil = result_pil.resize(original_size, Image.LANCZOS)
+        if progressive and max_dim > PROGRESSIVE_PREVIEW_DIM and _preview_pass_helps(image_pil, mask_pil, model_id):
+            # Fast LaMa pass on a small downscale, published as the preview, then the full pass
+            jobs.update(job_id, stage="preview")
+            draft_pil, _ = _run_inpaint(job_id, image_pil, mask_pil, PROGRESSIVE_PREVIEW_DIM, None, "lama", None, timer,
+                                        session_image, stage="preview_inference")
+            with timer.stage("preview"):
+                jobs.put_preview(job_id, encoding.encode_preview(draft_pil))
+            del draft_pil
+            jobs.update(job_id, stage="refine")
 
-        # Save result to memory
-        output = BytesIO()
-        result_pil.save(output, format="PNG")
-        output.seek(0)
-        
-        elapsed = time.time() - start_time
-        
-        JOBS[job_id] = {
-            "status": "completed",
-            "result": output.read(),
-            "error": None,
-            "metadata": {
-                "model_used": actual_model,
-                "execution_time": f"{elapsed:.2f}s"
-            }
-        }
+        result_pil, actual_model = _run_inpaint(job_id, image_pil, mask_pil, max_dim, original_size, model_id, prompt, timer, session_image)
+        job_scheduler.check_cancelled(job_id)
+
+        data, media_type, metadata = _complete_job(job_id, result_pil, actual_model, start_time, timer, profile, output, preview,
+                                                   image_pil if as_delta else None, session_id, session_image)
+        if cache_key:
+            inference_cache.put(cache_key, data, {"media_type": media_type, "metadata": metadata})
+    except JobCancelled:
+        print(f"Job {job_id} cancelled")
+        jobs.cancel(job_id)
     except Exception as e:
         print(f"Job {job_id} failed: {e}")
-        JOBS[job_id] = {
-            "status": "failed",
-            "result": None,
-            "error": str(e),
-            "metadata": {}
-        }
-
-def get_rembg_session():
-    global _rembg_session
-    if _rembg_session is None:
-        from rembg import new_session
-        _rembg_session = new_session("isnet-general-use")
-    return _rembg_session
+        jobs.fail(job_id, str(e))
+    finally:
+        if cache_key:
+            inference_cache.release(cache_key)
+
+def output_format(
+    request: Request,
+    format: Optional[str] = Query(None, description="Result format: png, webp or jpeg (default: the Accept header, else png)"),
+    lossless: bool = Query(True, description="Lossless WebP; false for lossy WebP"),
+    compression: Optional[int] = Query(None, ge=0, le=9, description="PNG compression level (default PNG_COMPRESS_LEVEL)"),
+    image_quality: Optional[int] = Query(None, ge=1, le=100, description="JPEG / lossy WebP quality (default LOSSY_QUALITY)"),
+) -> encoding.OutputFormat:
+    """Output format from the query parameters or the Accept header"""
+    try:
+        return encoding.negotiate(format, request.headers.get("accept"), lossless=lossless, compression=compression, quality=image_quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def _image_response(image: Image.Image, output: encoding.OutputFormat = encoding.PNG, timer: StageTimer = None, profile: bool = False) -> Response:
+    """
+    Encode off the event loop and return the bytes without another copy. With a timer
+    the encode is timed and the request finished; `profile` adds a Server-Timing header.
+    """
+    if timer is None:
+        data, media_type = await run_codec(encoding.encode, image, output)
+        return Response(content=data, media_type=media_type)
+    with timer.stage("encode"):
+        data, media_type = await run_codec(encoding.encode, image, output)
+    timer.finish()
+    return Response(content=data, media_type=media_type, headers={"Server-Timing": timer.server_timing()} if profile else None)
+
+async def _slot_model(model: str) -> str:
+    """
+    The model whose concurrency slot a job holds: the one that will actually run, so an
+    SDXL request falling back to LaMa does not wait behind SDXL capacity. Resolved off
+    the event loop, since the first SDXL request probes the device.
+    """
+    return await asyncio.to_thread(inpainting_model.resolve_model, model)
+
+def _known_device():
+    """The device if it has been detected yet, else None (never blocks on the GPU probe)"""
+    return inpainting_model.device if inpainting_model.device_known else None
 
 @app.get("/")
-def read_root():
-    return {"status": "ok", "device": inpainting_model.device}
+async def read_root():
+    device = _known_device()
+    return {"status": "ok" if device else "warming", "device": device}
 
 @app.get("/device")
-def get_device():
+async def get_device():
     """Return current device info for frontend display"""
+    device = _known_device()
+    if device is None:
+        return JSONResponse({"device": None, "device_name": "Warming up..."})
     return JSONResponse({
-        "device": inpainting_model.device,
-        "device_name": "GPU (CUDA)" if "cuda" in inpainting_model.device else "CPU",
+        "device": device,
+        "device_name": "GPU (CUDA)" if "cuda" in device else "CPU",
     })
 
+@app.get("/health")
+async def health():
+    """Readiness of the preloaded/warmed-up models. Answers 503 until they are ready."""
+    ready = inpainting_model.is_ready()
+    return JSONResponse(
+        {"status": "ok" if ready else "warming", "ready": ready, "device": _known_device(), "models": inpainting_model.readiness()},
+        status_code=200 if ready else 503,
+    )
+
 @app.get("/models")
 def get_models():
     """Return list of available models based on hardware capabilities"""
     return inpainting_model.get_available_models()
 
+@app.get("/stats")
+def get_stats():
+    """Scheduler and batching counters"""
+    return {
+        "scheduler": job_scheduler.stats(),
+        "jobs": jobs.stats(),
+        "inference_cache": inference_cache.stats(),
+        "segmentation_cache": segmentation.mask_cache.stats(),
+        "segmentation": segmentation.stats(),
+        "image_sessions": image_sessions.stats(),
+        "executors": {"inference": inference_pool.stats(), "codec": codec_pool.stats()},
+        "lama_batching": inpainting_model.lama_batcher.stats() if inpainting_model.lama_batcher else None,
+        "lama_backend": inpainting_model.lama_backend,
+    }
+
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus metrics: stage/request latency histograms, queue depth, caches, model memory"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Scrape-time views of state owned by the scheduler, stores, caches and models
+metrics.Callback("cleanup_queue_depth", "Jobs waiting for an inference worker", lambda: job_scheduler.stats()["queued"])
+metrics.Callback("cleanup_jobs_in_flight", "Jobs currently running, by model", lambda: [((model,), count) for model, count in job_scheduler.stats()["running"].items()], ("model",))
+metrics.Callback("cleanup_executor_pending", "Calls waiting for an executor thread", lambda: [((name,), pool.stats()["pending"]) for name, pool in (("inference", inference_pool), ("codec", codec_pool))], ("pool",))
+metrics.Callback("cleanup_executor_running", "Calls running on an executor thread", lambda: [((name,), pool.stats()["running"]) for name, pool in (("inference", inference_pool), ("codec", codec_pool))], ("pool",))
+metrics.Callback("cleanup_executor_wait_seconds_max", "Longest wait for an executor thread", lambda: [((name,), pool.stats()["max_wait_ms"] / 1000.0) for name, pool in (("inference", inference_pool), ("codec", codec_pool))], ("pool",))
+metrics.Callback("cleanup_jobs_stored", "Job records held in memory", lambda: jobs.stats()["jobs"])
+metrics.Callback("cleanup_results_bytes", "Bytes of stored job results", lambda: jobs.stats()["results"]["bytes"])
+metrics.Callback("cleanup_inference_cache_hits_total", "Inference cache hits", lambda: inference_cache.stats()["hits"], type="counter")
+metrics.Callback("cleanup_inference_cache_misses_total", "Inference cache misses", lambda: inference_cache.stats()["misses"], type="counter")
+metrics.Callback("cleanup_inference_cache_deduplicated_total", "Requests that joined an identical in-flight job", lambda: inference_cache.stats()["deduplicated"], type="counter")
+metrics.Callback("cleanup_inference_cache_hit_ratio", "Inference cache hit ratio", lambda: inference_cache.stats()["hit_rate"])
+metrics.Callback("cleanup_segmentation_cache_entries", "Cached rembg masks", lambda: segmentation.mask_cache.stats()["entries"])
+metrics.Callback("cleanup_segmentation_cache_bytes", "Bytes of cached rembg masks", lambda: segmentation.mask_cache.stats()["bytes"])
+metrics.Callback("cleanup_image_sessions", "Open image sessions", lambda: image_sessions.stats()["sessions"])
+metrics.Callback("cleanup_image_sessions_bytes", "Decoded bytes held by image sessions", lambda: image_sessions.stats()["bytes"])
+metrics.Callback("cleanup_model_memory_megabytes", "Measured (or estimated) memory of loaded models", lambda: [((model,), inpainting_model.memory_mb.get(model)) for model in list(inpainting_model.models)], ("model",))
+metrics.Callback("cleanup_model_status", "Model lifecycle status (1 for the current status)", lambda: [((model, status), 1) for model, status in inpainting_model.status.items()], ("model", "status"))
+metrics.Callback("cleanup_lama_batches_total", "Batched LaMa forward passes", lambda: inpainting_model.lama_batcher.stats()["batches"] if inpainting_model.lama_batcher else 0, type="counter")
+
+async def _load_image(upload: Optional[UploadFile], image_id: Optional[str], mode: str, timer: StageTimer) -> tuple:
+    """
+    The request's image as (PIL image, SessionImage or None): taken from the session
+    named by `image_id` without any upload or decode, else read and decoded from `upload`.
+    """
+    if image_id:
+        current = image_sessions.get(image_id)
+        if current is None:
+            raise HTTPException(status_code=404, detail="Image session not found or expired")
+        return await run_codec(current.convert, mode), current
+    image_pil, _ = await _read_upload(upload, mode, timer)
+    return image_pil, None
+
+async def _read_upload(upload: Optional[UploadFile], mode: str, timer: StageTimer, max_dim: int = None) -> tuple:
+    """
+    Decode an upload straight from its spooled file, at reduced size when `max_dim` says
+    it will be downscaled anyway. Returns (PIL image, original size).
+    """
+    if upload is None:
+        raise HTTPException(status_code=422, detail="Upload an image or pass image_id")
+    with timer.stage("decode"):
+        return await run_codec(ingest.open_image, upload.file, mode, max_dim)
+
+def _prepare_mask(mask_file, size: tuple, timer: StageTimer, **options) -> Image.Image:
+    with timer.stage("decode"):
+        mask_np = ingest.decode_mask(mask_file)  # Mask should be grayscale
+
+    # Resize to the image, binarize and apply any morphology in one pass. A mask drawn at the
+    # image's size is binarized as the model would (anti-aliased brush edges stay masked);
+    # a resized one at mid-gray, since resampling blurred its edges.
+    threshold = masks.MODEL_THRESHOLD if mask_np.shape[1::-1] == tuple(size) else masks.RESIZE_THRESHOLD
+    with timer.stage("mask"):
+        return masks.to_image(masks.prepare(mask_np, size, threshold=threshold, **options))
+
+def _complete_from_cache(job_id: str, cache_key: str, prompt: str, timer: StageTimer, profile: bool) -> bool:
+    """
+    Complete `job_id` with the cached result for `cache_key`; False on a miss. Runs on the
+    codec pool: with disk-backed stores this reads and writes files.
+    """
+    cached = inference_cache.get(cache_key)
+    if cached is None:
+        return False
+    data, meta = cached
+    jobs.create(job_id, status="processing", metadata={"prompt": prompt})
+    timer.finish()
+    metadata = dict(meta.get("metadata", {}), execution_time="0.00s", cache="hit")
+    metadata.pop("timings", None)
+    if profile:
+        metadata["timings"] = timer.breakdown()
+    jobs.complete(job_id, data, media_type=meta.get("media_type", "image/png"), metadata=metadata)
+    return True
+
 @app.post("/inpaint")
 async def inpaint(
-    background_tasks: BackgroundTasks,
-    image: UploadFile = File(...),
+    image: Optional[UploadFile] = File(None),
     mask: UploadFile = File(...),
+    image_id: Optional[str] = Query(None, description="Image session to edit instead of uploading an image"),
+    chain: bool = Query(True, description="With image_id: the result becomes the session's next version"),
     quality: Optional[str] = Query("balanced", description="Quality preset: fast, balanced, high"),
     model: str = Query("lama", description="Model ID: lama, sdxl"),
-    prompt: Optional[str] = Query(None, description="Optional text prompt for SDXL")
+    prompt: Optional[str] = Query(None, description="Optional text prompt for SDXL"),
+    priority: int = Query(0, ge=0, le=9, description="Scheduling priority, higher runs first"),
+    profile: bool = Query(False, description="Include a per-stage timing breakdown in the job status"),
+    preview: bool = Query(False, description="Publish a small JPEG preview before the full result is encoded"),
+    delta: bool = Query(False, description="Result is a JSON list of changed patches and their offsets instead of the full image"),
+    progressive: bool = Query(False, description="Publish a fast low-resolution pass as the preview, then refine at full quality"),
+    mask_dilate: int = Query(0, ge=0, le=64, description="Grow the mask by this many pixels"),
+    mask_fill_holes: bool = Query(False, description="Fill areas enclosed by the mask"),
+    mask_min_area: int = Query(0, ge=0, description="Ignore mask specks smaller than this many pixels"),
+    output: encoding.OutputFormat = Depends(output_format),
 ):
-    # Read image
-    image_data = await image.read()
-    image_pil = Image.open(BytesIO(image_data)).convert("RGB")
-    original_size = image_pil.size
-
-    # Read mask
-    mask_data = await mask.read()
-    mask_pil = Image.open(BytesIO(mask_data)).convert("L")  # Mask should be grayscale
-
-    # Resize mask to match image size (if they differ)
-    if mask_pil.size != image_pil.size:
-        # Use Bilinear to output smooth edges, then threshold to binary
-        # This prevents blocky 'staircase' edges when upscaling
-        mask_pil = mask_pil.resize(image_pil.size, Image.BILINEAR)
-        mask_np = np.array(mask_pil)
-        mask_np = (mask_np > 127).astype(np.uint8) * 255
-        mask_pil = Image.fromarray(mask_np)
-
+    timer = StageTimer("inpaint")
     # Apply quality preset - resize if image exceeds max dimension
     max_dim = QUALITY_PRESETS.get(quality, QUALITY_PRESETS["balanced"])
-    w, h = image_pil.size
-    
-    
-    # Store job
+
+    # Decode and align the mask off the event loop. The full-frame path downscales to
+    # max_dim anyway, so decode near that size; ROI inpainting works at native resolution
+    # and a delta needs the full-size source.
+    if image_id is None and not delta and not (model == "lama" and roi.ROI_ENABLED):
+        image_pil, original_size = await _read_upload(image, "RGB", timer, max_dim)
+        current = None
+    else:
+        image_pil, current = await _load_image(image, image_id, "RGB", timer)
+        original_size = image_pil.size
+    mask_pil = await run_codec(_prepare_mask, mask.file, image_pil.size, timer,
+                               dilate_px=mask_dilate, fill=mask_fill_holes, min_area=mask_min_area)
+    session_id = image_id if current is not None and chain else None
+
     job_id = str(uuid.uuid4())
-    JOBS[job_id] = {"status": "processing", "result": None, "error": None, "metadata": {"prompt": prompt}}
-    
-    # Run in background
-    background_tasks.add_task(process_inpaint_job, job_id, image_pil, mask_pil, max_dim, original_size, model, prompt)
 
-    return {"job_id": job_id, "status": "processing"}
+    # Identical image + mask + settings: serve the cached result or join the job already computing it.
+    # Chained session edits must run so the session gets the result image.
+    cache_key = await run_codec(inference_key, image_pil, mask_pil, model, prompt, quality, image_hash=current.hash if current else None,
+                                output=f"delta:{output.key}" if delta else output.key) if inference_cache.enabled and not session_id else None
+    if cache_key:
+        if await run_codec(_complete_from_cache, job_id, cache_key, prompt, timer, profile):
+            return {"job_id": job_id, "status": "completed", "queue_position": None}
 
-@app.get("/jobs/{job_id}")
-def get_job_status(job_id: str):
-    if job_id not in JOBS:
-        raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = JOBS[job_id]
+        existing = inference_cache.claim(cache_key, job_id)
+        if existing is not None:
+            # Join the identical job unless it is already finished or being cancelled
+            if jobs.attach(existing):
+                job = jobs.get(existing) or {"status": "queued"}
+                return {"job_id": existing, "status": job["status"], "queue_position": job_scheduler.position(existing)}
+            cache_key = None
+
+    # Store job
+    jobs.create(job_id, status="queued", metadata={"prompt": prompt, **({"image_id": session_id} if session_id else {})})
+
+    # Hand off to the bounded worker pool
+    try:
+        timer.mark("queued")
+        job_scheduler.submit(job_id, process_inpaint_job, job_id, image_pil, mask_pil, max_dim, original_size, model, prompt, cache_key, timer, profile,
+                             output, preview, delta, session_id, current, progressive, model_id=await _slot_model(model), priority=priority,
+                             on_cancel=(lambda: inference_cache.release(cache_key)) if cache_key else None)
+    except QueueFullError as e:
+        jobs.delete(job_id)
+        if cache_key:
+            inference_cache.release(cache_key)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+
+    await run_codec(_follow_remote_cancel, job_id)
+    return {"job_id": job_id, "status": "queued", "queue_position": job_scheduler.position(job_id)}
+
+def _job_payload(job_id: str, job: dict) -> dict:
+    metadata = job.get("metadata", {})
     return {
         "job_id": job_id, 
         "status": job["status"], 
         "error": job["error"],
-        "model_used": job.get("metadata", {}).get("model_used"),
-        "execution_time": job.get("metadata", {}).get("execution_time"),
-        "prompt": job.get("metadata", {}).get("prompt")
+        "model_used": metadata.get("model_used"),
+        "execution_time": metadata.get("execution_time"),
+        "prompt": metadata.get("prompt"),
+        "queue_position": job_scheduler.position(job_id) if job["status"] == "queued" else None,
+        "progress": job.get("progress"),
+        "stage": job.get("stage"),
+        "result_url": f"/results/{job_id}" if job["status"] == "completed" else None,
+        "preview_url": f"/results/{job_id}/preview" if job.get("preview") else None,
+        **({"image_id": metadata["image_id"], "image_version": metadata.get("image_version")} if "image_id" in metadata else {}),
+        **({"timings": metadata["timings"]} if "timings" in metadata else {}),
     }
 
+def _subscribe_job(job_id: str) -> tuple:
+    """Forward job changes from worker threads into an asyncio queue"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    callback = lambda job: loop.call_soon_threadsafe(queue.put_nowait, job)
+    jobs.subscribe(job_id, callback)
+    return queue, callback
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=60, description="Long-poll: wait up to this many seconds for the job to finish")
+):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    if wait > 0 and job["status"] not in TERMINAL_STATES:
+        queue, callback = _subscribe_job(job_id)
+        try:
+            # Re-read after subscribing so a transition in between is not missed
+            job = jobs.get(job_id) or job
+            deadline = asyncio.get_running_loop().time() + wait
+            while job["status"] not in TERMINAL_STATES:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    job = await asyncio.wait_for(queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            jobs.unsubscribe(job_id, callback)
+
+    return _job_payload(job_id, job)
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    """
+    Cancel a job. A queued job is dropped at once; a running one stops at its next
+    checkpoint (between regions, tiles, SDXL steps and passes), freeing its worker, and
+    becomes "cancelled". A two-pass job keeps the preview it already published.
+    A job shared by identical requests keeps running until every requester has cancelled.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] in TERMINAL_STATES or jobs.detach(job_id) > 0:
+        return _job_payload(job_id, job)
+    outcome = job_scheduler.cancel(job_id)
+    if outcome == "dequeued":
+        jobs.cancel(job_id)
+    elif outcome is None and shared_state.enabled():
+        # Queued or running in another server process, which follows the flag
+        jobs.update(job_id, cancel_requested=True)
+    job = jobs.get(job_id) or job
+    return _job_payload(job_id, job)
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    Server-Sent Events stream of job state transitions and SDXL step progress.
+    The last event carries the final status and, on success, the result URL.
+    """
+    if jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def stream():
+        queue, callback = _subscribe_job(job_id)
+        try:
+            job = jobs.get(job_id)
+            if job is None:
+                return
+            yield f"data: {json.dumps(_job_payload(job_id, job))}\n\n"
+            while job["status"] not in TERMINAL_STATES:
+                try:
+                    job = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # Comment line keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {json.dumps(_job_payload(job_id, job))}\n\n"
+        finally:
+            jobs.unsubscribe(job_id, callback)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.get("/results/{job_id}")
 def get_job_result(job_id: str):
-    if job_id not in JOBS:
+    job = jobs.get(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = JOBS[job_id]
+
+    if job["status"] == "expired":
+        raise HTTPException(status_code=410, detail="Result has expired")
     if job["status"] != "completed":
         raise HTTPException(status_code=400, detail="Job not completed")
-    
-    return StreamingResponse(BytesIO(job["result"]), media_type="image/png")
+
+    # Disk-backed results are streamed straight from the file
+    path = jobs.result_path(job_id)
+    if path:
+        return FileResponse(path, media_type=job["media_type"])
+
+    data = jobs.result_bytes(job_id)
+    if data is None:
+        raise HTTPException(status_code=410, detail="Result has expired")
+    return Response(content=data, media_type=job["media_type"])
+
+@app.get("/results/{job_id}/preview")
+def get_job_preview(job_id: str):
+    """The small preview published before the full result (jobs submitted with preview=true)"""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not job.get("preview"):
+        raise HTTPException(status_code=400, detail="No preview available")
+
+    data = jobs.preview_bytes(job_id)
+    if data is None:
+        raise HTTPException(status_code=410, detail="Preview has expired")
+    return Response(content=data, media_type=job["preview"])
+
+
+# ============ IMAGE SESSIONS ============
+
+@app.post("/images")
+async def create_image_session(image: UploadFile = File(...)):
+    """
+    Upload a photo once and get an image_id that /inpaint, /outpaint, /refine-edges and the
+    segmentation endpoints accept instead of an upload. The decoded image stays server-side.
+    """
+    timer = StageTimer("images")
+    image_pil, _ = await _load_image(image, None, "RGB", timer)
+    session_id, current = await run_codec(image_sessions.create, image_pil)
+    return {"image_id": session_id, **current.info()}
+
+@app.get("/images/{image_id}")
+def get_image_session(image_id: str):
+    current = image_sessions.get(image_id)
+    if current is None:
+        raise HTTPException(status_code=404, detail="Image session not found or expired")
+    return {"image_id": image_id, **current.info()}
+
+@app.get("/images/{image_id}/content")
+async def get_image_content(image_id: str, output: encoding.OutputFormat = Depends(output_format)):
+    """The session's current version (after any chained edits)"""
+    current = image_sessions.get(image_id)
+    if current is None:
+        raise HTTPException(status_code=404, detail="Image session not found or expired")
+    return await _image_response(current.image, output)
+
+@app.delete("/images/{image_id}")
+def delete_image_session(image_id: str):
+    if not image_sessions.delete(image_id):
+        raise HTTPException(status_code=404, detail="Image session not found or expired")
+    return {"image_id": image_id, "deleted": True}
 
 
 # ============ PHASE 5: AI FEATURES ============
 
 @app.post("/detect-objects")
-async def detect_objects(image: UploadFile = File(...)):
+async def detect_objects(
+    image: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Query(None, description="Image session to use instead of uploading an image"),
+    profile: bool = Query(False, description="Return a per-stage timing breakdown in a Server-Timing header"),
+    output: encoding.OutputFormat = Depends(output_format),
+):
     """
     5.1 AI Object Detection - Uses rembg to detect foreground objects
     Returns a mask where detected objects are white
     """
-    from rembg import remove
+    timer = StageTimer("detect-objects")
+    image_pil, current = await _load_image(image, image_id, "RGB", timer)
     
-    image_data = await image.read()
-    image_pil = Image.open(BytesIO(image_data)).convert("RGB")
+    # Foreground mask from the shared segmentation cache
+    with timer.stage("segmentation"):
+        mask = await run_inference(segmentation.get_mask, image_pil, current.hash if current else None)
     
-    # Get the session (lazy loaded)
-    session = get_rembg_session()
-    
-    # Remove background, keeping alpha channel as mask
-    result = remove(image_pil, session=session, only_mask=True)
+    return await _image_response(mask, output, timer, profile)
+
+
+def _locate_refine_region(image_pil: Image.Image, mask_file, pad: int = 50):
+    """Decode the mask and find the padded bounding box of the user's rough mask (None if empty)"""
+    w, h = image_pil.size
+    mask_np = masks.prepare(ingest.decode_mask(mask_file), (w, h))
+    mask_pil = masks.to_image(mask_np)
     
-    # Convert mask to grayscale
-    if result.mode == 'RGBA':
-        mask = result.split()[-1]  # Get alpha channel
-    else:
-        mask = result.convert('L')
+    # Find bounding box of the user's rough mask
+    rows = np.any(mask_np > 0, axis=1)
+    cols = np.any(mask_np > 0, axis=0)
     
-    output = BytesIO()
-    mask.save(output, format="PNG")
-    output.seek(0)
+    if not np.any(rows) or not np.any(cols):
+        return mask_pil, None
+        
+    y_min, y_max = np.where(rows)[0][[0, -1]]
+    x_min, x_max = np.where(cols)[0][[0, -1]]
     
-    return StreamingResponse(output, media_type="image/png")
+    # Add padding to context
+    box = (max(0, x_min - pad), max(0, y_min - pad), min(w, x_max + pad), min(h, y_max + pad))
+    return mask_pil, box
+
+
+def _refine_crop_mask(crop: Image.Image, crop_mask: Image.Image, threshold1: int, threshold2: int, dilation: int) -> Image.Image:
+    binary = masks.prepare(crop_mask)
+    binary = masks.snap_to_edges(binary, np.asarray(crop), threshold1, threshold2, dilation)
+    return masks.to_image(masks.fill_holes(binary))
 
 
 @app.post("/refine-edges")
 async def refine_edges(
-    image: UploadFile = File(...),
+    image: Optional[UploadFile] = File(None),
     mask: UploadFile = File(...),
+    image_id: Optional[str] = Query(None, description="Image session to use instead of uploading an image"),
     threshold1: int = Query(50, description="Canny edge detection threshold 1"),
     threshold2: int = Query(150, description="Canny edge detection threshold 2"),
-    dilation: int = Query(2, description="Edge dilation amount")
+    dilation: int = Query(2, description="Edge dilation amount"),
+    profile: bool = Query(False, description="Return a per-stage timing breakdown in a Server-Timing header"),
+    output: encoding.OutputFormat = Depends(output_format),
 ):
     """
     5.2 Smart Edge Detection - Refines mask by re-segmenting the area using AI
     """
-    from rembg import remove
-    
+    timer = StageTimer("refine-edges")
     # Read image and mask
-    image_data = await image.read()
-    image_pil = Image.open(BytesIO(image_data)).convert("RGB")
-    image_np = np.array(image_pil)
-    
-    mask_data = await mask.read()
-    mask_pil = Image.open(BytesIO(mask_data)).convert("L")
-    mask_np = np.array(mask_pil)
+    image_pil, _ = await _load_image(image, image_id, "RGB", timer)
+    with timer.stage("decode"):
+        mask_pil, box = await run_codec(_locate_refine_region, image_pil, mask.file)
     
-    # Resize mask if needed
-    if mask_np.shape[:2] != image_np.shape[:2]:
-        mask_np = cv2.resize(mask_np, (image_np.shape[1], image_np.shape[0]), interpolation=cv2.INTER_NEAREST)
-    
-    # Find bounding box of the user's rough mask
-    rows = np.any(mask_np > 0, axis=1)
-    cols = np.any(mask_np > 0, axis=0)
-    
-    if not np.any(rows) or not np.any(cols):
+    if box is None:
         # Empty mask, return original
-        output = BytesIO()
-        mask_pil.save(output, format="PNG")
-        output.seek(0)
-        return StreamingResponse(output, media_type="image/png")
-        
-    y_min, y_max = np.where(rows)[0][[0, -1]]
-    x_min, x_max = np.where(cols)[0][[0, -1]]
-    
-    # Add padding to context
-    pad = 50
-    h, w = image_np.shape[:2]
-    y_min = max(0, y_min - pad)
-    y_max = min(h, y_max + pad)
-    x_min = max(0, x_min - pad)
-    x_max = min(w, x_max + pad)
+        return await _image_response(mask_pil, output, timer, profile)
     
     # Crop the area
-    crop = image_pil.crop((x_min, y_min, x_max, y_max))
+    crop = image_pil.crop(box)
     
     # Run AI segmentation on the crop
     # This focuses the model on the specific object
-    session = get_rembg_session()
-    crop_mask = remove(crop, session=session, only_mask=True)
+    with timer.stage("segmentation"):
+        crop_mask = await run_inference(segmentation.get_mask, crop)
     
-    if crop_mask.mode == 'RGBA':
-        crop_mask = crop_mask.split()[-1]
-    else:
-        crop_mask = crop_mask.convert('L')
+    # Binarize, pull the outline onto nearby image edges and fill the interior
+    with timer.stage("mask"):
+        crop_mask = await run_codec(_refine_crop_mask, crop, crop_mask, threshold1, threshold2, dilation)
     
     # Paste back into full size mask
-    refined_mask = Image.new("L", (w, h), 0)
-    refined_mask.paste(crop_mask, (x_min, y_min))
+    refined_mask = Image.new("L", image_pil.size, 0)
+    refined_mask.paste(crop_mask, box[:2])
     
-    output = BytesIO()
-    refined_mask.save(output, format="PNG")
-    output.seek(0)
-    
-    return StreamingResponse(output, media_type="image/png")
+    return await _image_response(refined_mask, output, timer, profile)
 
 @app.post("/remove-background")
-async def remove_background(image: UploadFile = File(...)):
+async def remove_background(
+    image: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Query(None, description="Image session to use instead of uploading an image"),
+    profile: bool = Query(False, description="Return a per-stage timing breakdown in a Server-Timing header"),
+    output: encoding.OutputFormat = Depends(output_format),
+):
     """
     5.3 Background Replacement - Part 1: Remove background
     Returns image with transparent background
     """
-    from rembg import remove
     try:
-        image_data = await image.read()
-        image_pil = Image.open(BytesIO(image_data)).convert("RGBA")
-        
-        session = get_rembg_session()
-        result = remove(image_pil, session=session)
+        timer = StageTimer("remove-background")
+        image_pil, current = await _load_image(image, image_id, "RGBA", timer)
         
-        output = BytesIO()
-        result.save(output, format="PNG")
-        output.seek(0)
+        # Cutout derived from the cached mask
+        with timer.stage("segmentation"):
+            mask = await run_inference(segmentation.get_mask, image_pil, current.hash if current else None)
+        with timer.stage("composite"):
+            result = await run_codec(segmentation.cutout, image_pil, mask)
     
-        return StreamingResponse(output, media_type="image/png")
+        return await _image_response(result, output, timer, profile)
     
     except Exception as e:
         import traceback
@@ -305,69 +770,51 @@ async def remove_background(image: UploadFile = File(...)):
 
 @app.post("/replace-background")
 async def replace_background(
-    image: UploadFile = File(...),
+    image: Optional[UploadFile] = File(None),
     background: UploadFile = File(...),
+    image_id: Optional[str] = Query(None, description="Image session to use instead of uploading an image"),
+    profile: bool = Query(False, description="Return a per-stage timing breakdown in a Server-Timing header"),
+    output: encoding.OutputFormat = Depends(output_format),
 ):
     """
     5.3 Background Replacement - Part 2: Replace with new background
     """
-    from rembg import remove
+    timer = StageTimer("replace-background")
+    image_pil, current = await _load_image(image, image_id, "RGBA", timer)
+    # Decode the background image
+    bg_pil, _ = await _read_upload(background, "RGBA", timer)
     
-    # Read foreground image
-    image_data = await image.read()
-    image_pil = Image.open(BytesIO(image_data)).convert("RGBA")
+    # Composite the cached foreground cutout onto the new background
+    with timer.stage("segmentation"):
+        mask = await run_inference(segmentation.get_mask, image_pil, current.hash if current else None)
+    with timer.stage("composite"):
+        result = await run_codec(segmentation.replace_background, image_pil, bg_pil, mask)
     
-    # Read background image
-    bg_data = await background.read()
-    bg_pil = Image.open(BytesIO(bg_data)).convert("RGBA")
-    
-    # Remove background from foreground
-    session = get_rembg_session()
-    fg_removed = remove(image_pil, session=session)
-    
-    # Resize background to match foreground if needed
-    if bg_pil.size != fg_removed.size:
-        bg_pil = bg_pil.resize(fg_removed.size, Image.LANCZOS)
-    
-    # Composite foreground onto background
-    result = Image.alpha_composite(bg_pil, fg_removed)
-    
-    output = BytesIO()
-    result.save(output, format="PNG")
-    output.seek(0)
-    
-    return StreamingResponse(output, media_type="image/png")
+    return await _image_response(result, output, timer, profile)
 
 
 @app.post("/auto-mask")
 async def auto_mask(
-    image: UploadFile = File(...),
-    invert: bool = Query(False, description="Invert mask to select background instead")
+    image: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Query(None, description="Image session to use instead of uploading an image"),
+    invert: bool = Query(False, description="Invert mask to select background instead"),
+    profile: bool = Query(False, description="Return a per-stage timing breakdown in a Server-Timing header"),
+    output: encoding.OutputFormat = Depends(output_format),
 ):
     """
     Auto-generate mask for foreground objects (convenience endpoint)
     """
-    from rembg import remove
     try:
-        image_data = await image.read()
-        image_pil = Image.open(BytesIO(image_data)).convert("RGB")
-        
-        session = get_rembg_session()
-        mask = remove(image_pil, session=session, only_mask=True)
+        timer = StageTimer("auto-mask")
+        image_pil, current = await _load_image(image, image_id, "RGB", timer)
         
-        if mask.mode == 'RGBA':
-            mask = mask.split()[-1]
-        else:
-            mask = mask.convert('L')
+        with timer.stage("segmentation"):
+            mask = await run_inference(segmentation.get_mask, image_pil, current.hash if current else None)
         
         if invert:
-            mask = Image.eval(mask, lambda x: 255 - x)
-        
-        output = BytesIO()
-        mask.save(output, format="PNG")
-        output.seek(0)
+            mask = masks.to_image(masks.invert(mask))
     
-        return StreamingResponse(output, media_type="image/png")
+        return await _image_response(mask, output, timer, profile)
 
     except Exception as e:
         import traceback
@@ -376,140 +823,202 @@ async def auto_mask(
         raise HTTPException(status_code=500, detail=f"Auto-detection failed: {str(e)}")
 
 
+def process_outpaint_job(job_id: str, image_pil: Image.Image, extends: tuple, max_dim: int, model_id: str = "lama", prompt: str = None,
+                         timer: StageTimer = None, profile: bool = False, output: encoding.OutputFormat = encoding.PNG, preview: bool = False,
+                         session_id: str = None, session_image: SessionImage = None):
+    try:
+        import time
+        timer = timer or StageTimer("outpaint")
+        timer.add_since("queue_wait", "queued")
+        jobs.update(job_id, status="processing")
+        start_time = time.time()
+        models_used = set()
+
+        def fill(window, window_mask):
+            result, actual_model = inpainting_model.process(window, window_mask, model_id=model_id, prompt=prompt,
+                                                            progress_callback=lambda step, total: job_scheduler.check_cancelled(job_id))
+            models_used.add(actual_model)
+            return result
+
+        def progress(step, total):
+            job_scheduler.check_cancelled(job_id)
+            jobs.update(job_id, progress={"step": step, "total": total})
+
+        # Only the new border bands (plus some context) go through the model
+        with timer.stage("inference"):
+            result_pil = outpainting.extend(image_pil, *extends, fill, max_dim=max_dim, progress_callback=progress)
+
+        _complete_job(job_id, result_pil, ",".join(sorted(models_used)) or model_id, start_time, timer, profile, output, preview,
+                      session_id=session_id, session_image=session_image)
+    except JobCancelled:
+        print(f"Job {job_id} cancelled")
+        jobs.cancel(job_id)
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        jobs.fail(job_id, str(e))
+
+
 @app.post("/outpaint")
 async def outpaint(
-    image: UploadFile = File(...),
+    image: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Query(None, description="Image session to use instead of uploading an image"),
+    chain: bool = Query(True, description="With image_id: the result becomes the session's next version"),
     extend_left: int = Query(0, ge=0, le=500, description="Pixels to extend left"),
     extend_right: int = Query(0, ge=0, le=500, description="Pixels to extend right"),
     extend_top: int = Query(0, ge=0, le=500, description="Pixels to extend top"),
-    extend_bottom: int = Query(0, ge=0, le=500, description="Pixels to extend bottom")
+    extend_bottom: int = Query(0, ge=0, le=500, description="Pixels to extend bottom"),
+    quality: Optional[str] = Query("balanced", description="Quality preset: fast, balanced, high"),
+    model: str = Query("lama", description="Model ID: lama, sdxl"),
+    prompt: Optional[str] = Query(None, description="Optional text prompt for SDXL"),
+    priority: int = Query(0, ge=0, le=9, description="Scheduling priority, higher runs first"),
+    profile: bool = Query(False, description="Include a per-stage timing breakdown in the job status"),
+    preview: bool = Query(False, description="Publish a small JPEG preview before the full result is encoded"),
+    output: encoding.OutputFormat = Depends(output_format),
 ):
     """
-    5.4 Outpainting - Extend image canvas and fill new areas using AI
+    5.4 Outpainting - Extend image canvas and fill new areas using AI.
+    Runs as a job like /inpaint: poll /jobs/{job_id} (or its events) and fetch /results/{job_id}.
     """
-    import numpy as np
-    
-    image_data = await image.read()
-    image_pil = Image.open(BytesIO(image_data)).convert("RGB")
-    
-    orig_w, orig_h = image_pil.size
-    new_w = orig_w + extend_left + extend_right
-    new_h = orig_h + extend_top + extend_bottom
-    
-    if new_w == orig_w and new_h == orig_h:
-        # No extension requested, return original
-        output = BytesIO()
-        image_pil.save(output, format="PNG")
-        output.seek(0)
-        return StreamingResponse(output, media_type="image/png")
-    
-    # Create extended canvas using Mirror Reflection for better context
-    # Convert to numpy for cv2
-    img_np = np.array(image_pil)
-    # RGB <-> BGR? cv2 is BGR usually but if we treat as generic array it's fine 
-    # as long as we don't use color-sensitive ops. But simple copyMakeBorder is fine.
-    
-    # Note: cv2 uses (top, bottom, left, right)
-    extended_np = cv2.copyMakeBorder(
-        img_np, 
-        extend_top, extend_bottom, extend_left, extend_right, 
-        cv2.BORDER_REFLECT_101
-    )
-    
-    extended = Image.fromarray(extended_np)
-    
-    # Create mask where extended areas are white (to be inpainted)
-    mask = Image.new("L", (new_w, new_h), 255)
-    mask.paste(Image.new("L", (orig_w, orig_h), 0), (extend_left, extend_top))
-    
-    # Use LaMa to fill the extended areas
-    result_pil = inpainting_model.process(extended, mask)
-    
-    output = BytesIO()
-    result_pil.save(output, format="PNG")
-    output.seek(0)
-    
-    return StreamingResponse(output, media_type="image/png")
+    timer = StageTimer("outpaint")
+    image_pil, current = await _load_image(image, image_id, "RGB", timer)
+    max_dim = QUALITY_PRESETS.get(quality, QUALITY_PRESETS["balanced"])
+    session_id = image_id if current is not None and chain else None
+
+    job_id = str(uuid.uuid4())
+    jobs.create(job_id, status="queued", metadata={"prompt": prompt, **({"image_id": session_id} if session_id else {})})
+
+    # Hand off to the bounded worker pool
+    try:
+        timer.mark("queued")
+        job_scheduler.submit(job_id, process_outpaint_job, job_id, image_pil, (extend_left, extend_right, extend_top, extend_bottom), max_dim,
+                             model, prompt, timer, profile, output, preview, session_id, current, model_id=await _slot_model(model), priority=priority)
+    except QueueFullError as e:
+        jobs.delete(job_id)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+
+    await run_codec(_follow_remote_cancel, job_id)
+    return {"job_id": job_id, "status": "queued", "queue_position": job_scheduler.position(job_id)}
 
 
 # ============ PHASE 6: WORKFLOW & EXPORT ============
 
+def _batch_error(error: Exception) -> str:
+    """
+    Short manifest message for a failed batch item. The exception text itself stays in the
+    server log: it can carry our temp file paths (PIL names the spooled upload).
+    """
+    if isinstance(error, Image.DecompressionBombError):
+        return "Image is too large"
+    if isinstance(error, UnidentifiedImageError):
+        return "Not a supported image file"
+    if isinstance(error, OSError):
+        return "Could not read the image"
+    if isinstance(error, MemoryError):
+        return "Out of memory"
+    return "Processing failed"
+
 @app.post("/batch-inpaint")
 async def batch_inpaint(
     images: List[UploadFile] = File(...),
     quality: str = Query("balanced", description="Quality preset: fast, balanced, high"),
     model: str = Query("lama", description="Model ID: lama, sdxl"),
-    prompt: Optional[str] = Query(None, description="Optional text prompt for SDXL")
+    prompt: Optional[str] = Query(None, description="Optional text prompt for SDXL"),
+    profile: bool = Query(False, description="Include per-stage timings for every item in manifest.json"),
+    output: encoding.OutputFormat = Depends(output_format),
 ):
     """
     6.1 Batch Processing - Process multiple images with auto-generated masks
-    Returns a ZIP file containing all processed images
+    Returns a ZIP file containing all processed images plus a manifest.json with the
+    outcome of every upload. Decode, inpainting and encode are pipelined and the ZIP is
+    streamed as entries complete.
     """
-    from rembg import remove
-    
     max_dim = QUALITY_PRESETS.get(quality, 1024)
-    session = get_rembg_session()
-    
-    # Create ZIP in memory
-    zip_buffer = BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for i, image_file in enumerate(images):
+    slot_model = await _slot_model(model)
+    loop = asyncio.get_running_loop()
+
+    # The form (and its upload files) is closed once this handler returns, so copy the
+    # uploads to our own temp files for the streaming pipeline to read
+    def spool(upload: UploadFile) -> str:
+        with tempfile.NamedTemporaryFile(prefix="batch-", delete=False) as tmp:
+            shutil.copyfileobj(upload.file, tmp)
+            return tmp.name
+
+    items = []
+    for i, image_file in enumerate(images):
+        # Each item is timed separately; the request as a whole is just the sum of its items
+        timer = StageTimer("batch-inpaint")
+        with timer.stage("upload"):
+            path = await loop.run_in_executor(codec_pool, spool, image_file)
+        items.append({"index": i, "filename": image_file.filename or f"image_{i+1}.png", "path": path, "timer": timer})
+
+    def decode(item):
+        timer = item["timer"]
+        with timer.stage("decode"):
             try:
-                # Read and process image
-                image_data = await image_file.read()
-                image_pil = Image.open(BytesIO(image_data)).convert("RGB")
-                
-                original_size = image_pil.size
-                w, h = image_pil.size
-                
-                # Resize if needed
-                if max(w, h) > max_dim:
-                    scale = max_dim / max(w, h)
-                    new_w = int(w * scale)
-                    new_h = int(h * scale)
-                    image_pil = image_pil.resize((new_w, new_h), Image.LANCZOS)
-                
-                # Auto-generate mask using rembg (inverted to mask background)
-                mask = remove(image_pil, session=session, only_mask=True)
-                if mask.mode == 'RGBA':
-                    mask = mask.split()[-1]
-                else:
-                    mask = mask.convert('L')
-                mask = Image.eval(mask, lambda x: 255 - x)  # Invert
-                
-                
-                # Process
-                result_pil, _ = inpainting_model.process(image_pil, mask, model_id=model, prompt=prompt)
-                
-                # Resize back to original
-                if result_pil.size != original_size:
-                    result_pil = result_pil.resize(original_size, Image.LANCZOS)
-                
-                # Save to ZIP
-                img_buffer = BytesIO()
-                result_pil.save(img_buffer, format="PNG")
-                img_buffer.seek(0)
-                
-                # Use original filename or generate one
-                filename = image_file.filename or f"image_{i+1}.png"
-                if not filename.lower().endswith('.png'):
-                    filename = filename.rsplit('.', 1)[0] + '_cleaned.png'
-                else:
-                    filename = filename.rsplit('.', 1)[0] + '_cleaned.png'
-                
-                zip_file.writestr(filename, img_buffer.getvalue())
-                
-            except Exception as e:
-                print(f"Error processing {image_file.filename}: {e}")
-                continue
-    
-    zip_buffer.seek(0)
-    
+                # Decoded near max_dim already when the format allows it
+                image_pil, item["original_size"] = ingest.open_image(item["path"], "RGB", max_dim)
+            finally:
+                # The response's cleanup may be removing it too (client went away)
+                with suppress(FileNotFoundError):
+                    os.remove(item["path"])
+        # Resize if needed
+        size = ingest.target_size(image_pil.size, max_dim)
+        if size != image_pil.size:
+            with timer.stage("downscale"):
+                image_pil = ingest.downscale(image_pil, size)
+        item["image"] = image_pil
+        return item
+
+    def infer(item):
+        import time
+        timer = item["timer"]
+        start_time = time.time()
+        # Auto-generate mask using rembg (inverted to mask background)
+        with timer.stage("segmentation"):
+            # Items segmenting at the same time share one rembg forward pass
+            mask = masks.to_image(masks.prepare(segmentation.get_mask(item["image"], batched=True), inverted=True))
+        with job_scheduler.model_slot(slot_model), timer.stage("inference"):
+            item["result"], item["model_used"] = inpainting_model.process(item.pop("image"), mask, model_id=model, prompt=prompt)
+        item["execution_time"] = f"{time.time() - start_time:.2f}s"
+        return item
+
+    def encode(item):
+        timer = item["timer"]
+        result_pil = item.pop("result")
+        # Resize back to original
+        if result_pil.size != item["original_size"]:
+            with timer.stage("upscale"):
+                result_pil = result_pil.resize(item["original_size"], Image.LANCZOS)
+        with timer.stage("encode"):
+            item["data"], item["media_type"] = encoding.encode(result_pil, output)
+        timer.finish()
+        return item
+
+    def entries():
+        used_names = set()
+        try:
+            for index, item, error in batch.run_pipeline(items, [(codec_pool, decode), (inference_pool, infer), (codec_pool, encode)]):
+                source = items[index]["filename"]
+                if error is not None:
+                    print(f"Error processing {source}: {error}")
+                    yield None, None, {"source": source, "status": "failed", "error": _batch_error(error)}
+                    continue
+                extension = encoding.EXTENSIONS[item["media_type"].split("/")[1]]
+                name = batch.unique_name(source.rsplit('.', 1)[0] + '_cleaned' + extension, used_names)
+                info = {"source": source, "status": "completed", "output": name,
+                        "model_used": item["model_used"], "execution_time": item["execution_time"]}
+                if profile:
+                    info["timings"] = item["timer"].breakdown()
+                yield name, item["data"], info
+        finally:
+            # Uploads that never reached the decode stage (client went away)
+            for item in items:
+                # decode() may be removing the same file on a codec thread right now
+                with suppress(FileNotFoundError):
+                    os.remove(item["path"])
+
     return StreamingResponse(
-        zip_buffer,
+        batch.stream_zip(entries()),
         media_type="application/zip",
         headers={"Content-Disposition": "attachment; filename=cleaned_images.zip"}
     )
-
-
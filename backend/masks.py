@@ -0,0 +1,157 @@
+"""
+Vectorized mask preprocessing shared by every endpoint.
+
+Masks are handled as uint8 numpy arrays (0 = keep, 255 = edit) and every step is a
+single numpy or OpenCV call on the whole array: resize, guided upsampling, binarize,
+dilate/erode, hole filling, small-component removal, inversion and feathering.
+prepare() chains the steps, reusing one buffer where it can.
+"""
+import numpy as np
+from PIL import Image
+
+# The inpainting models treat every mask value above this as masked (LaMa binarizes at > 0)
+MODEL_THRESHOLD = 0
+# Binarization of a mask after bilinear resizing, which blurred its edges
+RESIZE_THRESHOLD = 127
+
+
+def as_array(mask) -> np.ndarray:
+    """uint8 view of a PIL mask or array (no copy when it already is one)"""
+    if isinstance(mask, Image.Image):
+        return np.asarray(mask if mask.mode == "L" else mask.convert("L"))
+    return mask if mask.dtype == np.uint8 else mask.astype(np.uint8)
+
+
+def _kernel(radius: int):
+    import cv2
+    return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * radius + 1, 2 * radius + 1))
+
+
+def resize(mask: np.ndarray, size: tuple) -> np.ndarray:
+    """
+    Resize to `size` (w, h). Bilinear, so thresholding afterwards gives smooth edges
+    instead of blocky 'staircase' ones when upscaling.
+    """
+    import cv2
+    if mask.shape[1::-1] == tuple(size):
+        return mask
+    return cv2.resize(mask, tuple(size), interpolation=cv2.INTER_LINEAR)
+
+
+def binarize(mask: np.ndarray, threshold: int = 127, out: np.ndarray = None) -> np.ndarray:
+    """255 where mask > threshold, else 0"""
+    import cv2
+    _, binary = cv2.threshold(mask, threshold, 255, cv2.THRESH_BINARY, dst=out)
+    return binary
+
+
+def dilate(binary: np.ndarray, radius: int) -> np.ndarray:
+    import cv2
+    return cv2.dilate(binary, _kernel(radius)) if radius > 0 else binary
+
+
+def erode(binary: np.ndarray, radius: int) -> np.ndarray:
+    import cv2
+    return cv2.erode(binary, _kernel(radius)) if radius > 0 else binary
+
+
+def fill_holes(binary: np.ndarray) -> np.ndarray:
+    """Fill unmasked areas fully enclosed by the mask"""
+    import cv2
+    h, w = binary.shape
+    # Flood the background from a 1 px border; whatever it cannot reach is a hole
+    flooded = np.zeros((h + 2, w + 2), dtype=np.uint8)
+    flooded[1:-1, 1:-1] = binary
+    cv2.floodFill(flooded, None, (0, 0), 255)
+    return binary | ~flooded[1:-1, 1:-1]
+
+
+def remove_small(binary: np.ndarray, min_area: int) -> np.ndarray:
+    """Drop connected components smaller than `min_area` pixels"""
+    import cv2
+    if min_area <= 1:
+        return binary
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    keep = np.where(stats[:, cv2.CC_STAT_AREA] >= min_area, 255, 0).astype(np.uint8)
+    keep[0] = 0  # background label
+    return keep[labels]
+
+
+def invert(mask) -> np.ndarray:
+    return 255 - as_array(mask)
+
+
+def feather(mask: np.ndarray, radius: int) -> np.ndarray:
+    """
+    Blend weights for pasting an inpainted patch: 1.0 on masked pixels, fading linearly
+    to exactly 0.0 at `radius` pixels outside the mask.
+    """
+    binary = mask > 0
+    if radius <= 0:
+        return binary.astype(np.float32)
+    # Distance of every unmasked pixel to the nearest masked one
+    import cv2
+    dist = cv2.distanceTransform((~binary).astype(np.uint8), cv2.DIST_L2, 3)
+    return np.clip(1.0 - dist / (radius + 1), 0.0, 1.0).astype(np.float32)
+
+
+def snap_to_edges(binary: np.ndarray, image: np.ndarray, threshold1: int = 50, threshold2: int = 150, radius: int = 2) -> np.ndarray:
+    """
+    Grow `binary` onto Canny edges (`threshold1`/`threshold2`) of the RGB `image` lying
+    within `radius` pixels of the mask, so object outlines and their halos are included.
+    """
+    import cv2
+    if radius <= 0:
+        return binary
+    edges = cv2.Canny(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY), threshold1, threshold2)
+    return binary | (edges & dilate(binary, radius))
+
+
+def guided_upsample(mask: np.ndarray, guide: np.ndarray, radius: int = 4, eps: float = 1e-3) -> np.ndarray:
+    """
+    Upsample a low-resolution soft mask to the size of `guide` (grayscale uint8) with a
+    fast guided filter: the local linear model mask = a * guide + b is fitted at mask
+    resolution (`radius` window, `eps` regularization) and only its coefficients are
+    upsampled, so mask edges follow the full-resolution image instead of blurring.
+    """
+    import cv2
+    h, w = guide.shape[:2]
+    window = (2 * radius + 1, 2 * radius + 1)
+    box = lambda x: cv2.boxFilter(x, -1, window)
+
+    small = cv2.resize(guide, mask.shape[1::-1], interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+    p = mask.astype(np.float32) / 255.0
+    mean_i, mean_p = box(small), box(p)
+    a = (box(small * p) - mean_i * mean_p) / (box(small * small) - mean_i * mean_i + eps)
+    # Scaled so that q = a * guide + b comes out in 0..255 for the uint8 guide
+    b = (mean_p - a * mean_i) * 255.0
+
+    q = cv2.resize(box(a), (w, h), interpolation=cv2.INTER_LINEAR)
+    q *= guide
+    q += cv2.resize(box(b), (w, h), interpolation=cv2.INTER_LINEAR)
+    return np.clip(q, 0, 255, out=q).astype(np.uint8)
+
+
+def prepare(mask, size: tuple = None, threshold: int = RESIZE_THRESHOLD, dilate_px: int = 0, erode_px: int = 0,
+            fill: bool = False, min_area: int = 0, inverted: bool = False) -> np.ndarray:
+    """
+    Turn a user or model mask (PIL or array, any size) into a binary uint8 mask of `size`:
+    resize, threshold, optionally invert, shrink by `erode_px` then grow by `dilate_px`,
+    fill enclosed holes and drop specks smaller than `min_area`.
+    """
+    source = as_array(mask)
+    mask = resize(source, size) if size is not None else source
+    # Threshold in place when resizing produced a buffer of our own
+    binary = binarize(mask, threshold, out=mask if mask is not source else None)
+    if inverted:
+        np.subtract(255, binary, out=binary)
+    binary = dilate(erode(binary, erode_px), dilate_px)
+    if fill:
+        binary = fill_holes(binary)
+    if min_area > 1:
+        binary = remove_small(binary, min_area)
+    return binary
+
+
+def to_image(mask: np.ndarray) -> Image.Image:
+    return Image.fromarray(mask)
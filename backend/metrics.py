@@ -0,0 +1,189 @@
+"""
+Prometheus metrics without a client library.
+
+Counters, gauges and histograms register themselves in a module-level registry and
+render() produces the text exposition format served at /metrics. Values owned by other
+components (queue depth, cache counters, model memory) are exposed through callbacks
+evaluated at scrape time. StageTimer records the stages of one request into the stage
+histogram and can return the breakdown for profiled requests.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+# Seconds; spans cheap codec stages up to multi-minute SDXL jobs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: dict = None) -> str:
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, key)} {_number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][i] += 1
+                    break
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            for key, entry in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry["counts"]):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_labels(self.labels, key, {'le': _number(bound)})} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(entry['sum'])}")
+                lines.append(f"{self.name}_count{_labels(self.labels, key)} {entry['count']}")
+        return lines
+
+
+class Callback(Metric):
+    """
+    A gauge or counter whose samples come from `fn()` at scrape time: a number, or a
+    list of (label_values, value) pairs matching `labels`.
+    """
+
+    def __init__(self, name: str, documentation: str, fn, labels: tuple = (), type: str = "gauge"):
+        super().__init__(name, documentation, labels)
+        self.fn = fn
+        self.type = type
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        try:
+            samples = self.fn()
+        except Exception as e:
+            print(f"Metric {self.name} failed: {e}")
+            return lines
+        if not isinstance(samples, list):
+            samples = [((), samples)]
+        for key, value in samples:
+            if value is not None:
+                lines.append(f"{self.name}{_labels(self.labels, key)} {_number(value)}")
+        return lines
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+REQUEST_SECONDS = Histogram("cleanup_request_duration_seconds", "End-to-end request time, including queueing for jobs", ("endpoint",))
+STAGE_SECONDS = Histogram("cleanup_stage_duration_seconds", "Time spent in each request stage", ("endpoint", "stage"))
+
+
+class StageTimer:
+    """Times the stages of one request; every stage is also observed in STAGE_SECONDS"""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.stages = {}
+        self.marks = {}
+        self.started = time.perf_counter()
+        self.total = None
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, endpoint=self.endpoint, stage=name)
+
+    def mark(self, name: str):
+        self.marks[name] = time.perf_counter()
+
+    def add_since(self, stage: str, mark: str):
+        """Record the time since mark(`mark`) as `stage`, e.g. how long a job sat in the queue"""
+        started = self.marks.pop(mark, None)
+        if started is not None:
+            self.add(stage, time.perf_counter() - started)
+
+    def finish(self) -> float:
+        if self.total is None:
+            self.total = time.perf_counter() - self.started
+            REQUEST_SECONDS.observe(self.total, endpoint=self.endpoint)
+        return self.total
+
+    def breakdown(self) -> dict:
+        """Stage durations in milliseconds, plus the total once finished"""
+        result = {name: round(seconds * 1000.0, 2) for name, seconds in self.stages.items()}
+        if self.total is not None:
+            result["total"] = round(self.total * 1000.0, 2)
+        return result
+
+    def server_timing(self) -> str:
+        """Value for a Server-Timing header (shown in browser dev tools)"""
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.breakdown().items())
@@ -1,60 +1,300 @@
-from simple_lama_inpainting import SimpleLama
+# torch and simple_lama_inpainting are imported lazily so that importing this module
+# (and starting a server worker) stays fast; see ModelManager.device and _load_lama.
 from PIL import Image
-import torch
+import numpy as np
 import os
+import gc
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from roi import feather_alpha, paste_patch
+
+# Images larger than this (in either dimension) are inpainted tile by tile so peak
+# memory is bounded by the tile size instead of the image size
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "1024"))
+TILE_OVERLAP = int(os.environ.get("TILE_OVERLAP", "128"))
+TILE_FEATHER = int(os.environ.get("TILE_FEATHER", "8"))
+
+# Model lifecycle
+# Models loaded before the server starts answering, e.g. "lama"
+MODEL_PRELOAD = [m.strip() for m in os.environ.get("MODEL_PRELOAD", "").split(",") if m.strip()]
+# Models loaded and warmed up (one dummy inference) in the background at startup
+MODEL_WARMUP = [m.strip() for m in os.environ.get("MODEL_WARMUP", "lama").split(",") if m.strip()]
+# Unload a model after this many idle seconds (0 = keep loaded), e.g. "sdxl=900,lama=0"
+MODEL_IDLE_TIMEOUT = os.environ.get("MODEL_IDLE_TIMEOUT", "sdxl=900")
+# Least recently used models are unloaded to keep the total under this budget (0 = unlimited)
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get("MODEL_MEMORY_BUDGET_MB", "0"))
+# Used for budgeting until the real footprint has been measured
+MODEL_SIZE_ESTIMATES_MB = {"lama": 250, "sdxl": 7500}
+
+
+def _parse_timeouts(spec: str) -> dict:
+    timeouts = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            timeouts[name.strip()] = float(value)
+    return timeouts
 
 class ModelManager:
     def __init__(self):
-        self.device = "cpu"
+        # Construction is cheap: the device is detected on first access and models load later
+        self._device = None
+        self._device_lock = threading.Lock()
         self.models = {}
         self.active_model_id = "lama"
-        
-        # Check for forced CPU mode
+        self.lama_batcher = None
+        self.lama_backend = None  # {"backend": ..., parity check results}, see lama_backends
+
+        # Lifecycle state: unloaded | loading | warming | ready | failed
+        self.status = {"lama": "unloaded"}
+        self.errors = {}
+        self.last_used = {}
+        self.memory_mb = {}
+        self.idle_timeouts = _parse_timeouts(MODEL_IDLE_TIMEOUT)
+        self._in_use = Counter()
+        self._lock = threading.RLock()
+        self._load_locks = {"lama": threading.Lock(), "sdxl": threading.Lock()}
+        self._loaders = {"lama": self._load_lama, "sdxl": self._load_sdxl}
+        self._reaper = None
+
+    @property
+    def device_known(self) -> bool:
+        return self._device is not None
+
+    @property
+    def device(self) -> str:
+        """"cuda" or "cpu". The first access imports torch and probes the GPU."""
+        if self._device is None:
+            with self._device_lock:
+                if self._device is None:
+                    self._device = self._detect_device()
+                    if self._device == "cuda":
+                        self.status.setdefault("sdxl", "unloaded")
+        return self._device
+
+    def _detect_device(self) -> str:
+        device = "cpu"
+        # Check for forced CPU mode (torch is not even imported then)
         if os.environ.get("FORCE_CPU", "false").lower() == "true":
             print("Force CPU mode enabled. Using CPU.")
-            self.device = "cpu"
-        elif torch.cuda.is_available():
+        else:
+            import torch
+
+            if torch.cuda.is_available():
+                try:
+                    # Check for compatibility
+                    cap = torch.cuda.get_device_capability()
+                    major, minor = cap
+                    if major < 5:
+                        print(f"Warning: GPU Compute Capability {major}.{minor} is too old (needs 5.0+). Falling back to CPU.")
+                        device = "cpu"
+                    else:
+                        device = "cuda"
+                        print(f"Device Name: {torch.cuda.get_device_name(0)}")
+                except Exception as e:
+                    print(f"Error checking GPU capability: {e}")
+                    device = "cpu"
+
+        print(f"Initializing ModelManager on device: {device}")
+        return device
+
+    # ---- Lifecycle ----
+
+    def start(self, background: bool = True):
+        """
+        Detect the device, load MODEL_PRELOAD and warm up MODEL_WARMUP.
+        In background mode everything happens on a separate thread and the server answers
+        immediately; otherwise preloading blocks and only the warm-up runs in the background.
+        """
+        if background:
+            threading.Thread(target=self._startup, name="model-startup", daemon=True).start()
+            return
+        self.device  # probe the GPU before loading anything
+        for model_id in MODEL_PRELOAD:
+            if model_id in self.status:
+                self.warmup(model_id)
+        threading.Thread(target=self._startup, name="model-warmup", daemon=True).start()
+
+    def _startup(self):
+        self.device  # probe the GPU before loading anything
+        for model_id in MODEL_PRELOAD + MODEL_WARMUP:
+            if model_id in self.status and self.status[model_id] != "ready":
+                self.warmup(model_id)
+
+    def is_ready(self) -> bool:
+        """True once the device is known and every preloaded/warmed-up model is ready"""
+        if not self.device_known:
+            return False
+        wanted = [m for m in MODEL_PRELOAD + MODEL_WARMUP if m in self.status]
+        return all(self.status.get(m) == "ready" for m in wanted)
+
+    def readiness(self) -> dict:
+        with self._lock:
+            return {
+                model_id: {
+                    "status": status,
+                    "error": self.errors.get(model_id),
+                    "memory_mb": self.memory_mb.get(model_id),
+                    "idle_seconds": round(time.time() - self.last_used[model_id], 1) if model_id in self.last_used and model_id in self.models else None,
+                }
+                for model_id, status in self.status.items()
+            }
+
+    def after_fork(self):
+        """
+        Called in a server process forked after the weights were loaded (see shared.py):
+        locks may have been held by threads that did not survive the fork, and the idle
+        reaper and batching threads have to be started again.
+        """
+        self._device_lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._load_locks = {model_id: threading.Lock() for model_id in self._load_locks}
+        self._in_use = Counter()
+        self._reaper = None
+        if self.lama_backend and self.lama_backend.get("backend") == "onnx":
+            from lama_backends import reopen_onnx
+            reopen_onnx(self.models["lama"], self.lama_backend["artifact"])
+        if self.lama_batcher is not None:
+            self.lama_batcher.after_fork()
+        if self.models:
+            self._ensure_reaper()
+
+    def ensure_loaded(self, model_id: str):
+        if model_id in self.models:
+            return
+        with self._load_locks[model_id]:
+            if model_id in self.models:
+                return
+            self._make_room(model_id)
+            self.status[model_id] = "loading"
+            if self.device == "cuda":
+                import torch
+                allocated_before = torch.cuda.memory_allocated()
             try:
-                # Check for compatibility
-                cap = torch.cuda.get_device_capability()
-                major, minor = cap
-                if major < 5:
-                    print(f"Warning: GPU Compute Capability {major}.{minor} is too old (needs 5.0+). Falling back to CPU.")
-                    self.device = "cpu"
-                else:
-                    self.device = "cuda"
-                    print(f"Device Name: {torch.cuda.get_device_name(0)}")
+                self._loaders[model_id]()
             except Exception as e:
-                print(f"Error checking GPU capability: {e}")
-                self.device = "cpu"
-        
-        print(f"Initializing ModelManager on device: {self.device}")
-        
-        # Initialize Default Model (LaMa)
-        # We always want LaMa available as it's fast and lightweight
-        self._load_lama()
+                self.status[model_id] = "failed"
+                self.errors[model_id] = str(e)
+                raise
+            if self.device == "cuda":
+                self.memory_mb[model_id] = round((torch.cuda.memory_allocated() - allocated_before) / (1024 * 1024))
+            else:
+                self.memory_mb[model_id] = MODEL_SIZE_ESTIMATES_MB.get(model_id, 0)
+            with self._lock:
+                self.errors.pop(model_id, None)
+                self.status[model_id] = "ready"
+                self.last_used[model_id] = time.time()
+            self._ensure_reaper()
+
+    def warmup(self, model_id: str):
+        """Load a model and run one small inference so lazy kernel compilation happens now"""
+        try:
+            self.ensure_loaded(model_id)
+            self.status[model_id] = "warming"
+            image = Image.new("RGB", (256, 256), (127, 127, 127))
+            mask = Image.new("L", (256, 256), 0)
+            mask.paste(255, (96, 96, 160, 160))
+            start_time = time.time()
+            with self._using(model_id):
+                if model_id == "sdxl":
+                    self.models["sdxl"](prompt="", image=image.resize((512, 512)), mask_image=mask.resize((512, 512)),
+                                        strength=0.99, num_inference_steps=2)
+                else:
+                    self._process_lama(image, mask)
+            print(f"Warm-up of {model_id} finished in {time.time() - start_time:.2f}s")
+            self.status[model_id] = "ready"
+        except Exception as e:
+            print(f"Warm-up of {model_id} failed: {e}")
+            if model_id in self.models:
+                self.status[model_id] = "ready"
+            else:
+                self.status[model_id] = "failed"
+                self.errors[model_id] = str(e)
+
+    def unload(self, model_id: str) -> bool:
+        """Drop a model's weights. Models currently running inference are left alone."""
+        with self._lock:
+            if model_id not in self.models or self._in_use[model_id]:
+                return False
+            print(f"Unloading {model_id} model")
+            del self.models[model_id]
+            if model_id == "lama" and self.lama_batcher is not None:
+                self.lama_batcher.stop()
+                self.lama_batcher = None
+            self.status[model_id] = "unloaded"
+            self.memory_mb.pop(model_id, None)
+        gc.collect()
+        if self.device == "cuda":
+            import torch
+            torch.cuda.empty_cache()
+        return True
+
+    def _make_room(self, model_id: str):
+        """Unload least recently used idle models until `model_id` fits in the memory budget"""
+        if MODEL_MEMORY_BUDGET_MB <= 0:
+            return
+        needed = self.memory_mb.get(model_id) or MODEL_SIZE_ESTIMATES_MB.get(model_id, 0)
+        for other in sorted(list(self.models), key=lambda m: self.last_used.get(m, 0)):
+            if sum(self.memory_mb.get(m, 0) for m in self.models) + needed <= MODEL_MEMORY_BUDGET_MB:
+                break
+            if other != model_id:
+                self.unload(other)
+
+    @contextmanager
+    def _using(self, model_id: str):
+        with self._lock:
+            self._in_use[model_id] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_use[model_id] -= 1
+                self.last_used[model_id] = time.time()
+
+    def _ensure_reaper(self):
+        if self._reaper is None and any(t > 0 for t in self.idle_timeouts.values()):
+            self._reaper = threading.Thread(target=self._reap_idle, name="model-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_idle(self):
+        while True:
+            time.sleep(30)
+            now = time.time()
+            for model_id, timeout in self.idle_timeouts.items():
+                if timeout > 0 and model_id in self.models and now - self.last_used.get(model_id, now) > timeout:
+                    self.unload(model_id)
 
     def _load_lama(self):
+        import torch
+        from lama_backends import load_lama, configure_torch_threads
+        from batching import LamaBatcher, LAMA_BATCH_WINDOW_MS
+
         print("Loading LaMa model...")
+        if self.device == "cpu":
+            print(f"Using {configure_torch_threads()} CPU threads per inference")
         try:
-            self.models["lama"] = SimpleLama(device=torch.device(self.device))
+            self.models["lama"], self.lama_backend = load_lama(torch.device(self.device))
         except Exception as e:
              if self.device == "cuda":
                 print(f"Error loading LaMa on GPU: {e}. Fallback to CPU.")
-                self.models["lama"] = SimpleLama(device=torch.device("cpu"))
+                self.models["lama"], self.lama_backend = load_lama(torch.device("cpu"))
              else:
                  raise e
 
-    def _load_sdxl(self):
-        """Lazy load SDXL only when requested"""
-        if "sdxl" in self.models:
-            return
+        # Concurrent LaMa calls are coalesced into batched forward passes
+        if LAMA_BATCH_WINDOW_MS > 0:
+            self.lama_batcher = LamaBatcher(self.models["lama"])
 
+    def _load_sdxl(self):
+        """Load SDXL (called through ensure_loaded, on first use or warm-up)"""
         if self.device == "cpu":
             raise RuntimeError("SDXL requires a GPU (CUDA) to run efficiently. CPU not supported.")
 
         print("Loading SDXL Inpainting model... (This may take a moment)")
         try:
+            import torch
             from diffusers import AutoPipelineForInpainting
             
             # Load SDXL Inpainting
@@ -79,7 +319,7 @@ class ModelManager:
     def get_available_models(self):
         """Return list of available models based on hardware"""
         models = [
-            {"id": "lama", "name": "LaMa (Fast, Cleaning)", "description": "Best for cleaning up small defects and removing objects."}
+            {"id": "lama", "name": "LaMa (Fast, Cleaning)", "description": "Best for cleaning up small defects and removing objects.", "status": self.status.get("lama")}
         ]
         
         # SDXL is available if we have a GPU
@@ -87,14 +327,24 @@ class ModelManager:
             models.append({
                 "id": "sdxl", 
                 "name": "SDXL (High Quality, Generative)", 
-                "description": "Best for large objects and complex background reconstruction. Slower."
+                "description": "Best for large objects and complex background reconstruction. Slower.",
+                "status": self.status.get("sdxl")
             })
             
         return models
 
-    def process(self, image: Image.Image, mask: Image.Image, model_id: str = "lama", prompt: str = None) -> tuple[Image.Image, str]:
+    def resolve_model(self, model_id: str) -> str:
+        """
+        The model a request for `model_id` runs on: SDXL needs CUDA, anything else is LaMa.
+        Only SDXL requests look at the device (probing it on first use).
+        """
+        return "sdxl" if model_id == "sdxl" and self.device == "cuda" else "lama"
+
+    def process(self, image: Image.Image, mask: Image.Image, model_id: str = "lama", prompt: str = None, progress_callback=None) -> tuple[Image.Image, str]:
         """
         Process the image with the specified model. Returns (ResultImage, ActualModelID)
+        progress_callback(step, total) is called after every SDXL denoising step and every
+        LaMa tile; an exception raised by it aborts the call.
         """
         actual_model = model_id
         
@@ -105,22 +355,83 @@ class ModelManager:
             else:
                 # Lazy load SDXL
                 try:
-                    self._load_sdxl()
+                    self.ensure_loaded("sdxl")
                 except Exception as e:
                     print(f"Failed to load SDXL: {e}. Falling back to LaMa.")
                     actual_model = "lama"
+        elif model_id != "lama":
+            print(f"Warning: unknown model {model_id!r} requested. Falling back to LaMa.")
+            actual_model = "lama"
 
-        # Dispatch
-        if actual_model == "sdxl":
-            return self._process_sdxl(image, mask, prompt=prompt), "sdxl"
-        else:
-            return self._process_lama(image, mask), "lama"
+        # Dispatch (holding the model in use so the idle reaper cannot unload it mid-call)
+        with self._using(actual_model):
+            self.ensure_loaded(actual_model)
+            if actual_model == "sdxl":
+                return self._process_sdxl(image, mask, prompt=prompt, progress_callback=progress_callback), "sdxl"
+            elif max(image.size) > TILE_SIZE:
+                return self.process_tiled(image, mask, progress_callback=progress_callback), "lama"
+            else:
+                return self._process_lama(image, mask), "lama"
 
     def _process_lama(self, image, mask):
+        if self.lama_batcher is not None:
+            return self.lama_batcher(image, mask)
         return self.models["lama"](image, mask)
 
-    def _process_sdxl(self, image, mask, prompt=None):
+    @staticmethod
+    def _tile_starts(length: int, tile_size: int, overlap: int) -> list:
+        if length <= tile_size:
+            return [0]
+        stride = max(1, tile_size - overlap)
+        starts = list(range(0, length - tile_size, stride))
+        starts.append(length - tile_size)
+        return starts
+
+    def process_tiled(self, image: Image.Image, mask: Image.Image, tile_size: int = TILE_SIZE, overlap: int = TILE_OVERLAP,
+                      progress_callback=None) -> Image.Image:
+        """
+        Inpaint a large image with LaMa in overlapping tiles of at most `tile_size` pixels.
+        Tiles without masked pixels are skipped, overlaps are blended with linear ramps and
+        only the masked area (plus a small feather) of each tile is written back.
+        """
+        overlap = min(overlap, tile_size // 2)
+        mask_np = np.asarray(mask.convert("L"))
+        out_np = np.array(image.convert("RGB"))
+        h, w = mask_np.shape
+        ramp = np.linspace(0.0, 1.0, overlap + 2, dtype=np.float32)[1:-1]
+        rows, columns = self._tile_starts(h, tile_size, overlap), self._tile_starts(w, tile_size, overlap)
+
+        for row, y0 in enumerate(rows):
+            for column, x0 in enumerate(columns):
+                if progress_callback is not None:
+                    progress_callback(row * len(columns) + column, len(rows) * len(columns))
+                y1, x1 = min(h, y0 + tile_size), min(w, x0 + tile_size)
+                tile_mask = mask_np[y0:y1, x0:x1]
+                if not tile_mask.any():
+                    continue
+
+                tile_image = Image.fromarray(out_np[y0:y1, x0:x1])
+                result = self._process_lama(tile_image, Image.fromarray(tile_mask))
+                result = result.convert("RGB").crop((0, 0, x1 - x0, y1 - y0))
+
+                # Fade in over the overlap with tiles above and to the left, which were already written
+                alpha = feather_alpha(tile_mask, TILE_FEATHER)
+                if x0 > 0:
+                    alpha[:, :overlap] *= ramp[None, :]
+                if y0 > 0:
+                    alpha[:overlap, :] *= ramp[:, None]
+                paste_patch(out_np, np.asarray(result), alpha, (x0, y0, x1, y1))
+
+        return Image.fromarray(out_np)
+
+    def _process_sdxl(self, image, mask, prompt=None, progress_callback=None):
         pipe = self.models["sdxl"]
+        num_inference_steps = 25 # Good speed/quality balance for interactive use
+
+        def on_step_end(pipeline, step, timestep, callback_kwargs):
+            if progress_callback is not None:
+                progress_callback(step + 1, getattr(pipeline, "num_timesteps", num_inference_steps))
+            return callback_kwargs
         
         # SDXL requires inputs to be divisible by 8 usually, pipelines handle it but good to be safe.
         # Also SDXL works best at 1024x1024.
@@ -137,7 +448,8 @@ class ModelManager:
             mask_image=mask,
             strength=0.99, 
             guidance_scale=7.5,
-            num_inference_steps=25 # Good speed/quality balance for interactive use
+            num_inference_steps=num_inference_steps,
+            callback_on_step_end=on_step_end
         ).images[0]
         
         return result
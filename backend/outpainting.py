@@ -0,0 +1,101 @@
+"""
+Border-strip outpainting.
+
+Extending a canvas only needs the new border bands filled, so instead of running the
+model on the whole enlarged image each band is inpainted together with a strip of
+`context` original pixels next to it. Bands longer than `chunk` are processed in
+windows along the edge; consecutive windows overlap and pixels filled by the previous
+window serve as context for the next, so the fill stays continuous without blending.
+Original pixels are never modified.
+"""
+import os
+
+import numpy as np
+from PIL import Image
+
+import masks
+from roi import paste_patch
+
+# Original (or already filled) pixels shown to the model next to each band
+OUTPAINT_CONTEXT = int(os.environ.get("OUTPAINT_CONTEXT", "128"))
+# Longest window along an edge, and how much consecutive windows overlap
+OUTPAINT_CHUNK = int(os.environ.get("OUTPAINT_CHUNK", "1024"))
+OUTPAINT_CHUNK_OVERLAP = int(os.environ.get("OUTPAINT_CHUNK_OVERLAP", "128"))
+
+
+def _windows(start: int, end: int, chunk: int, overlap: int) -> list:
+    """(a, b) ranges of at most `chunk` covering [start, end), overlapping by `overlap`"""
+    if end - start <= chunk:
+        return [(start, end)]
+    stride = max(1, chunk - overlap)
+    starts = list(range(start, end - chunk, stride)) + [end - chunk]
+    return [(a, a + chunk) for a in starts]
+
+
+def band_boxes(size: tuple, left: int, right: int, top: int, bottom: int, context: int, chunk: int, overlap: int) -> list:
+    """
+    Canvas windows (x0, y0, x1, y1) in processing order: the left and right bands beside
+    the original image first, then the top and bottom bands across the full width, which
+    also fills the corners with the side bands as context.
+    """
+    w, h = size
+    new_w, new_h = w + left + right, h + top + bottom
+    boxes = []
+    if left:
+        boxes += [(0, a, min(new_w, left + context), b) for a, b in _windows(top, top + h, chunk, overlap)]
+    if right:
+        boxes += [(max(0, left + w - context), a, new_w, b) for a, b in _windows(top, top + h, chunk, overlap)]
+    if top:
+        boxes += [(a, 0, b, min(new_h, top + context)) for a, b in _windows(0, new_w, chunk, overlap)]
+    if bottom:
+        boxes += [(a, max(0, top + h - context), b, new_h) for a, b in _windows(0, new_w, chunk, overlap)]
+    return boxes
+
+
+def extend(image: Image.Image, left: int, right: int, top: int, bottom: int, inpaint_fn, max_dim: int = 99999,
+           context: int = OUTPAINT_CONTEXT, chunk: int = OUTPAINT_CHUNK, overlap: int = OUTPAINT_CHUNK_OVERLAP,
+           progress_callback=None) -> Image.Image:
+    """
+    Extend `image` by the given number of pixels on each side and fill the new area.
+
+    `inpaint_fn(window_image, window_mask)` is called once per window and must return a
+    PIL image at least as large as its input. Windows larger than `max_dim` are
+    downscaled for inference and only the filled pixels are upscaled back.
+    progress_callback(done, total) is called after every window.
+    """
+    import cv2
+
+    image = image.convert("RGB")
+    w, h = image.size
+    chunk = max(chunk, 2 * overlap + 1)
+    # Reflected borders give the first windows plausible (masked) surroundings
+    canvas = cv2.copyMakeBorder(np.asarray(image), top, bottom, left, right, cv2.BORDER_REFLECT_101)
+    todo = np.ones(canvas.shape[:2], dtype=bool)
+    todo[top:top + h, left:left + w] = False
+
+    boxes = band_boxes((w, h), left, right, top, bottom, context, chunk, overlap)
+    for index, box in enumerate(boxes):
+        x0, y0, x1, y1 = box
+        window_todo = todo[y0:y1, x0:x1]
+        if not window_todo.any():
+            continue
+        window_mask = Image.fromarray(window_todo.astype(np.uint8) * 255)
+        window_image = Image.fromarray(canvas[y0:y1, x0:x1])
+        win_w, win_h = window_image.size
+
+        if max(win_w, win_h) > max_dim:
+            scale = max_dim / max(win_w, win_h)
+            small = (max(1, int(win_w * scale)), max(1, int(win_h * scale)))
+            # Pixels that are even partly unfilled stay masked after downscaling
+            small_mask = masks.binarize(np.asarray(window_mask.resize(small, Image.BOX)), 0)
+            patch = inpaint_fn(window_image.resize(small, Image.LANCZOS), masks.to_image(small_mask))
+            patch = patch.convert("RGB").crop((0, 0) + small).resize((win_w, win_h), Image.LANCZOS)
+        else:
+            patch = inpaint_fn(window_image, window_mask).convert("RGB").crop((0, 0, win_w, win_h))
+
+        paste_patch(canvas, np.asarray(patch), window_todo.astype(np.float32), box)
+        window_todo[:] = False
+        if progress_callback is not None:
+            progress_callback(index + 1, len(boxes))
+
+    return Image.fromarray(canvas)
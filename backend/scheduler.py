@@ -0,0 +1,211 @@
+"""
+Bounded job scheduler for inference work.
+
+Jobs wait in a bounded priority queue and are picked up by a fixed number of worker
+threads. Each model has its own concurrency limit (e.g. a single SDXL pipeline on one
+GPU), and a job is only started once a slot for its model is free, so a waiting SDXL
+job never blocks LaMa jobs queued behind it.
+
+Jobs can be cancelled: a queued job is simply dropped, a running one is asked to stop
+and raises JobCancelled at its next checkpoint (check_cancelled), which frees the worker.
+
+With several server processes (shared_state.py) the queue bound and the per-model limits
+hold across all of them: they are process-shared semaphores created before the fork.
+Each process still queues and runs its own jobs.
+"""
+import os
+import threading
+import itertools
+import multiprocessing
+from contextlib import contextmanager
+
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "32"))
+# Per-model concurrency limits, e.g. "lama=2,sdxl=1". Unlisted models are only limited by the worker count.
+MODEL_CONCURRENCY = os.environ.get("MODEL_CONCURRENCY", "sdxl=1")
+# How often a process waiting for a model slot held by another process checks again
+SLOT_POLL_SECONDS = 0.05
+
+
+class QueueFullError(Exception):
+    """Raised by JobScheduler.submit when the queue is at capacity"""
+
+
+class JobCancelled(Exception):
+    """Raised by JobScheduler.check_cancelled inside a job that has been cancelled"""
+
+
+def parse_model_limits(spec: str) -> dict:
+    limits = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            limits[name.strip()] = max(1, int(value))
+    return limits
+
+
+class JobScheduler:
+    def __init__(self, workers: int = 1, max_queue: int = JOB_QUEUE_SIZE, model_limits: dict = None, shared: bool = False):
+        self.workers = max(1, int(workers))
+        self.max_queue = max_queue
+        self.model_limits = model_limits or {}
+        # Process-shared queue count and model slots (None / empty in a single process)
+        self._queued_total = None
+        self._slots = {}
+        if shared:
+            ctx = multiprocessing.get_context("fork")
+            self._queued_total = ctx.Value("i", 0)
+            self._slots = {model_id: ctx.BoundedSemaphore(limit) for model_id, limit in self.model_limits.items()}
+        self._cond = threading.Condition()
+        self._queue = []  # [(sort_key, job_id, model_id, fn, args, on_cancel)] kept sorted
+        self._seq = itertools.count()
+        self._running = {}  # model_id -> number of jobs holding a slot
+        self._active = set()  # ids of the jobs being run
+        self._cancelled = set()  # running jobs asked to stop
+        self.cancellations = 0
+        self._threads = []
+
+    def _ensure_started(self):
+        # Threads are started on first use rather than at import, so the module is fork-safe
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"inference-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job_id: str, fn, *args, model_id: str = "lama", priority: int = 0, on_cancel=None):
+        """
+        Queue `fn(*args)`. Higher priority runs first; raises QueueFullError when full.
+        `on_cancel()` is called instead of `fn` if the job is cancelled while still queued.
+        """
+        with self._cond:
+            self._reserve_queue_slot()
+            self._queue.append(((-priority, next(self._seq)), job_id, model_id, fn, args, on_cancel))
+            self._queue.sort(key=lambda entry: entry[0])
+            self._ensure_started()
+            self._cond.notify_all()
+
+    def _reserve_queue_slot(self):
+        if self._queued_total is None:
+            if len(self._queue) >= self.max_queue:
+                raise QueueFullError(f"Job queue is full ({self.max_queue} jobs waiting)")
+            return
+        with self._queued_total.get_lock():
+            if self._queued_total.value >= self.max_queue:
+                raise QueueFullError(f"Job queue is full ({self.max_queue} jobs waiting)")
+            self._queued_total.value += 1
+
+    def _dequeue(self, index: int):
+        entry = self._queue.pop(index)
+        if self._queued_total is not None:
+            with self._queued_total.get_lock():
+                self._queued_total.value -= 1
+        return entry
+
+    def position(self, job_id: str):
+        """1-based position of a waiting job, or None if it is not queued"""
+        with self._cond:
+            for index, entry in enumerate(self._queue):
+                if entry[1] == job_id:
+                    return index + 1
+        return None
+
+    def cancel(self, job_id: str):
+        """
+        Cancel a job. Returns "dequeued" if it had not started (it never will), "cancelling"
+        if it is running and will stop at its next checkpoint, or None if it is unknown here.
+        """
+        with self._cond:
+            for index, entry in enumerate(self._queue):
+                if entry[1] == job_id:
+                    on_cancel = self._dequeue(index)[5]
+                    self.cancellations += 1
+                    break
+            else:
+                if job_id in self._active:
+                    if job_id not in self._cancelled:
+                        self._cancelled.add(job_id)
+                        self.cancellations += 1
+                    return "cancelling"
+                return None
+        if on_cancel is not None:
+            on_cancel()
+        return "dequeued"
+
+    def check_cancelled(self, job_id: str):
+        """Checkpoint for long-running jobs: raises JobCancelled once `job_id` is cancelled"""
+        if job_id in self._cancelled:
+            raise JobCancelled(f"Job {job_id} was cancelled")
+
+    def _try_acquire(self, model_id: str) -> bool:
+        """Take a slot for `model_id` if one is free (called with _cond held)"""
+        slot = self._slots.get(model_id)
+        if slot is not None:
+            if not slot.acquire(False):
+                return False
+        else:
+            limit = self.model_limits.get(model_id)
+            if limit is not None and self._running.get(model_id, 0) >= limit:
+                return False
+        self._running[model_id] = self._running.get(model_id, 0) + 1
+        return True
+
+    def _release(self, model_id: str):
+        with self._cond:
+            self._running[model_id] -= 1
+            if model_id in self._slots:
+                self._slots[model_id].release()
+            self._cond.notify_all()
+
+    def _slot_wait(self):
+        # Another process freeing a shared slot does not notify our condition
+        return SLOT_POLL_SECONDS if self._slots else None
+
+    @contextmanager
+    def model_slot(self, model_id: str):
+        """Hold one of `model_id`'s concurrency slots for work running outside the queue"""
+        with self._cond:
+            while not self._cond.wait_for(lambda: self._try_acquire(model_id), self._slot_wait()):
+                pass
+        try:
+            yield
+        finally:
+            self._release(model_id)
+
+    def _next_runnable(self):
+        for index, entry in enumerate(self._queue):
+            if self._try_acquire(entry[2]):
+                return self._dequeue(index)
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                entry = self._next_runnable()
+                while entry is None:
+                    self._cond.wait(self._slot_wait() if self._queue else None)
+                    entry = self._next_runnable()
+                _, job_id, model_id, fn, args, _ = entry
+                self._active.add(job_id)
+            try:
+                fn(*args)
+            except JobCancelled:
+                print(f"Scheduled job {job_id} cancelled")
+            except Exception as e:
+                print(f"Scheduled job {job_id} raised: {e}")
+            finally:
+                with self._cond:
+                    self._active.discard(job_id)
+                    self._cancelled.discard(job_id)
+                self._release(model_id)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "queued": len(self._queue),
+                **({"queued_all_processes": self._queued_total.value} if self._queued_total is not None else {}),
+                "max_queue": self.max_queue,
+                "running": {k: v for k, v in self._running.items() if v},
+                "cancellations": self.cancellations,
+            }
@@ -0,0 +1,272 @@
+"""
+rembg foreground segmentation with a shared per-image mask cache.
+
+The soft alpha mask is computed once per image (keyed on its content hash) and every
+endpoint derives what it needs from it: the mask itself, its inverse, a cutout or a
+composite. Only the first call for a photo pays for the isnet model.
+
+The model runs on a pool of REMBG_POOL_SIZE ONNX sessions, each used by one thread at a
+time, so concurrent requests segment in parallel. Inputs are downscaled to the model's
+native resolution first (rembg squashes them to it anyway) and the low-resolution mask
+is brought back to full size with a guided filter, so its edges follow the photo.
+Batch jobs group concurrent calls into one forward pass (SegmentationBatcher) when the
+exported model takes batches; the default isnet model has a fixed batch of one.
+"""
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+import ingest
+import masks
+from batching import MicroBatcher
+from cache import image_digest
+from store import MemoryBlobStore
+
+SEGMENTATION_CACHE_MAX_BYTES = int(os.environ.get("SEGMENTATION_CACHE_MB", "128")) * 1024 * 1024
+SEGMENTATION_CACHE_TTL_SECONDS = int(os.environ.get("SEGMENTATION_CACHE_TTL_SECONDS", "3600"))
+REMBG_MODEL = os.environ.get("REMBG_MODEL", "isnet-general-use")
+# ONNX Runtime intra-op threads per rembg session (0 = the per-process CPU share split across the pool)
+REMBG_THREADS = int(os.environ.get("REMBG_THREADS", "0"))
+# rembg sessions that can run at once; each holds its own copy of the model
+REMBG_POOL_SIZE = int(os.environ.get("REMBG_POOL_SIZE", "1"))
+# Longest side of the image handed to the model (0 = the model's native input size)
+REMBG_INPUT_DIM = int(os.environ.get("REMBG_INPUT_DIM", "0"))
+# Guided-filter upsampling of the mask: window radius (at model resolution) and regularization
+REMBG_GUIDE_RADIUS = int(os.environ.get("REMBG_GUIDE_RADIUS", "4"))
+REMBG_GUIDE_EPS = float(os.environ.get("REMBG_GUIDE_EPS", "1e-3"))
+# Batched segmentation for batch jobs: how long to wait for more images, and the batch cap
+REMBG_BATCH_WINDOW_MS = float(os.environ.get("REMBG_BATCH_WINDOW_MS", "10"))
+REMBG_MAX_BATCH = int(os.environ.get("REMBG_MAX_BATCH", "4"))
+
+# Native input size and normalization of the rembg models (as in rembg.sessions).
+# Other models still work, through session.predict one image at a time.
+_U2NET = {"size": 320, "mean": (0.485, 0.456, 0.406), "std": (0.229, 0.224, 0.225)}
+MODEL_SPECS = {
+    "isnet-general-use": {"size": 1024, "mean": (0.5, 0.5, 0.5), "std": (1.0, 1.0, 1.0)},
+    "u2net": _U2NET,
+    "u2netp": _U2NET,
+    "u2net_human_seg": _U2NET,
+    "silueta": _U2NET,
+}
+
+mask_cache = MemoryBlobStore(max_bytes=SEGMENTATION_CACHE_MAX_BYTES, ttl=SEGMENTATION_CACHE_TTL_SECONDS)
+
+
+def _new_session(threads: int):
+    import onnxruntime as ort
+    from rembg.sessions import sessions_class
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    session_class = next(sc for sc in sessions_class if sc.name() == REMBG_MODEL)
+    return session_class(REMBG_MODEL, options)
+
+
+class SessionPool:
+    """Up to `size` rembg sessions, created on demand, each used by one thread at a time"""
+
+    def __init__(self, size: int = REMBG_POOL_SIZE):
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._batchable = None
+
+    def threads(self) -> int:
+        from lama_backends import cpu_threads
+        return REMBG_THREADS or max(1, cpu_threads() // self.size)
+
+    @contextmanager
+    def session(self):
+        """Borrow a session: an idle one, a new one while fewer than `size` exist, else wait"""
+        session, create = None, False
+        with self._lock:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+        if session is None:
+            session = self._create() if create else self._idle.get()
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def _create(self):
+        try:
+            return _new_session(self.threads())
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def accepts_batches(self) -> bool:
+        """Whether the model runs several images per forward pass (checked once, on a session)"""
+        if self._batchable is None:
+            with self.session() as session:
+                self._batchable = _accepts_batches(session)
+        return self._batchable
+
+    def fill(self):
+        """Create every session up front (used before forking, see shared.py)"""
+        with self._lock:
+            missing = self.size - self._created
+            self._created = self.size
+        for _ in range(missing):
+            self._idle.put(self._create())
+
+    def after_fork(self):
+        """
+        Drop the sessions in a forked server process: ONNX Runtime cannot take its thread
+        pools along, so each process opens its own sessions with its share of the cores.
+        """
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": self.size, "created": self._created, "idle": self._idle.qsize()}
+
+
+session_pool = SessionPool()
+
+
+def _input_dim() -> int:
+    spec = MODEL_SPECS.get(REMBG_MODEL)
+    return REMBG_INPUT_DIM or (spec["size"] if spec else 1024)
+
+
+def _model_input(rgb: Image.Image) -> Image.Image:
+    """`rgb` downscaled to the model's input resolution (unchanged if already smaller)"""
+    size = ingest.target_size(rgb.size, _input_dim())
+    return rgb if size == rgb.size else ingest.downscale(rgb, size)
+
+
+def _as_mask(mask: Image.Image) -> Image.Image:
+    return mask.split()[-1] if mask.mode == "RGBA" else mask.convert("L")
+
+
+def _upsample(mask: Image.Image, rgb: Image.Image) -> Image.Image:
+    """Bring a mask computed on _model_input(rgb) back to the size of `rgb`"""
+    if mask.size == rgb.size:
+        return mask
+    guide = np.asarray(rgb.convert("L"))
+    return masks.to_image(masks.guided_upsample(np.asarray(mask), guide, REMBG_GUIDE_RADIUS, REMBG_GUIDE_EPS))
+
+
+def _normalize(image: Image.Image, spec: dict) -> np.ndarray:
+    """CHW float32 model input, as rembg's BaseSession.normalize builds it"""
+    size = spec["size"]
+    array = np.asarray(image.resize((size, size), Image.LANCZOS), dtype=np.float32)
+    array /= max(float(array.max()), 1e-6)
+    array -= np.asarray(spec["mean"], dtype=np.float32)
+    array /= np.asarray(spec["std"], dtype=np.float32)
+    return array.transpose(2, 0, 1)
+
+
+def _to_mask(pred: np.ndarray, size: tuple) -> Image.Image:
+    """Min-max normalize one prediction to a uint8 mask of `size`, as rembg does"""
+    low, high = float(pred.min()), float(pred.max())
+    pred = (pred - low) / max(high - low, 1e-6)
+    return Image.fromarray((pred * 255).astype(np.uint8), mode="L").resize(size, Image.LANCZOS)
+
+
+def _accepts_batches(session) -> bool:
+    """
+    True when we know the model's preprocessing and its ONNX input has a dynamic batch
+    dimension. A fixed (int) one means the model was exported for single images.
+    """
+    batch_dim = session.inner_session.get_inputs()[0].shape[0]
+    return REMBG_MODEL in MODEL_SPECS and not isinstance(batch_dim, int)
+
+
+def _predict(session, images: list) -> list:
+    """Masks for model-sized `images`: one forward pass when the model takes batches"""
+    if len(images) == 1 or not _accepts_batches(session):
+        return [_as_mask(session.predict(image)[0]) for image in images]
+    spec = MODEL_SPECS[REMBG_MODEL]
+    batch = np.stack([_normalize(image, spec) for image in images])
+    model_input = session.inner_session.get_inputs()[0]
+    pred = session.inner_session.run(None, {model_input.name: batch})[0][:, 0]
+    return [_to_mask(pred[index], image.size) for index, image in enumerate(images)]
+
+
+def _segment(rgb: Image.Image) -> Image.Image:
+    small = _model_input(rgb)
+    with session_pool.session() as session:
+        mask = _predict(session, [small])[0]
+    return _upsample(mask, rgb)
+
+
+class SegmentationBatcher(MicroBatcher):
+    """
+    Groups segmentation calls arriving within `window_ms` into one batched forward pass.
+    Resizing and upsampling stay on the calling threads. Models with a fixed batch
+    dimension bypass the batcher, since it would only serialize their calls.
+    """
+    name = "rembg"
+    thread_name = "rembg-batcher"
+
+    def __init__(self, window_ms: float = REMBG_BATCH_WINDOW_MS, max_batch: int = REMBG_MAX_BATCH):
+        super().__init__(window_ms, max_batch)
+
+    def __call__(self, rgb: Image.Image) -> Image.Image:
+        if self.window <= 0 or self.max_batch == 1 or not session_pool.accepts_batches():
+            return _segment(rgb)
+        return _upsample(self.submit(_model_input(rgb)), rgb)
+
+    def _run_batch(self, images: list) -> list:
+        with session_pool.session() as session:
+            return _predict(session, images)
+
+
+segmentation_batcher = SegmentationBatcher()
+
+
+def after_fork():
+    """Reset locks, threads and sessions in a forked server process"""
+    session_pool.after_fork()
+    segmentation_batcher.after_fork()
+
+
+def stats() -> dict:
+    return {"model": REMBG_MODEL, "input_dim": _input_dim(), "pool": session_pool.stats(), "batching": segmentation_batcher.stats()}
+
+
+def get_mask(image: Image.Image, image_hash: str = None, batched: bool = False) -> Image.Image:
+    """
+    Soft foreground mask (mode "L", 255 = foreground) for `image`, cached by content.
+    `batched` lets the call share a forward pass with concurrent ones (batch jobs).
+    """
+    rgb = image if image.mode == "RGB" else image.convert("RGB")
+    key = image_hash or image_digest(rgb)
+
+    data = mask_cache.get(key)
+    if data is not None:
+        return Image.frombytes("L", rgb.size, data)
+
+    mask = segmentation_batcher(rgb) if batched else _segment(rgb)
+    mask_cache.put(key, mask.tobytes(), {"size": mask.size})
+    return mask
+
+
+def cutout(image: Image.Image, mask: Image.Image) -> Image.Image:
+    """Foreground on a transparent background (same as rembg's default cutout)"""
+    rgba = image if image.mode == "RGBA" else image.convert("RGBA")
+    return Image.composite(rgba, Image.new("RGBA", rgba.size, 0), mask)
+
+
+def replace_background(image: Image.Image, background: Image.Image, mask: Image.Image) -> Image.Image:
+    foreground = cutout(image, mask)
+    background = background.convert("RGBA")
+    if background.size != foreground.size:
+        background = background.resize(foreground.size, Image.LANCZOS)
+    return Image.alpha_composite(background, foreground)
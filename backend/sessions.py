@@ -0,0 +1,225 @@
+"""
+Server-side image sessions.
+
+A client uploads a photo once and refers to it by id afterwards. The decoded image is
+kept in memory together with its content hash and anything derived from it (resized
+copies, converted modes), so iterative edits neither re-upload nor re-decode the photo,
+and the rembg and inference caches are hit without rehashing it. Edits can be chained:
+a finished edit becomes the session's next version. Sessions are bounded by total size
+(LRU) and idle time.
+
+With several server processes the sessions are held by the shared state process
+(shared_state.py); each process keeps the versions it used, with their derived copies,
+in a local SessionStore of its own.
+"""
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+import shared_state
+from cache import image_digest
+
+SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_MB", "512")) * 1024 * 1024
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", "1800"))
+
+
+def _image_bytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+class SessionImage:
+    """One version of a session's image. Never modified, so jobs can hold on to it."""
+
+    def __init__(self, image: Image.Image, version: int, image_hash: str = None):
+        self.image = image
+        self.version = version
+        self.hash = image_hash or image_digest(image)
+        self.size = _image_bytes(image)
+        self._derived = {}
+        self._lock = threading.Lock()
+        # Set by the SessionStore holding this version, so derived copies count against its limit
+        self.on_grow = None
+
+    def derive(self, key, fn):
+        """Return `fn()` computed once per version and cached under `key`"""
+        with self._lock:
+            if key in self._derived:
+                return self._derived[key]
+        value = fn()
+        grew = False
+        with self._lock:
+            if key not in self._derived:
+                self._derived[key] = value
+                if isinstance(value, Image.Image):
+                    self.size += _image_bytes(value)
+                    grew = True
+            value = self._derived[key]
+        if grew and self.on_grow is not None:
+            self.on_grow()
+        return value
+
+    def __getstate__(self):
+        # Sent between processes without the derived copies, which are rebuilt on demand
+        return {"image": self.image, "version": self.version, "hash": self.hash}
+
+    def __setstate__(self, state):
+        self.__init__(state["image"], state["version"], state["hash"])
+
+    def convert(self, mode: str) -> Image.Image:
+        return self.image if self.image.mode == mode else self.derive(("mode", mode), lambda: self.image.convert(mode))
+
+    def info(self) -> dict:
+        w, h = self.image.size
+        return {"width": w, "height": h, "version": self.version}
+
+
+class SessionStore:
+    def __init__(self, max_bytes: int = SESSION_MAX_BYTES, ttl: int = SESSION_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._sessions = OrderedDict()  # session_id -> {"current": SessionImage, "touched": float}
+        self._lock = threading.RLock()
+
+    def create(self, image: Image.Image) -> tuple:
+        """Start a session for a decoded RGB image. Returns (session_id, SessionImage)."""
+        current = SessionImage(image, 1)
+        return self.insert(current), current
+
+    def insert(self, current: SessionImage, session_id: str = None) -> str:
+        """Store `current` as a session's image, under a new id unless `session_id` is given"""
+        session_id = session_id or uuid.uuid4().hex
+        current.on_grow = self._shrink
+        with self._lock:
+            self._sessions[session_id] = {"current": current, "touched": time.time()}
+            self._sessions.move_to_end(session_id)
+            self._evict()
+        return session_id
+
+    def get(self, session_id: str):
+        """The current SessionImage, or None if the session is unknown or expired"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if session["touched"] < time.time() - self.ttl:
+                self._drop(session_id)
+                return None
+            session["touched"] = time.time()
+            self._sessions.move_to_end(session_id)
+            return session["current"]
+
+    def version(self, session_id: str):
+        """Version of the session's current image (keeping the session alive), or None"""
+        current = self.get(session_id)
+        return current.version if current else None
+
+    def advance(self, session_id: str, image: Image.Image, base_version: int):
+        """
+        Make `image` (an edit of version `base_version`) the session's next version.
+        Returns the new SessionImage, or None if the session is gone or has moved on
+        since the edit started.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session["current"].version != base_version:
+                return None
+        advanced = SessionImage(image.convert("RGB"), base_version + 1)
+        return advanced if self.replace(session_id, advanced) else None
+
+    def replace(self, session_id: str, advanced: SessionImage) -> bool:
+        """Make `advanced` current if the session is still at the version before it"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session["current"].version != advanced.version - 1:
+                return False
+            advanced.on_grow = self._shrink
+            session["current"] = advanced
+            session["touched"] = time.time()
+            self._sessions.move_to_end(session_id)
+            self._evict()
+            return True
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._drop(session_id)
+
+    def _drop(self, session_id: str) -> bool:
+        return self._sessions.pop(session_id, None) is not None
+
+    def _shrink(self):
+        """A session image grew by a derived copy: evict down to the limit again"""
+        with self._lock:
+            self._evict()
+
+    def _total_bytes(self) -> int:
+        return sum(session["current"].size for session in self._sessions.values())
+
+    def _evict(self):
+        cutoff = time.time() - self.ttl
+        for session_id in [k for k, s in self._sessions.items() if s["touched"] < cutoff]:
+            self._drop(session_id)
+            self.evictions += 1
+        while len(self._sessions) > 1 and self._total_bytes() > self.max_bytes:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self._total_bytes(),
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+
+class SharedSessionStore:
+    """
+    Sessions held by the shared state process. Images cross over only when this process
+    has not seen the current version yet; hashing and conversions stay in this process.
+    """
+
+    def __init__(self, remote, local: SessionStore):
+        self.remote = remote
+        self.local = local
+
+    def create(self, image: Image.Image) -> tuple:
+        current = SessionImage(image, 1)
+        session_id = self.remote.insert(current)
+        self.local.insert(current, session_id)
+        return session_id, current
+
+    def get(self, session_id: str):
+        version = self.remote.version(session_id)
+        if version is None:
+            self.local.delete(session_id)
+            return None
+        current = self.local.get(session_id)
+        if current is None or current.version != version:
+            current = self.remote.get(session_id)
+            if current is None:
+                return None
+            self.local.insert(current, session_id)
+        return current
+
+    def advance(self, session_id: str, image: Image.Image, base_version: int):
+        advanced = SessionImage(image.convert("RGB"), base_version + 1)
+        if not self.remote.replace(session_id, advanced):
+            return None
+        self.local.insert(advanced, session_id)
+        return advanced
+
+    def delete(self, session_id: str) -> bool:
+        self.local.delete(session_id)
+        return self.remote.delete(session_id)
+
+    def stats(self) -> dict:
+        return self.remote.stats()
+
+
+image_sessions = SharedSessionStore(shared_state.remote("sessions"), SessionStore()) if shared_state.enabled() else SessionStore()
@@ -0,0 +1,72 @@
+"""
+Multi-process serving with model weights shared between the processes.
+
+Several server processes use all the cores of a CPU node, but each one loading its own
+LaMa and rembg models multiplies RAM by the process count. In shared mode the weights
+are loaded once in the parent process before the workers are forked (gunicorn with
+preload_app, see gunicorn.conf.py). The forked workers then map the same physical pages
+copy-on-write, and inference only reads weights, so the pages stay shared.
+
+Only CPU weights are shared: a CUDA context cannot be used across fork. Neither can an
+ONNX Runtime thread pool, so for ONNX models (rembg, LAMA_BACKEND=onnx) the parent only
+does the one-time work (download, conversion, parity check) with single-threaded
+sessions, and every worker reopens them with its own share of the cores; their weights
+are per worker. Torch's per-process thread count is applied again in each worker. All
+CPU shares are divided by WEB_CONCURRENCY as well as INFERENCE_WORKERS (cpu_threads) to
+avoid oversubscription.
+
+Job records, results, image sessions and the dedupe map are not per process either; they
+live in the shared state process (shared_state.py).
+"""
+import os
+import gc
+import time
+
+# Models loaded in the parent process: "lama", "rembg"
+SHARED_MODELS = [m.strip() for m in os.environ.get("SHARED_MODELS", "lama,rembg").split(",") if m.strip()]
+
+
+def preload():
+    """Load SHARED_MODELS in the parent process, before the workers are forked"""
+    import lama_backends
+    import segmentation
+    from model import inpainting_model
+
+    if inpainting_model.device != "cpu":
+        print("Shared model weights need CPU inference, every worker loads its own models.")
+        return
+
+    # No ONNX Runtime thread pools in the parent: their threads would be missing after
+    # fork. Only while preloading; the workers reopen those sessions with cpu_threads().
+    threads = lama_backends.ORT_INTRA_OP_THREADS, segmentation.REMBG_THREADS
+    lama_backends.ORT_INTRA_OP_THREADS = segmentation.REMBG_THREADS = 1
+
+    start_time = time.time()
+    try:
+        for model_id in SHARED_MODELS:
+            try:
+                if model_id == "rembg":
+                    segmentation.session_pool.fill()
+                else:
+                    inpainting_model.ensure_loaded(model_id)
+            except Exception as e:
+                print(f"Preloading {model_id} for the workers failed ({e}), workers load it themselves.")
+    finally:
+        lama_backends.ORT_INTRA_OP_THREADS, segmentation.REMBG_THREADS = threads
+    print(f"Preloaded {', '.join(SHARED_MODELS)} for the workers in {time.time() - start_time:.2f}s")
+
+    # Objects in the permanent generation are never touched by the collector, so it does
+    # not dirty (and copy) the shared pages in every worker
+    gc.freeze()
+
+
+def after_fork():
+    """Runs in every forked worker before it serves requests"""
+    import segmentation
+    from model import inpainting_model
+
+    inpainting_model.after_fork()
+    segmentation.after_fork()
+    if "lama" in inpainting_model.models:
+        from lama_backends import configure_torch_threads
+        print(f"Worker {os.getpid()}: using {configure_torch_threads()} CPU threads per inference")
@@ -0,0 +1,116 @@
+"""
+Job, session and dedupe state shared by several server processes.
+
+With more than one server process (gunicorn, WEB_CONCURRENCY > 1) any of them may get a
+client's next request, so state that outlives a request cannot stay inside a process:
+job records and results, the in-flight map that deduplicates identical jobs, the
+inference cache and image sessions. The gunicorn master starts a multiprocessing manager
+that holds them before it forks the workers (see gunicorn.conf.py), and every worker
+reaches them through a proxy. The model concurrency slots and the queue bound are
+process-shared semaphores created before the fork (see scheduler.py).
+
+A job still runs in the process that accepted it. A cancel arriving at another process
+only flags the shared record, and the owner passes it on to its scheduler. Per-process
+caches (decoded session images, rembg masks) stay local and are refilled on demand.
+
+Single-process serving (uvicorn, the default) keeps all of this in memory as before.
+`uvicorn --workers N` starts its processes without a common parent that could hold the
+state, so use gunicorn for more than one process.
+"""
+import os
+import signal
+import threading
+import multiprocessing
+from multiprocessing.managers import BaseManager, DictProxy
+
+# How often a process re-reads the shared job records it has listeners for (long-polls, events)
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_MS", "100")) / 1000.0
+
+_address = None
+_authkey = None
+_manager = None
+_objects = {}  # in the manager process: name -> hosted object
+
+
+def _hosted(name: str, factory):
+    def get():
+        if name not in _objects:
+            _objects[name] = factory()
+        return _objects[name]
+    return get
+
+
+def _jobs():
+    from store import JobStore, create_blob_store
+    return JobStore(create_blob_store())
+
+
+def _inference_store():
+    from store import create_blob_store
+    from cache import INFERENCE_CACHE, INFERENCE_CACHE_DIR, INFERENCE_CACHE_MAX_BYTES, INFERENCE_CACHE_TTL_SECONDS
+    return create_blob_store(INFERENCE_CACHE, INFERENCE_CACHE_DIR, max_bytes=INFERENCE_CACHE_MAX_BYTES, ttl=INFERENCE_CACHE_TTL_SECONDS)
+
+
+def _sessions():
+    from sessions import SessionStore
+    return SessionStore()
+
+
+class StateManager(BaseManager):
+    pass
+
+
+StateManager.register("jobs", _hosted("jobs", _jobs))
+StateManager.register("inference_store", _hosted("inference_store", _inference_store))
+StateManager.register("inflight", _hosted("inflight", dict), DictProxy)
+StateManager.register("sessions", _hosted("sessions", _sessions))
+
+
+def enabled() -> bool:
+    return _address is not None
+
+
+def start():
+    """Start the state process. Called in the gunicorn master, before the workers are forked."""
+    global _address, _authkey, _manager
+    if enabled():
+        return
+    _authkey = os.urandom(32)
+    # Ctrl-C reaches the whole process group; the master shuts the manager down on exit
+    _manager = StateManager(authkey=_authkey, ctx=multiprocessing.get_context("fork"))
+    _manager.start(initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+    _address = _manager.address
+    print(f"Shared job and session state served at {_address}")
+
+
+class Remote:
+    """
+    Proxy to a hosted object. Each process connects on first use, since a connection
+    inherited through fork would be shared with the parent.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._pid = None
+        self._proxy = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    manager = StateManager(address=_address, authkey=_authkey)
+                    manager.connect()
+                    self._proxy = getattr(manager, self._name)()
+                    self._pid = os.getpid()
+        return self._proxy
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __len__(self):
+        return len(self._get())
+
+
+def remote(name: str) -> Remote:
+    return Remote(name)
@@ -0,0 +1,416 @@
+"""
+Bounded job and result storage.
+
+Job records are small dicts kept in memory; result payloads live in a BlobStore that
+evicts by TTL and total size (LRU). The disk store keeps results as files so they can
+be served with FileResponse and survive a restart.
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+
+RESULT_STORE = os.environ.get("RESULT_STORE", "memory").lower()  # memory | disk
+RESULT_DIR = os.environ.get("RESULT_DIR", os.path.join(tempfile.gettempdir(), "cleanup-image-results"))
+RESULT_TTL_SECONDS = int(os.environ.get("RESULT_TTL_SECONDS", "3600"))
+RESULT_MAX_BYTES = int(os.environ.get("RESULT_MAX_MB", "512")) * 1024 * 1024
+SWEEP_INTERVAL_SECONDS = int(os.environ.get("SWEEP_INTERVAL_SECONDS", "60"))
+
+
+class BlobStore:
+    """LRU store of byte payloads bounded by total size and age"""
+
+    def __init__(self, max_bytes: int = RESULT_MAX_BYTES, ttl: int = RESULT_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.total_bytes = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> {"size", "created", "meta", ...}
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key: str, data: bytes, meta: dict = None):
+        with self._lock:
+            self.delete(key)
+            entry = self._write(key, data, meta or {})
+            self._entries[key] = entry
+            self.total_bytes += entry["size"]
+            self._evict()
+
+    def get(self, key: str):
+        """Return the payload bytes, or None if missing or expired"""
+        with self._lock:
+            entry = self._touch(key)
+            return self._read(key, entry) if entry else None
+
+    def path(self, key: str):
+        """Return a file path for the payload when it is stored on disk"""
+        return None
+
+    def meta(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry["meta"]) if entry else None
+
+    def delete(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self.total_bytes -= entry["size"]
+                self._remove(key, entry)
+
+    def sweep(self):
+        """Drop expired entries"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e["created"] < cutoff]:
+                self.delete(key)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+    def _touch(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["created"] < time.time() - self.ttl:
+            self.delete(key)
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            self.delete(key)
+            self.evictions += 1
+
+    # Backend hooks
+    def _write(self, key, data, meta):
+        raise NotImplementedError
+
+    def _read(self, key, entry):
+        raise NotImplementedError
+
+    def _remove(self, key, entry):
+        pass
+
+
+class MemoryBlobStore(BlobStore):
+    def _write(self, key, data, meta):
+        return {"data": bytes(data), "size": len(data), "created": time.time(), "meta": meta}
+
+    def _read(self, key, entry):
+        return entry["data"]
+
+
+class DiskBlobStore(BlobStore):
+    def __init__(self, directory: str = RESULT_DIR, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._load_existing()
+
+    def _file(self, key):
+        return os.path.join(self.directory, key)
+
+    def _load_existing(self):
+        # Pick up results written before a restart, oldest first so LRU order is preserved
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith((".json", ".tmp")) or not os.path.isfile(path):
+                continue
+            meta = {}
+            try:
+                with open(path + ".json") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                pass
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size, meta))
+        for created, name, size, meta in sorted(files):
+            self._entries[name] = {"size": size, "created": created, "meta": meta}
+            self.total_bytes += size
+        self.sweep()
+        self._evict()
+
+    def _write(self, key, data, meta):
+        path = self._file(key)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        with open(path + ".json", "w") as f:
+            json.dump(meta, f)
+        return {"size": len(data), "created": time.time(), "meta": meta}
+
+    def _read(self, key, entry):
+        try:
+            with open(self._file(key), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def path(self, key):
+        with self._lock:
+            return self._file(key) if self._touch(key) else None
+
+    def _remove(self, key, entry):
+        for path in (self._file(key), self._file(key) + ".json"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def create_blob_store(kind: str = RESULT_STORE, directory: str = RESULT_DIR, **kwargs) -> BlobStore:
+    if kind == "disk":
+        return DiskBlobStore(directory, **kwargs)
+    return MemoryBlobStore(**kwargs)
+
+
+TERMINAL_STATES = ("completed", "failed", "expired", "cancelled")
+PREVIEW_SUFFIX = ".preview"
+
+
+class JobStore:
+    """
+    Job records plus their result payloads. Listeners registered with subscribe() are
+    called with a snapshot of the record after every change.
+    Record structure: { "status": "queued" | "processing" | "completed" | "failed" | "expired" | "cancelled",
+                        "error": str | None, "metadata": dict, "media_type": str | None,
+                        "preview": media type of the published preview | None,
+                        "stage": "preview" | "refine" | None (two-pass jobs),
+                        "requesters": clients sharing the job (deduplicated requests),
+                        "cancel_requested": set by a cancel that reached another server process }
+    """
+
+    def __init__(self, results: BlobStore, ttl: int = RESULT_TTL_SECONDS, sweep_interval: int = SWEEP_INTERVAL_SECONDS):
+        self.results = results
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._jobs = {}
+        self._lock = threading.RLock()
+        self._sweeper = None
+        self._listeners = {}  # job_id -> set of callbacks
+
+    def create(self, job_id: str, status: str = "queued", metadata: dict = None):
+        with self._lock:
+            self._jobs[job_id] = {
+                "status": status,
+                "error": None,
+                "metadata": metadata or {},
+                "media_type": None,
+                "preview": None,
+                "stage": None,
+                "requesters": 1,
+                "updated": time.time(),
+            }
+            self._ensure_sweeper()
+
+    def update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            metadata = fields.pop("metadata", None)
+            if metadata:
+                job["metadata"].update(metadata)
+            job.update(fields)
+            job["updated"] = time.time()
+            self._notify(job_id, job)
+
+    def complete(self, job_id: str, data: bytes, media_type: str = "image/png", metadata: dict = None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            meta = dict(job["metadata"]) if job else {}
+            meta.update(metadata or {})
+            self.results.put(job_id, data, {"media_type": media_type, "metadata": meta})
+            if job is not None:
+                self.update(job_id, status="completed", media_type=media_type, metadata=metadata)
+
+    def put_preview(self, job_id: str, data: bytes, media_type: str = "image/jpeg"):
+        """Publish a preview of the result while the job is still running"""
+        with self._lock:
+            self.results.put(job_id + PREVIEW_SUFFIX, data, {"media_type": media_type})
+            self.update(job_id, preview=media_type)
+
+    def fail(self, job_id: str, error: str):
+        self.update(job_id, status="failed", error=error)
+
+    def attach(self, job_id: str) -> bool:
+        """
+        Add a requester to a job shared by identical requests. False when the job is
+        finished or every requester already cancelled it, so it cannot be joined.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] in TERMINAL_STATES or job["requesters"] <= 0:
+                return False
+            job["requesters"] += 1
+            return True
+
+    def detach(self, job_id: str) -> int:
+        """Remove one requester of a job; returns how many are still waiting for it"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return 0
+            job["requesters"] = max(0, job["requesters"] - 1)
+            return job["requesters"]
+
+    def cancel(self, job_id: str):
+        self.update(job_id, status="cancelled")
+
+    def delete(self, job_id: str):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self.results.delete(job_id)
+            self.results.delete(job_id + PREVIEW_SUFFIX)
+
+    def subscribe(self, job_id: str, callback):
+        """Call `callback(job_snapshot)` whenever the job changes. Must be cheap and non-blocking."""
+        with self._lock:
+            self._listeners.setdefault(job_id, set()).add(callback)
+
+    def unsubscribe(self, job_id: str, callback):
+        with self._lock:
+            listeners = self._listeners.get(job_id)
+            if listeners is not None:
+                listeners.discard(callback)
+                if not listeners:
+                    del self._listeners[job_id]
+
+    def _notify(self, job_id: str, job: dict):
+        snapshot = dict(job, metadata=dict(job["metadata"]))
+        for callback in list(self._listeners.get(job_id, ())):
+            try:
+                callback(snapshot)
+            except Exception as e:
+                print(f"Job listener for {job_id} failed: {e}")
+
+    def get(self, job_id: str):
+        """Return a copy of the job record, or None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                # Results persisted by a previous process (disk store)
+                meta = self.results.meta(job_id)
+                if meta is None:
+                    return None
+                job = {"status": "completed", "error": None, "metadata": meta.get("metadata", {}),
+                       "media_type": meta.get("media_type", "image/png"), "preview": None, "stage": None, "updated": time.time()}
+                self._jobs[job_id] = job
+            elif job["status"] == "completed" and job_id not in self.results:
+                job["status"] = "expired"
+            return dict(job, metadata=dict(job["metadata"]))
+
+    def result_path(self, job_id: str):
+        return self.results.path(job_id)
+
+    def result_bytes(self, job_id: str):
+        return self.results.get(job_id)
+
+    def preview_bytes(self, job_id: str):
+        return self.results.get(job_id + PREVIEW_SUFFIX)
+
+    def sweep(self):
+        self.results.sweep()
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for job_id in [k for k, j in self._jobs.items()
+                           if j["updated"] < cutoff and j["status"] not in ("queued", "processing")]:
+                self._jobs.pop(job_id, None)
+
+    def _ensure_sweeper(self):
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="result-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Result sweep failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"jobs": len(self._jobs), "results": self.results.stats()}
+
+
+class SharedJobStore:
+    """
+    A JobStore hosted by the shared state process (shared_state.py). Calls are forwarded
+    to it; listeners stay in this process and are called when a poll of their job sees
+    the record change, whichever process changed it.
+    """
+
+    def __init__(self, remote, poll_interval: float):
+        self.remote = remote
+        self.poll_interval = poll_interval
+        self._listeners = {}  # job_id -> set of callbacks
+        self._seen = {}  # job_id -> "updated" of the last record passed to the listeners
+        self._lock = threading.Lock()
+        self._poller = None
+        self._pid = None
+
+    def __getattr__(self, name):
+        return getattr(self.remote, name)
+
+    def subscribe(self, job_id: str, callback):
+        # Only later changes are passed on, as with JobStore
+        job = self.remote.get(job_id)
+        with self._lock:
+            self._listeners.setdefault(job_id, set()).add(callback)
+            self._seen.setdefault(job_id, job["updated"] if job else None)
+            # Started on first use, in the process that listens (a thread does not survive fork)
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._poller = threading.Thread(target=self._poll_loop, name="job-poller", daemon=True)
+                self._poller.start()
+
+    def unsubscribe(self, job_id: str, callback):
+        with self._lock:
+            listeners = self._listeners.get(job_id)
+            if listeners is not None:
+                listeners.discard(callback)
+                if not listeners:
+                    del self._listeners[job_id]
+                    self._seen.pop(job_id, None)
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                job_ids = list(self._listeners)
+            for job_id in job_ids:
+                try:
+                    job = self.remote.get(job_id)
+                except Exception as e:
+                    print(f"Polling job {job_id} failed: {e}")
+                    continue
+                with self._lock:
+                    if job is None or self._seen.get(job_id) == job["updated"] or job_id not in self._listeners:
+                        continue
+                    self._seen[job_id] = job["updated"]
+                    callbacks = list(self._listeners[job_id])
+                for callback in callbacks:
+                    try:
+                        callback(job)
+                    except Exception as e:
+                        print(f"Job listener for {job_id} failed: {e}")
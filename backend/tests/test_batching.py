@@ -0,0 +1,71 @@
+"""
+MicroBatcher grouping and its thread lifecycle.
+
+Run from backend/:  python -m pytest tests
+"""
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics  # noqa: E402
+from batching import MicroBatcher  # noqa: E402
+
+
+class Doubler(MicroBatcher):
+    name = "test"
+
+    def __init__(self, window_ms: float = 50, max_batch: int = 4):
+        super().__init__(window_ms, max_batch)
+        self.batches = []
+
+    def _run_batch(self, payloads: list) -> list:
+        self.batches.append(list(payloads))
+        return [2 * payload for payload in payloads]
+
+
+def submit_concurrently(batcher: MicroBatcher, payloads: list) -> list:
+    results = [None] * len(payloads)
+
+    def call(index):
+        results[index] = batcher.submit(payloads[index])
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(len(payloads))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    return results
+
+
+def test_concurrent_calls_share_a_batch():
+    batcher = Doubler(window_ms=200)
+    assert submit_concurrently(batcher, [1, 2, 3]) == [2, 4, 6]
+    assert sum(len(batch) for batch in batcher.batches) == 3
+    assert len(batcher.batches) < 3
+    batcher.stop()
+
+
+def test_submit_after_stop_starts_a_new_thread():
+    batcher = Doubler(window_ms=1)
+    assert batcher.submit(1) == 2
+    first = batcher._thread
+    batcher.stop()
+    first.join(timeout=5)
+    assert not first.is_alive()
+
+    result = []
+    caller = threading.Thread(target=lambda: result.append(batcher.submit(5)), daemon=True)
+    caller.start()
+    caller.join(timeout=5)
+    assert result == [10]
+    batcher.stop()
+
+
+def test_batch_sizes_are_exported():
+    batcher = Doubler(window_ms=1)
+    batcher.submit(1)
+    batcher.stop()
+    rendered = "\n".join(line for metric in metrics.REGISTRY for line in metric.render())
+    assert 'cleanup_batch_size_count{batcher="test"}' in rendered
@@ -0,0 +1,42 @@
+"""
+Inference cache lookups and deduplication of identical in-flight jobs (cache.py).
+
+Run from backend/:  python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import InferenceCache  # noqa: E402
+
+
+def test_identical_jobs_are_deduplicated_until_released():
+    cache = InferenceCache("memory")
+    assert cache.claim("key", "first") is None
+    assert cache.claim("key", "first") is None  # re-claiming its own key is not a duplicate
+    assert cache.claim("key", "second") == "first"
+    assert cache.claim("other", "third") is None
+    assert cache.stats()["deduplicated"] == 1
+    assert cache.stats()["in_flight"] == 2
+
+    # A finished or cancelled owner releases the key; the next identical job computes it
+    cache.release("key")
+    cache.release("key")
+    assert cache.claim("key", "second") is None
+
+
+def test_results_are_served_from_the_store():
+    cache = InferenceCache("memory")
+    assert cache.get("key") is None
+    cache.put("key", b"png", {"model_used": "lama"})
+    assert cache.get("key") == (b"png", {"model_used": "lama"})
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+def test_disabled_cache_stores_nothing():
+    cache = InferenceCache("off")
+    cache.put("key", b"png")
+    assert cache.get("key") is None
+    assert cache.stats()["store"] is None
@@ -0,0 +1,108 @@
+"""
+Mask preprocessing (masks.py) and how /inpaint binarizes uploaded masks.
+
+Run from backend/:  python -m pytest tests
+"""
+import os
+import sys
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MODEL_WARMUP", "")
+os.environ.setdefault("INFERENCE_CACHE", "off")
+
+pytest.importorskip("cv2")
+
+import masks  # noqa: E402
+from cache import mask_digest  # noqa: E402
+from metrics import StageTimer  # noqa: E402
+
+
+def png(array: np.ndarray) -> BytesIO:
+    buffer = BytesIO()
+    Image.fromarray(array).save(buffer, format="PNG")
+    return buffer
+
+
+def brush_stroke() -> np.ndarray:
+    """A stroke with an anti-aliased rim, as a browser canvas draws it"""
+    mask = np.zeros((40, 60), dtype=np.uint8)
+    mask[10:30, 20:40] = 255
+    mask[9, 20:40] = mask[30, 20:40] = 64
+    mask[10:30, 19] = mask[10:30, 40] = 32
+    return mask
+
+
+def test_same_size_mask_keeps_antialiased_edges():
+    pytest.importorskip("fastapi")
+    import main
+
+    stroke = brush_stroke()
+    prepared = np.asarray(main._prepare_mask(png(stroke), (60, 40), StageTimer("test")))
+    np.testing.assert_array_equal(prepared > 0, stroke > 0)
+    # The cache key of the uploaded mask is the key of the mask that runs
+    assert mask_digest(Image.fromarray(stroke)) == mask_digest(Image.fromarray(prepared))
+
+
+def test_resized_mask_thresholds_at_mid_gray():
+    pytest.importorskip("fastapi")
+    import main
+
+    small = np.zeros((20, 30), dtype=np.uint8)
+    small[5:15, 10:20] = 255
+    small[4, 10:20] = 100  # below mid-gray: dropped once blurred by the resize
+    prepared = np.asarray(main._prepare_mask(png(small), (60, 40), StageTimer("test")))
+    assert set(np.unique(prepared)) <= {0, 255}
+    assert prepared[20, 30] == 255
+    # Rows 7-8 come out of the resize at 25 and 75: blurred, not drawn
+    assert not prepared[:9].any() and prepared[9].any()
+
+
+def square(size: int = 40, box: tuple = (10, 10, 30, 30)) -> np.ndarray:
+    mask = np.zeros((size, size), dtype=np.uint8)
+    x0, y0, x1, y1 = box
+    mask[y0:y1, x0:x1] = 255
+    return mask
+
+
+def test_prepare_thresholds_and_resizes():
+    mask = square()
+    mask[0, 0] = 100
+    binary = masks.prepare(mask)
+    assert binary[0, 0] == 0 and binary[20, 20] == 255
+    assert masks.prepare(mask, threshold=masks.MODEL_THRESHOLD)[0, 0] == 255
+    resized = masks.prepare(mask, size=(80, 60))
+    assert resized.shape == (60, 80) and set(np.unique(resized)) == {0, 255}
+
+
+def test_prepare_grows_and_shrinks():
+    mask = square()
+    assert np.count_nonzero(masks.prepare(mask, dilate_px=2)) > np.count_nonzero(mask)
+    assert np.count_nonzero(masks.prepare(mask, erode_px=2)) < np.count_nonzero(mask)
+    # Eroding first removes what dilating could not bring back
+    speck = square(box=(2, 2, 4, 4)) | mask
+    assert not masks.prepare(speck, erode_px=2, dilate_px=2)[2:4, 2:4].any()
+
+
+def test_prepare_fills_holes_and_drops_specks():
+    ring = square()
+    ring[15:25, 15:25] = 0
+    assert not masks.prepare(ring)[20, 20]
+    assert masks.prepare(ring, fill=True)[20, 20] == 255
+
+    specks = square()
+    specks[2, 2] = specks[36, 36] = 255
+    cleaned = masks.prepare(specks, min_area=4)
+    assert not cleaned[2, 2] and not cleaned[36, 36] and cleaned[20, 20] == 255
+
+
+def test_prepare_inverts_after_thresholding():
+    mask = square()
+    mask[0, 0] = 100  # below the threshold: becomes part of the inverted mask
+    inverted = masks.prepare(mask, inverted=True)
+    assert inverted[0, 0] == 255 and inverted[20, 20] == 0
+    np.testing.assert_array_equal(inverted, 255 - masks.prepare(mask))
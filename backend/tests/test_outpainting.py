@@ -0,0 +1,41 @@
+"""
+Band and window layout for border-strip outpainting (outpainting.py).
+
+Run from backend/:  python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from outpainting import band_boxes  # noqa: E402
+
+
+def test_single_side_band_includes_context():
+    assert band_boxes((100, 80), 0, 30, 0, 0, context=16, chunk=1024, overlap=32) == [(84, 0, 130, 80)]
+    assert band_boxes((100, 80), 30, 0, 0, 0, context=16, chunk=1024, overlap=32) == [(0, 0, 46, 80)]
+
+
+def test_context_is_clamped_to_the_canvas():
+    assert band_boxes((10, 80), 20, 0, 0, 0, context=64, chunk=1024, overlap=32) == [(0, 0, 30, 80)]
+    assert band_boxes((100, 10), 0, 0, 0, 20, context=64, chunk=1024, overlap=32) == [(0, 0, 100, 30)]
+
+
+def test_side_bands_come_before_full_width_bands():
+    boxes = band_boxes((100, 80), 10, 10, 20, 20, context=8, chunk=1024, overlap=32)
+    assert boxes == [
+        (0, 20, 18, 100),      # left, beside the original rows only
+        (102, 20, 120, 100),   # right
+        (0, 0, 120, 28),       # top, across the corners
+        (0, 92, 120, 120),     # bottom
+    ]
+
+
+def test_long_edges_are_split_into_overlapping_windows():
+    boxes = band_boxes((250, 40), 0, 0, 0, 10, context=8, chunk=100, overlap=20)
+    spans = [(x0, x1) for x0, _, x1, _ in boxes]
+    assert spans == [(0, 100), (80, 180), (150, 250)]
+    assert all(x1 - x0 == 100 for x0, x1 in spans)
+    # Consecutive windows overlap by at least `overlap` and together cover the edge
+    assert all(a[1] - b[0] >= 20 for a, b in zip(spans, spans[1:]))
+    assert {(y0, y1) for _, y0, _, y1 in boxes} == {(32, 50)}
@@ -0,0 +1,70 @@
+"""
+Region planning and feathered pasting for region-of-interest inpainting (roi.py).
+
+Run from backend/:  python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("cv2")
+
+import roi  # noqa: E402
+
+
+def mask_with(*boxes, size: tuple = (200, 200)) -> np.ndarray:
+    w, h = size
+    mask = np.zeros((h, w), dtype=np.uint8)
+    for x0, y0, x1, y1 in boxes:
+        mask[y0:y1, x0:x1] = 255
+    return mask
+
+
+def test_plan_regions_adds_clamped_margin():
+    mask = mask_with((5, 20, 15, 30), (150, 150, 160, 160))
+    assert roi.plan_regions(mask, (200, 200), margin=10) == [(0, 10, 25, 40), (140, 140, 170, 170)]
+
+
+def test_plan_regions_merges_overlapping_crops():
+    mask = mask_with((20, 20, 30, 30), (45, 20, 55, 30))
+    assert roi.plan_regions(mask, (200, 200), margin=10) == [(10, 10, 65, 40)]
+
+
+def test_plan_regions_falls_back_to_full_frame():
+    mask = mask_with((20, 20, 180, 180))
+    assert roi.plan_regions(mask, (200, 200), margin=10) is None
+    assert roi.plan_regions(mask_with(), (200, 200)) == []
+
+
+def test_plan_regions_boxes_are_plain_ints():
+    boxes = roi.plan_regions(mask_with((20, 20, 30, 30)), (200, 200), margin=4)
+    assert all(type(v) is int for box in boxes for v in box)
+
+
+def test_paste_patch_blends_only_inside_the_feather():
+    target = np.full((20, 20, 3), 100, dtype=np.uint8)
+    patch = np.full((10, 10, 3), 200, dtype=np.uint8)
+    alpha = np.zeros((10, 10), dtype=np.float32)
+    alpha[2:8, 2:8] = 1.0
+    alpha[1, 2:8] = 0.5
+
+    roi.paste_patch(target, patch, alpha, (5, 5, 15, 15))
+    assert (target[7:13, 7:13] == 200).all()
+    assert (target[6, 7:13] == 150).all()
+    untouched = np.ones((20, 20), dtype=bool)
+    untouched[7:13, 7:13] = untouched[6, 7:13] = False
+    assert (target[untouched] == 100).all()
+
+
+def test_paste_patch_with_feather_alpha_keeps_far_pixels():
+    mask = np.zeros((30, 30), dtype=np.uint8)
+    mask[10:20, 10:20] = 255
+    alpha = roi.feather_alpha(mask, feather=3)
+    target = np.zeros((30, 30, 3), dtype=np.uint8)
+    roi.paste_patch(target, np.full((30, 30, 3), 255, dtype=np.uint8), alpha, (0, 0, 30, 30))
+    assert (target[10:20, 10:20] == 255).all()
+    assert not target[:6].any() and not target[:, :6].any()
@@ -0,0 +1,113 @@
+"""
+JobScheduler priorities, queue bound, per-model limits and cancellation.
+
+Run from backend/:  python -m pytest tests
+"""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import JobScheduler, QueueFullError  # noqa: E402
+
+
+class Blocker:
+    """A job that holds its worker until released"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.started.set()
+        assert self.release.wait(5)
+
+
+def occupy(scheduler: JobScheduler, job_id: str = "blocker", model_id: str = "lama") -> Blocker:
+    blocker = Blocker()
+    scheduler.submit(job_id, blocker, model_id=model_id)
+    assert blocker.started.wait(5)
+    return blocker
+
+
+def test_higher_priority_runs_first():
+    scheduler = JobScheduler(workers=1)
+    blocker = occupy(scheduler)
+    order = []
+    done = threading.Event()
+    scheduler.submit("low", order.append, "low")
+    scheduler.submit("high", order.append, "high", priority=5)
+    scheduler.submit("last", lambda: (order.append("last"), done.set()))
+    assert scheduler.position("high") == 1 and scheduler.position("low") == 2
+    blocker.release.set()
+    assert done.wait(5)
+    assert order == ["high", "low", "last"]
+
+
+def test_full_queue_rejects_new_jobs():
+    scheduler = JobScheduler(workers=1, max_queue=1)
+    blocker = occupy(scheduler)
+    scheduler.submit("waiting", lambda: None)
+    with pytest.raises(QueueFullError):
+        scheduler.submit("rejected", lambda: None)
+    assert scheduler.stats()["queued"] == 1
+    blocker.release.set()
+
+
+def test_cancelled_queued_job_never_runs():
+    scheduler = JobScheduler(workers=1)
+    blocker = occupy(scheduler)
+    ran, cancelled, done = [], [], threading.Event()
+    scheduler.submit("victim", ran.append, "victim", on_cancel=lambda: cancelled.append("victim"))
+    scheduler.submit("after", done.set)
+
+    assert scheduler.cancel("victim") == "dequeued"
+    assert cancelled == ["victim"] and scheduler.position("victim") is None
+    blocker.release.set()
+    assert done.wait(5)
+    assert ran == []
+    assert scheduler.stats()["cancellations"] == 1
+
+
+def test_running_job_stops_at_its_checkpoint():
+    scheduler = JobScheduler(workers=1)
+    started, stopped = threading.Event(), threading.Event()
+
+    def job():
+        started.set()
+        try:
+            while True:
+                scheduler.check_cancelled("running")
+                threading.Event().wait(0.01)
+        finally:
+            stopped.set()
+
+    scheduler.submit("running", job)
+    assert started.wait(5)
+    assert scheduler.cancel("running") == "cancelling"
+    assert scheduler.cancel("running") == "cancelling"  # counted once
+    assert stopped.wait(5)
+
+    # The worker is free again, and has forgotten the cancelled job
+    done = threading.Event()
+    scheduler.submit("next", done.set)
+    assert done.wait(5)
+    assert scheduler.cancel("running") is None
+    assert scheduler.cancel("unknown") is None
+    assert scheduler.stats()["cancellations"] == 1
+
+
+def test_busy_model_does_not_block_other_models():
+    scheduler = JobScheduler(workers=2, model_limits={"sdxl": 1})
+    blocker = occupy(scheduler, model_id="sdxl")
+    sdxl_ran, lama_done = threading.Event(), threading.Event()
+    scheduler.submit("sdxl-2", sdxl_ran.set, model_id="sdxl")
+    scheduler.submit("lama", lama_done.set, model_id="lama")
+
+    assert lama_done.wait(5)
+    assert not sdxl_ran.is_set() and scheduler.position("sdxl-2") == 1
+    blocker.release.set()
+    assert sdxl_ran.wait(5)
@@ -0,0 +1,39 @@
+"""
+Image session bookkeeping (sessions.py): versions and the byte limit.
+
+Run from backend/:  python -m pytest tests
+"""
+import os
+import sys
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sessions import SessionStore  # noqa: E402
+
+
+def image(color: int) -> Image.Image:
+    return Image.new("RGB", (100, 100), (color, color, color))  # 30000 bytes
+
+
+def test_advance_needs_the_current_version():
+    store = SessionStore()
+    session_id, first = store.create(image(1))
+    assert store.advance(session_id, image(2), first.version).version == 2
+    assert store.advance(session_id, image(3), first.version) is None
+    assert store.get(session_id).version == 2
+
+
+def test_derived_copies_count_against_the_limit():
+    store = SessionStore(max_bytes=70000)
+    old_id, _ = store.create(image(1))
+    new_id, current = store.create(image(2))
+    assert store.stats()["bytes"] == 60000
+
+    current.convert("L")  # +10000, still fits
+    assert store.stats()["sessions"] == 2
+    current.derive(("resize", 80, 80), lambda: current.image.resize((80, 80)))  # +19200
+    assert store.stats()["bytes"] <= store.max_bytes
+    assert store.get(old_id) is None
+    assert store.get(new_id) is current
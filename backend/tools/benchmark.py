@@ -0,0 +1,449 @@
+"""
+Benchmark harness for the model paths and HTTP endpoints.
+
+Generates synthetic photos and masks at several resolutions and mask coverages, then
+measures them through
+  direct   ModelManager.process (decode, inference and PNG encode timed separately)
+  inpaint  POST /inpaint, long-poll /jobs/{id}, GET /results/{id}
+  batch    POST /batch-inpaint, reading the whole streamed ZIP
+  outpaint POST /outpaint, long-poll /jobs/{id}, GET /results/{id}
+  rembg    POST /remove-background, /auto-mask and /detect-objects
+with a configurable number of concurrent clients. Every scenario reports p50/p95/p99
+latency, images/sec, per-stage timing and peak RSS as JSON, so runs can be diffed
+across commits.
+
+The HTTP paths run in-process through an ASGI transport unless --url points at a running
+server (peak RSS then describes the client only). Without LaMa weights or the rembg
+model on disk, cheap stand-ins are used (--stub auto), so the suite runs offline on CPU;
+stubbed results measure everything except the networks themselves. Without torch the
+LaMa stand-in works on PIL images and skips the LaMa batcher.
+
+Usage (from backend/):
+    python tools/benchmark.py [--paths direct,inpaint] [--sizes 512,1024] [--coverages 0.05,0.25]
+                              [--concurrency 1,4] [--requests 8] [--output result.json]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import contextlib
+import resource
+import subprocess
+import importlib.util
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+PATHS = ("direct", "inpaint", "batch", "outpaint", "rembg")
+REMBG_ENDPOINTS = ("/remove-background", "/auto-mask", "/detect-objects")
+
+
+def log(message: str):
+    print(message, file=sys.stderr, flush=True)
+
+
+# ---- Synthetic inputs ----
+
+def synthetic_image(width: int, height: int, seed: int) -> np.ndarray:
+    """A photo-like RGB image: sky/ground gradients, a few solid objects and sensor noise"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    sky = np.stack([90 + 60 * yy / height, 140 + 40 * yy / height, 220 - 30 * xx / width], axis=-1)
+    ground = np.stack([70 + 40 * xx / width, 110 - 20 * yy / height, 40 + 10 * xx / width], axis=-1)
+    image = np.where((yy < height * rng.uniform(0.4, 0.6))[..., None], sky, ground)
+    for _ in range(6):
+        x0, y0 = rng.integers(0, width - width // 8), rng.integers(0, height - height // 8)
+        w, h = rng.integers(width // 16, width // 4), rng.integers(height // 16, height // 4)
+        image[y0:y0 + h, x0:x0 + w] = rng.integers(0, 256, 3)
+    image += rng.normal(0, 6, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def synthetic_mask(width: int, height: int, coverage: float, seed: int) -> np.ndarray:
+    """Elliptical blobs added until roughly `coverage` of the pixels are masked"""
+    rng = np.random.default_rng(seed + 1_000_003)
+    mask = np.zeros((height, width), dtype=bool)
+    yy, xx = np.ogrid[0:height, 0:width]
+    while mask.mean() < coverage:
+        cy, cx = rng.integers(0, height), rng.integers(0, width)
+        ry = rng.integers(max(2, height // 40), max(3, height // 6))
+        rx = rng.integers(max(2, width // 40), max(3, width // 6))
+        mask |= ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1
+    return mask.astype(np.uint8) * 255
+
+
+def encode_png(array: np.ndarray) -> bytes:
+    output = BytesIO()
+    Image.fromarray(array).save(output, format="PNG")
+    return output.getvalue()
+
+
+def make_cases(size: int, coverage: float, count: int) -> list:
+    """`count` distinct (image_png, mask_png) pairs, size = longest side (4:3 landscape)"""
+    width, height = size, size * 3 // 4
+    return [(encode_png(synthetic_image(width, height, seed)), encode_png(synthetic_mask(width, height, coverage, seed)))
+            for seed in range(count)]
+
+
+# ---- Stand-ins for unavailable models ----
+
+def lama_weights_available() -> bool:
+    if os.environ.get("LAMA_MODEL"):
+        return os.path.exists(os.environ["LAMA_MODEL"])
+    try:
+        from torch.hub import get_dir
+        return os.path.exists(os.path.join(get_dir(), "checkpoints", "big-lama.pt"))
+    except ImportError:
+        return False
+
+
+def rembg_available() -> bool:
+    if importlib.util.find_spec("rembg") is None or importlib.util.find_spec("onnxruntime") is None:
+        return False
+    from segmentation import REMBG_MODEL
+    from rembg.sessions import sessions_class
+    session_class = next((sc for sc in sessions_class if sc.name() == REMBG_MODEL), None)
+    return session_class is not None and session_class.resolve_existing(f"{REMBG_MODEL}.onnx") is not None
+
+
+class StubLamaModule:
+    """Stands in for the LaMa network: fills the hole with a blurred copy of the image"""
+
+    def __call__(self, image, mask):
+        import torch.nn.functional as F
+
+        mask = mask.float()
+        blurred = F.avg_pool2d(image, 15, stride=1, padding=7, count_include_pad=False)
+        return image * (1 - mask) + blurred * mask
+
+
+class StubLamaImage:
+    """
+    The LaMa stand-in without torch: PIL images in and out, so the LaMa batcher and the
+    eager TorchScript plumbing are not exercised
+    """
+
+    def __call__(self, image, mask):
+        image = image.convert("RGB")
+        hole = mask.convert("L").point(lambda v: 255 if v > 0 else 0)
+        return Image.composite(image.filter(ImageFilter.BoxBlur(7)), image, hole)
+
+
+def torch_available() -> bool:
+    return importlib.util.find_spec("torch") is not None and importlib.util.find_spec("simple_lama_inpainting") is not None
+
+
+def install_stubs(lama: bool, rembg: bool):
+    if lama and not torch_available():
+        from model import inpainting_model
+
+        def load_stub():
+            inpainting_model.models["lama"] = StubLamaImage()
+            inpainting_model.lama_backend = {"backend": "stub"}
+
+        log("torch is not installed, using the image-level LaMa stand-in without batching")
+        os.environ["FORCE_CPU"] = "true"
+        inpainting_model._loaders["lama"] = load_stub
+    elif lama:
+        import torch
+        import simple_lama_inpainting
+        from lama_backends import LamaRunner
+
+        class StubLama(LamaRunner):
+            def __init__(self, device=None):
+                super().__init__(StubLamaModule(), torch.device("cpu"), "stub")
+
+        simple_lama_inpainting.SimpleLama = StubLama
+        os.environ["LAMA_BACKEND"] = "eager"
+    if rembg:
+        import segmentation
+
+        def predict(session, images):
+            """Stands in for the rembg model: pixels brighter than the image mean are foreground"""
+            masks = []
+            for image in images:
+                gray = np.asarray(image.convert("L"), dtype=np.float32)
+                masks.append(Image.fromarray(((gray > gray.mean()) * 255).astype(np.uint8)))
+            return masks
+
+        # The session pool, downscaling, guided upsampling and batching stay real
+        segmentation._new_session = lambda threads: object()
+        segmentation._accepts_batches = lambda session: True
+        segmentation._predict = predict
+
+
+# ---- Measurement ----
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    ms = np.asarray(values) * 1000.0
+    return {"p50": round(float(np.percentile(ms, 50)), 2), "p95": round(float(np.percentile(ms, 95)), 2),
+            "p99": round(float(np.percentile(ms, 99)), 2), "mean": round(float(ms.mean()), 2)}
+
+
+def summarize(samples: list, wall: float, images: int) -> dict:
+    """`samples` holds one dict of stage -> seconds per request, with "total", or {"error": str}"""
+    ok = [s for s in samples if "error" not in s]
+    stages = sorted({k for s in ok for k in s if k != "total"})
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "error_examples": sorted({s["error"] for s in samples if "error" in s})[:3],
+        "latency_ms": percentiles([s["total"] for s in ok]),
+        "images_per_sec": round(images / wall, 3) if wall > 0 else None,
+        "wall_seconds": round(wall, 3),
+        "stages_ms": {stage: percentiles([s[stage] for s in ok if stage in s]) for stage in stages},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+class Timer:
+    def __init__(self):
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    def mark(self, stage: str, since: float) -> float:
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - since
+        return now
+
+    def done(self) -> dict:
+        return dict(self.stages, total=time.perf_counter() - self.started)
+
+
+def bench_direct(cases: list, concurrency: int) -> dict:
+    from model import inpainting_model
+
+    def run(case):
+        image_data, mask_data = case
+        timer = Timer()
+        try:
+            t = timer.started
+            image = Image.open(BytesIO(image_data)).convert("RGB")
+            mask = Image.open(BytesIO(mask_data)).convert("L")
+            t = timer.mark("decode", t)
+            result, _ = inpainting_model.process(image, mask)
+            t = timer.mark("inference", t)
+            output = BytesIO()
+            result.save(output, format="PNG")
+            timer.mark("encode", t)
+            return timer.done()
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(run, cases))
+    return summarize(samples, time.perf_counter() - started, len(cases))
+
+
+async def _run_clients(requests: list, concurrency: int, send) -> tuple:
+    """Run `send(request)` for every request with `concurrency` clients; returns (samples, wall)"""
+    queue = asyncio.Queue()
+    for request in requests:
+        queue.put_nowait(request)
+    samples = []
+
+    async def client():
+        while not queue.empty():
+            request = queue.get_nowait()
+            try:
+                samples.append(await send(request))
+            except Exception as e:
+                samples.append({"error": f"{type(e).__name__}: {e}"})
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return samples, time.perf_counter() - started
+
+
+def _files(**named) -> list:
+    return [(field, (f"{field}.png", data, "image/png")) for field, data in named.items()]
+
+
+async def http_job(client, url: str, params: dict = None, **files) -> dict:
+    """Submit a job, long-poll it and download the result"""
+    timer = Timer()
+    t = timer.started
+    response = await client.post(url, params=params, files=_files(**files))
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    t = timer.mark("submit", t)
+    while True:
+        job = (await client.get(f"/jobs/{job_id}", params={"wait": 30})).json()
+        if job["status"] in ("completed", "failed", "expired", "cancelled"):
+            break
+    if job["status"] != "completed":
+        raise RuntimeError(f"job {job['status']}: {job.get('error')}")
+    t = timer.mark("wait", t)
+    (await client.get(f"/results/{job_id}")).raise_for_status()
+    timer.mark("download", t)
+    return timer.done()
+
+
+async def http_post(client, url: str, params: dict = None, **files) -> dict:
+    timer = Timer()
+    response = await client.post(url, params=params, files=_files(**files))
+    response.raise_for_status()
+    return timer.done()
+
+
+async def http_batch(client, cases: list, quality: str) -> dict:
+    timer = Timer()
+    files = [("images", (f"image_{i}.png", image_data, "image/png")) for i, (image_data, _) in enumerate(cases)]
+    async with client.stream("POST", "/batch-inpaint", params={"quality": quality}, files=files) as response:
+        response.raise_for_status()
+        t = timer.started
+        first = True
+        async for _ in response.aiter_bytes():
+            if first:
+                t = timer.mark("first_byte", t)
+                first = False
+        timer.mark("stream", t)
+    return timer.done()
+
+
+async def bench_http(path: str, client, cases: list, concurrency: int, args) -> dict:
+    if path == "inpaint":
+        samples, wall = await _run_clients(cases, concurrency, lambda case: http_job(client, "/inpaint", {"quality": args.quality}, image=case[0], mask=case[1]))
+        return summarize(samples, wall, len(cases))
+    if path == "outpaint":
+        w, h = Image.open(BytesIO(cases[0][0])).size
+        params = {"extend_left": min(500, w // 8), "extend_right": min(500, w // 8), "quality": args.quality}
+        samples, wall = await _run_clients(cases, concurrency, lambda case: http_job(client, "/outpaint", params, image=case[0]))
+        return summarize(samples, wall, len(cases))
+    if path == "batch":
+        groups = [cases[i:i + args.batch_size] for i in range(0, len(cases), args.batch_size)]
+        samples, wall = await _run_clients(groups, concurrency, lambda group: http_batch(client, group, args.quality))
+        return summarize(samples, wall, len(cases))
+    if path == "rembg":
+        results = {}
+        for endpoint in REMBG_ENDPOINTS:
+            samples, wall = await _run_clients(cases, concurrency, lambda case: http_post(client, endpoint, image=case[0]))
+            results[endpoint] = summarize(samples, wall, len(cases))
+        return results
+    raise ValueError(f"Unknown path {path}")
+
+
+def scenarios(path: str, sizes: list, coverages: list, concurrencies: list):
+    # Only the inpainting paths take a mask; the others run once per size
+    for size in sizes:
+        for coverage in (coverages if path in ("direct", "inpaint") else [None]):
+            for concurrency in concurrencies:
+                yield size, coverage, concurrency
+
+
+async def run(args) -> list:
+    import httpx
+
+    paths = [p.strip() for p in args.paths.split(",") if p.strip()]
+    sizes = [int(s) for s in args.sizes.split(",")]
+    coverages = [float(c) for c in args.coverages.split(",")]
+    concurrencies = [int(c) for c in args.concurrency.split(",")]
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+    else:
+        import main
+        log("Loading and warming up LaMa...")
+        await asyncio.to_thread(main.inpainting_model.warmup, "lama")
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://benchmark", timeout=args.timeout)
+
+    results = []
+    async with client:
+        cache = {}
+        for path in paths:
+            for size, coverage, concurrency in scenarios(path, sizes, coverages, concurrencies):
+                key = (size, coverage if coverage is not None else coverages[0])
+                if key not in cache:
+                    log(f"Generating {args.requests} inputs at {size}px, coverage {key[1]}...")
+                    cache = {key: await asyncio.to_thread(make_cases, size, key[1], args.requests)}
+                cases = cache[key]
+                log(f"{path}: size={size} coverage={coverage} concurrency={concurrency}")
+                if path == "direct":
+                    if args.url:
+                        log("  skipped: the direct path needs an in-process model")
+                        continue
+                    summary = await asyncio.to_thread(bench_direct, cases, concurrency)
+                else:
+                    summary = await bench_http(path, client, cases, concurrency, args)
+                results.append({"path": path, "size": size, "coverage": coverage, "concurrency": concurrency,
+                                "result": summary})
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--paths", default=",".join(PATHS), help="Comma separated: " + ", ".join(PATHS))
+    parser.add_argument("--sizes", default="512,1024,2048", help="Longest image side in pixels")
+    parser.add_argument("--coverages", default="0.02,0.1,0.3", help="Fraction of masked pixels")
+    parser.add_argument("--concurrency", default="1,4", help="Concurrent clients")
+    parser.add_argument("--requests", type=int, default=8, help="Requests per scenario")
+    parser.add_argument("--batch-size", type=int, default=4, help="Images per /batch-inpaint request")
+    parser.add_argument("--quality", default="high", help="Quality preset for /inpaint, /outpaint and /batch-inpaint")
+    parser.add_argument("--stub", choices=("auto", "always", "never"), default="auto",
+                        help="Use stand-in models (auto: only when weights are not on disk)")
+    parser.add_argument("--url", help="Benchmark a running server instead of the in-process app")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    # Repeated inputs must not be answered from the result cache
+    os.environ.setdefault("INFERENCE_CACHE", "off")
+    stubs = {"lama": args.stub == "always" or (args.stub == "auto" and not lama_weights_available()),
+             "rembg": args.stub == "always" or (args.stub == "auto" and not rembg_available())}
+    if not args.url:
+        install_stubs(**stubs)
+
+    # Server and model log output goes to stderr so stdout stays valid JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.run(run(args))
+
+    try:
+        import torch
+        torch_version = torch.__version__
+    except ImportError:
+        torch_version = None
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "platform": {"python": platform.python_version(), "torch": torch_version, "cpus": os.cpu_count()},
+        "stubs": stubs if not args.url else None,
+        "target": args.url or "in-process",
+        "config": {k: v for k, v in vars(args).items() if k not in ("output",)},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+        log(f"Wrote {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
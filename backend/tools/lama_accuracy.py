@@ -0,0 +1,82 @@
+"""
+Compare LaMa CPU configurations for accuracy and latency.
+
+Every configuration is loaded through lama_backends.load_lama (so converted artifacts are
+cached as in production) and measured against the fp32 eager model: PSNR over the masked
+pixels of the fixed test set, and median latency of a single inference. Prints JSON.
+
+Usage (from backend/):
+    python tools/lama_accuracy.py [--configs eager,onnx,onnx+dynamic] [--size 512] [--runs 5]
+A configuration is a backend name plus optional "+dynamic", "+static" or "+channels_last".
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lama_backends  # noqa: E402
+
+DEFAULT_CONFIGS = "eager,eager+channels_last,torchscript,torchscript+channels_last,onnx,onnx+dynamic,onnx+static"
+
+
+def parse_config(spec: str) -> dict:
+    backend, *options = spec.split("+")
+    quantize = next((o for o in options if o in ("dynamic", "static")), "off")
+    return {"backend": backend, "quantize": quantize, "channels_last": "channels_last" in options}
+
+
+def latency(model, size: int, runs: int) -> float:
+    image, mask = lama_backends.test_set(size)[0]
+    model(image, mask)  # warm-up
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        model(image, mask)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", default=DEFAULT_CONFIGS)
+    parser.add_argument("--size", type=int, default=512, help="Image size for the latency measurement")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    import torch
+
+    # Loading/conversion messages go to stderr so stdout stays valid JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        results, threads = measure(torch.device("cpu"), args)
+
+    print(json.dumps({"threads": threads, "size": args.size, "min_psnr_db": lama_backends.LAMA_MIN_PSNR,
+                      "results": results}, indent=2))
+
+
+def measure(device, args):
+    threads = lama_backends.configure_torch_threads()
+    reference = lama_backends.load_lama(device, "eager", "off", False)[0]
+    cases = lama_backends.test_set()
+
+    results = []
+    for spec in args.configs.split(","):
+        config = parse_config(spec.strip())
+        model, info = lama_backends.load_lama(device, **config)
+        result = {"config": spec.strip(), "loaded": info}
+        if info.get("error"):
+            result["error"] = info["error"]
+        else:
+            result.update(lama_backends.accuracy(reference, model, cases))
+            result["latency_ms"] = round(1000.0 * latency(model, args.size, args.runs), 1)
+        results.append(result)
+        del model
+    return results, threads
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Measure backend startup time.
+
+Times `import main` in a fresh interpreter, then starts uvicorn and records how long it
+takes until `/` answers and until `/health` reports ready. Prints a JSON report.
+
+Usage (from backend/):
+    python tools/measure_startup.py [--timeout 300] [--repeat 3]
+Environment variables (STARTUP_MODE, MODEL_PRELOAD, ...) are passed through to the server.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+import statistics
+import urllib.error
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import() -> float:
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=BACKEND_DIR, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _status(url: str):
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def measure_server(timeout: float) -> dict:
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+    )
+    first_response = ready = None
+    try:
+        while time.perf_counter() - started < timeout and server.poll() is None:
+            if first_response is None and _status(base + "/") == 200:
+                first_response = time.perf_counter() - started
+            if first_response is not None and _status(base + "/health") == 200:
+                ready = time.perf_counter() - started
+                break
+            time.sleep(0.05)
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+    return {"first_response_s": first_response, "ready_s": ready}
+
+
+def _summary(values: list):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {"min": round(min(values), 3), "median": round(statistics.median(values), 3), "max": round(max(values), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--timeout", type=float, default=300.0, help="Seconds to wait for /health per run")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    imports, runs = [], []
+    for _ in range(max(1, args.repeat)):
+        imports.append(measure_import())
+        runs.append(measure_server(args.timeout))
+
+    print(json.dumps({
+        "startup_mode": os.environ.get("STARTUP_MODE", "background"),
+        "import_main_s": _summary(imports),
+        "first_response_s": _summary([r["first_response_s"] for r in runs]),
+        "ready_s": _summary([r["ready_s"] for r in runs]),
+        "runs": runs,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
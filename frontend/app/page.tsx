@@ -43,6 +43,8 @@ export default function Home() {
   const [historyIndex, setHistoryIndex] = useState(-1);
   const [zoomLevel, setZoomLevel] = useState(1);
   const canvasRef = useRef<InpaintingCanvasHandle>(null);
+  // Server-side copy of imageFile, so repeated edits send only the mask
+  const imageSessionRef = useRef<{ file: File, id: string, baseUrl: string } | null>(null);
   const fileInputRef = useRef<HTMLInputElement>(null);
 
   // Drag & Drop state
@@ -418,6 +420,84 @@ export default function Home() {
     }, mimeType, quality);
   };
 
+  // Paste the changed patches of a delta result onto the image the session holds
+  const applyDelta = async (baseUrl: string, delta: { width: number, height: number, patches: { x: number, y: number, media_type: string, data: string }[] }): Promise<Blob> => {
+    const loadImage = (src: string) => new Promise<HTMLImageElement>((resolve, reject) => {
+      const img = new Image();
+      img.onload = () => resolve(img);
+      img.onerror = reject;
+      img.src = src;
+    });
+
+    const canvas = document.createElement('canvas');
+    canvas.width = delta.width;
+    canvas.height = delta.height;
+    const ctx = canvas.getContext('2d');
+    if (!ctx) throw new Error("Canvas context failed");
+
+    ctx.drawImage(await loadImage(baseUrl), 0, 0, delta.width, delta.height);
+    const patches = await Promise.all(delta.patches.map(p => loadImage(`data:${p.media_type};base64,${p.data}`)));
+    delta.patches.forEach((p, i) => ctx.drawImage(patches[i], p.x, p.y));
+
+    return new Promise((resolve, reject) => {
+      canvas.toBlob(blob => blob ? resolve(blob) : reject(new Error("Failed to compose result")), 'image/png');
+    });
+  };
+
+  // Long-poll the job status until it finishes. The server holds each request open
+  // for up to `wait` seconds, so there is no dead time between completion and response.
+  const pollJob = async (jobId: string): Promise<any> => {
+    let failureCount = 0;
+    while (true) {
+      try {
+        const statusRes = await axios.get(`${apiBaseUrl}/jobs/${jobId}?wait=25`, {
+          headers: { 'ngrok-skip-browser-warning': 'true' }
+        });
+        failureCount = 0; // Reset failure count on success
+        const status = statusRes.data.status;
+        if (status === 'completed') return statusRes.data;
+        if (status === 'failed' || status === 'expired' || status === 'cancelled') {
+          throw Object.assign(new Error(statusRes.data.error || "Job failed"), { fatal: true });
+        }
+      } catch (error: any) {
+        if (error.fatal) throw error;
+        console.warn("Poll failed, retrying...", error);
+        failureCount++;
+        // CPU processing might starve the server for minutes.
+        // We need to be very patient. 150 retries * 5s ~ 12 minutes of coverage.
+        if (failureCount > 150) throw error;
+        await new Promise(r => setTimeout(r, 5000)); // Wait 5s before retrying to relieve load
+      }
+    }
+  };
+
+  // Wait for a job using the server-sent event stream, falling back to long-polling
+  // when EventSource is unavailable or the connection drops.
+  const waitForJob = (jobId: string): Promise<any> => {
+    if (typeof EventSource === 'undefined') return pollJob(jobId);
+    return new Promise((resolve, reject) => {
+      const source = new EventSource(`${apiBaseUrl}/jobs/${jobId}/events`);
+      source.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        if (data.status === 'completed') {
+          source.close();
+          resolve(data);
+        } else if (data.status === 'failed' || data.status === 'expired' || data.status === 'cancelled') {
+          source.close();
+          reject(new Error(data.error || "Job failed"));
+        } else if (data.progress) {
+          setDeviceInfo(`Processing (step ${data.progress.step}/${data.progress.total})`);
+        } else if (data.status === 'queued' && data.queue_position) {
+          setDeviceInfo(`Queued (position ${data.queue_position})`);
+        }
+      };
+      source.onerror = () => {
+        source.close();
+        pollJob(jobId).then(resolve, reject);
+      };
+    });
+  };
+
   const handleClean = async () => {
     if (!imageFile || !maskBlob) return;
     setLoading(true);
@@ -426,74 +506,78 @@ export default function Home() {
     const beforeUrl = imageSrc;
     setBeforeImage(beforeUrl);
 
-    // Compress if needed (Vercel limit workaround)
-    let fileToSend = imageFile;
-    try {
-      fileToSend = await compressImage(imageFile);
-    } catch (err) {
-      console.warn("Compression failed, sending original:", err);
-    }
+    // Upload the image once; later edits of the same file reference it by id
+    // Delta results are patches against the server's copy, so they are composited onto
+    // the exact bytes that were uploaded (possibly compressed), not the local original
+    const ensureImageSession = async (): Promise<{ id: string, baseUrl: string }> => {
+      if (imageSessionRef.current?.file === imageFile) return imageSessionRef.current;
 
-    const formData = new FormData();
-    formData.append("image", fileToSend);
-    formData.append("mask", maskBlob, "mask.png");
+      // Compress if needed (Vercel limit workaround)
+      let fileToSend = imageFile;
+      try {
+        fileToSend = await compressImage(imageFile);
+      } catch (err) {
+        console.warn("Compression failed, sending original:", err);
+      }
+      const uploadData = new FormData();
+      uploadData.append("image", fileToSend);
+      const res = await axios.post(`${apiBaseUrl}/images`, uploadData, {
+        headers: { 'ngrok-skip-browser-warning': 'true' }
+      });
+      imageSessionRef.current = { file: imageFile, id: res.data.image_id, baseUrl: URL.createObjectURL(fileToSend) };
+      return imageSessionRef.current;
+    };
 
-    try {
-      // 1. Submit Job
+    const submitJob = async (imageId: string) => {
+      const formData = new FormData();
+      formData.append("mask", maskBlob, "mask.png");
       const promptParam = prompt ? `&prompt=${encodeURIComponent(prompt)}` : "";
-      const response = await axios.post(`${apiBaseUrl}/inpaint?quality=${qualityPreset}&model=${selectedModel}${promptParam}`, formData, {
+      return axios.post(`${apiBaseUrl}/inpaint?image_id=${imageId}&quality=${qualityPreset}&model=${selectedModel}&delta=true${promptParam}`, formData, {
         headers: { 'ngrok-skip-browser-warning': 'true' }
       });
-      const { job_id } = response.data;
+    };
 
-      // 2. Poll Status
-      let resultBlob: Blob | null = null;
-      let failureCount = 0;
-      let executionMetadata: any = null;
+    try {
+      // 1. Submit Job (re-uploading once if the server-side session has expired)
+      let response;
+      let session = await ensureImageSession();
+      try {
+        response = await submitJob(session.id);
+      } catch (err: any) {
+        if (err.response?.status !== 404) throw err;
+        imageSessionRef.current = null;
+        session = await ensureImageSession();
+        response = await submitJob(session.id);
+      }
+      const { job_id } = response.data;
 
-      while (true) {
-        await new Promise(r => setTimeout(r, 2000)); // Wait 2s
+      // 2. Wait for completion (pushed over SSE, long-poll fallback)
+      const finalStatus = await waitForJob(job_id);
 
-        try {
-          const statusRes = await axios.get(`${apiBaseUrl}/jobs/${job_id}`, {
-            headers: { 'ngrok-skip-browser-warning': 'true' }
-          });
-          const status = statusRes.data.status;
-          failureCount = 0; // Reset failure count on success
-
-          if (status === 'completed') {
-            // 3. Get Result
-            const resultRes = await axios.get(`${apiBaseUrl}/results/${job_id}`, {
-              responseType: 'blob',
-              headers: { 'ngrok-skip-browser-warning': 'true' }
-            });
-            resultBlob = resultRes.data;
-            executionMetadata = {
-              model_used: statusRes.data.model_used,
-              execution_time: statusRes.data.execution_time
-            };
-            break;
-          } else if (status === 'failed') {
-            throw new Error(statusRes.data.error || "Job failed");
-          }
-        } catch (error) {
-          console.warn("Poll failed, retrying...", error);
-          failureCount++;
-          // CPU processing might starve the server for minutes. 
-          // We need to be very patient. 150 retries * 5s ~ 12 minutes of coverage.
-          if (failureCount > 150) throw error;
-          await new Promise(r => setTimeout(r, 5000)); // Wait 5s before retrying to relieve load
-        }
-      }
+      // 3. Get Result (only the changed patches) and composite it locally
+      const resultRes = await axios.get(`${apiBaseUrl}/results/${job_id}`, {
+        headers: { 'ngrok-skip-browser-warning': 'true' }
+      });
+      const resultBlob: Blob | null = await applyDelta(session.baseUrl, resultRes.data);
+      const executionMetadata = {
+        model_used: finalStatus.model_used,
+        execution_time: finalStatus.execution_time
+      };
 
       if (!resultBlob) throw new Error("Failed to get result");
 
       const newImageBlob = resultBlob;
       const newUrl = URL.createObjectURL(newImageBlob);
 
-      // Update state for continuous editing
+      // Update state for continuous editing. The server chained the edit onto the
+      // session, so the next edit of this file needs no upload and its deltas apply
+      // to this result, which matches the server's new version.
+      const newFile = new File([newImageBlob], "cleaned.png", { type: "image/png" });
+      if (imageSessionRef.current?.id === session.id && finalStatus.image_version) {
+        imageSessionRef.current = { file: newFile, id: session.id, baseUrl: newUrl };
+      }
       setImageSrc(newUrl);
-      setImageFile(new File([newImageBlob], "cleaned.png", { type: "image/png" }));
+      setImageFile(newFile);
 
       const newHistory = history.slice(0, historyIndex + 1);
       newHistory.push(newUrl);
@@ -738,18 +822,26 @@ export default function Home() {
       extend_right: outpaintValues.right.toString(),
       extend_top: outpaintValues.top.toString(),
       extend_bottom: outpaintValues.bottom.toString(),
+      quality: qualityPreset,
+      model: selectedModel,
     });
 
     try {
+      // Outpainting runs as a job, like inpainting
       const response = await axios.post(`${apiBaseUrl}/outpaint?${params}`, formData, {
+        headers: { 'ngrok-skip-browser-warning': 'true' }
+      });
+      const { job_id } = response.data;
+      await waitForJob(job_id);
+      const resultRes = await axios.get(`${apiBaseUrl}/results/${job_id}`, {
         responseType: "blob",
-        timeout: 300000,
+        headers: { 'ngrok-skip-browser-warning': 'true' }
       });
 
-      const newUrl = URL.createObjectURL(response.data);
+      const newUrl = URL.createObjectURL(resultRes.data);
       setBeforeImage(imageSrc);
       setImageSrc(newUrl);
-      setImageFile(new File([response.data], "outpainted.png", { type: "image/png" }));
+      setImageFile(new File([resultRes.data], "outpainted.png", { type: "image/png" }));
 
       const newHistory = history.slice(0, historyIndex + 1);
       newHistory.push(newUrl);